@@ -1,9 +1,38 @@
+import copy
 import inspect
+import json
+import shutil
 import sys
-import shelve
-from PySide6.QtWidgets import QAbstractItemView, QFileDialog, QDialog, QTextBrowser, QMessageBox
-
-from modules import *
+import threading
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+from PySide6.QtCore import QObject, QTimer, Signal
+from PySide6.QtWidgets import QAbstractItemView, QFileDialog, QDialog, QTextBrowser, QMessageBox, QCheckBox
+
+from modules.ui import *
+
+if TYPE_CHECKING:
+    from modules.cowan.data import ExpData, CalData, Widen, SpectraAdd
+    from modules.cowan.grid import AdaptiveScheduler, GridScheduler
+
+
+def import_main_modules():
+    """
+    导入主界面需要的模块，登录界面只需要 Qt，打开项目时才调用
+    pandas、scipy 和 plotly 在第一次使用 ExpData、CalData、Widen 和 SpectraAdd 时才导入，
+    导入时间见 python -m modules.import_time
+    """
+    global np, ATOM, SUBSHELL_SEQUENCE, Atomic, In36, In2, Recorder, Run, RunCache, RunManager, \
+        BatchRunner, load_jobs, METRICS, rainbow_color
+    import numpy as np
+    from modules.cowan.atom import ATOM, SUBSHELL_SEQUENCE, Atomic
+    from modules.cowan.input_files import In36, In2
+    from modules.cowan.run import Recorder, Run, RunCache, RunManager
+    from modules.cowan.batch import BatchRunner, load_jobs
+    from modules.cowan.similarity import METRICS
+    from modules.tools import rainbow_color
 
 
 class VerticalLine(QWidget):
@@ -30,8 +59,76 @@ class VerticalLine(QWidget):
             event.accept()
 
 
+class PlotView(QObject):
+    def __init__(self, web_view: QWebEngineView, figure_path: Path):
+        """
+        在网页中显示图，网页（包括 plotly.js）只在第一次显示时加载，之后用 Plotly.react 替换图中的数据，
+        不再为每次更新写一个 HTML 文件，也不重新加载网页
+        Args:
+            web_view: 显示图的控件
+            figure_path: 项目的 figure 文件夹，网页保存在其中，见 figure.get_view_page
+        """
+        super().__init__(web_view)
+        self.web_view = web_view
+        self.figure_path = figure_path
+        self.page_url: QUrl | None = None
+        self.loaded = False
+        # 网页加载完成前最后一次设置的图
+        self.script: str | None = None
+        self.web_view.loadFinished.connect(self.slot_load_finished)
+
+    def set_figure(self, figure: dict):
+        """
+        显示图，网页还没有加载完成时只保留最后一次设置的图，加载完成后显示
+        Args:
+            figure: plotly 格式的字典，见 figure.line_figure
+        """
+        from modules.cowan.figure import to_json, get_view_page
+        self.script = f'update({to_json(figure)});'
+        if self.loaded:
+            self.run_script()
+        elif self.page_url is None:
+            self.page_url = QUrl.fromLocalFile(get_view_page(self.figure_path).as_posix())
+            self.web_view.load(self.page_url)
+
+    def slot_load_finished(self, ok):
+        # 控件初始化时加载的空白页也会触发该信号
+        if not ok or self.web_view.url() != self.page_url:
+            return
+        self.loaded = True
+        self.run_script()
+
+    def run_script(self):
+        if self.script is not None:
+            self.web_view.page().runJavaScript(self.script)
+            self.script = None
+
+
+class RunSignals(QObject):
+    """
+    Cowan 程序在后台线程中运行，通过信号把输出传回主线程
+    """
+    output = Signal(str, str, str)
+    stage = Signal(str, str)
+    finished = Signal(object, object, object)
+    batch_job_finished = Signal(object, object)
+    batch_finished = Signal(object, object)
+
+
+class GridSignals(QObject):
+    """
+    网格计算在后台线程中进行，通过信号把结果传回主线程
+    """
+    updated = Signal(int, object)
+    finished = Signal(object)
+    # 自适应搜索的进度和结束
+    progress = Signal(float)
+    search_finished = Signal(object)
+
+
 class MainWindow(QMainWindow):
     def __init__(self, path, load_project=False):
+        import_main_modules()
         super().__init__()
         self.ui = Ui_main_window()
         self.ui.setupUi(self)
@@ -51,6 +148,34 @@ class MainWindow(QMainWindow):
         self.spectra_add: SpectraAdd | None = None
 
         self.v_line: VerticalLine | None = None
+        # 各个图，见 PlotView
+        figure_path = self.PROJECT_PATH / 'figure'
+        self.exp_plot = PlotView(self.ui.exp_web, figure_path)
+        self.cal_line_plot = PlotView(self.ui.web_cal_line, figure_path)
+        self.cal_widen_plot = PlotView(self.ui.web_cal_widen, figure_path)
+        self.add_spectrum_plot = PlotView(self.ui.page2_add_spectrum_web, figure_path)
+        self.grid_plot = PlotView(self.ui.page2_grid_web, figure_path)
+        # 第一页的图片是否需要重新加载，见 update_page1_plots
+        self.page1_plots_stale = False
+
+        # Cowan 计算
+        self.run_manager = RunManager()
+        self.run_signals = RunSignals()
+        self.run_signals.output.connect(self.slot_run_output)
+        self.run_signals.stage.connect(self.slot_run_stage)
+        self.run_signals.finished.connect(self.slot_run_finished)
+        self.run_signals.batch_job_finished.connect(self.slot_batch_job_finished)
+        self.run_signals.batch_finished.connect(self.slot_batch_finished)
+        self.batch_runner: BatchRunner | None = None
+
+        # 网格计算
+        self.grid_scheduler: GridScheduler | AdaptiveScheduler | None = None
+        self.grid_signals = GridSignals()
+        self.grid_signals.updated.connect(self.slot_page2_grid_updated)
+        self.grid_signals.finished.connect(self.slot_page2_grid_finished)
+        self.grid_signals.progress.connect(self.slot_page2_search_progress)
+        self.grid_signals.search_finished.connect(self.slot_page2_search_finished)
+        self.grid_plot_time = 0.0
 
         # 初始化
         self.init()
@@ -75,6 +200,37 @@ class MainWindow(QMainWindow):
         self.ui.page2_grid_list.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)  # 设置表格不可编辑
         self.ui.page2_grid_list.horizontalHeader().setSectionResizeMode(
             QHeaderView.ResizeMode.ResizeToContents)  # 设置表格列宽自适应
+        # 相似度的选择，勾选的第一个用于热力图和自适应搜索，放在开始计算按钮的上方
+        self.ui.page2_metric_list = QListWidget(self.ui.groupBox_5)
+        for name, metric in METRICS.items():
+            item = QListWidgetItem(metric.label)
+            item.setData(Qt.UserRole, name)
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            item.setCheckState(Qt.Checked if name == 'dtw' else Qt.Unchecked)
+            self.ui.page2_metric_list.addItem(item)
+        self.ui.page2_metric_list.setMaximumHeight(100)
+        self.ui.verticalLayout_10.insertWidget(
+            self.ui.verticalLayout_10.indexOf(self.ui.page2_cal_grid), self.ui.page2_metric_list)
+        # 自适应搜索
+        self.ui.page2_adaptive_search = QCheckBox('自适应搜索', self.ui.groupBox_5)
+        self.ui.verticalLayout_10.insertWidget(
+            self.ui.verticalLayout_10.indexOf(self.ui.page2_cal_grid), self.ui.page2_adaptive_search)
+        # 精确DTW，数值与默认的 fastdtw 不同，不能和以前的结果比较
+        self.ui.page2_dtw_band = QCheckBox('精确DTW（带宽约束）', self.ui.groupBox_5)
+        self.ui.verticalLayout_10.insertWidget(
+            self.ui.verticalLayout_10.indexOf(self.ui.page2_cal_grid), self.ui.page2_dtw_band)
+        # Cowan 程序的输出窗口
+        self.run_log_dialog = QDialog(self)
+        self.run_log_dialog.setWindowTitle('计算输出')
+        self.run_log_dialog.resize(800, 400)
+        self.run_log = QTextBrowser(self.run_log_dialog)
+        self.run_log.setStyleSheet('font: 10pt "Consolas";')
+        QVBoxLayout(self.run_log_dialog).addWidget(self.run_log)
+        # 批量计算
+        self.ui.batch_run = QAction('批量计算', self)
+        self.ui.menu_2.addAction(self.ui.batch_run)
+        self.ui.clear_run_cache = QAction('清除计算缓存', self)
+        self.ui.menu_2.addAction(self.ui.clear_run_cache)
         # 隐藏不必要的按钮
         # self.ui.page_up.hide()
         # self.ui.page_down.hide()
@@ -83,11 +239,14 @@ class MainWindow(QMainWindow):
         # 页面切换按钮
         self.ui.page_up.clicked.connect(lambda x: self.ui.stackedWidget.setCurrentIndex(0))
         self.ui.page_down.clicked.connect(lambda x: self.ui.stackedWidget.setCurrentIndex(1))
+        self.ui.stackedWidget.currentChanged.connect(self.slot_page_changed)
 
         # 菜单栏
         self.ui.save_project.triggered.connect(self.slot_save_project)
         self.ui.exit_project.triggered.connect(self.slot_exit_project)
         self.ui.load_exp_data.triggered.connect(self.slot_load_exp_data)  # 加载实验数据
+        self.ui.batch_run.triggered.connect(self.slot_batch_run)  # 批量计算
+        self.ui.clear_run_cache.triggered.connect(self.slot_clear_run_cache)  # 清除计算缓存
         self.ui.show_guides.triggered.connect(self.slot_show_guides)  # 显示参考线
         # 元素选择 - 下拉框
         self.ui.atomic_num.activated.connect(self.slot_atomic_num)  # 原子序数
@@ -149,7 +308,8 @@ class MainWindow(QMainWindow):
             shutil.copyfile(path, new_path)
         except shutil.SameFileError:
             pass
-        self.exp_data = ExpData(self.PROJECT_PATH, new_path)
+        from modules.cowan.data import ExpData
+        self.exp_data = ExpData(self.PROJECT_PATH, new_path, plot=False)
         self.update_exp_data_obj_about()
 
         self.ui.load_exp_data.setText('重新加载实验数据')
@@ -212,59 +372,180 @@ class MainWindow(QMainWindow):
         if self.exp_data is None:
             self.ui.statusbar.showMessage('请先加载实验数据')
             return
+        # 同名的计算正在进行时再次点击按钮则取消计算
+        name = '{}_{}'.format(self.atom.symbol, self.atom.ion)
+        if self.run_manager.is_running(name):
+            self.run_manager.cancel(name)
+            return
         # 获取界面中的数据
         self.get_in36_control_card()
         self.get_in2_control_card()
         # 获取当前时间
         # current_time = datetime.datetime.now()
-        # 创建运行对象
-        self.run = Run(project_path=self.PROJECT_PATH,
-                       # name='{:0>4d}{:0>2d}{:0>2d}{:0>2d}{:0>2d}{:0>2d}_{}_{}'.format(
-                       #     current_time.year, current_time.month, current_time.day,
-                       #     current_time.hour, current_time.minute, current_time.second,
-                       #     self.atom.symbol, self.atom.ion),
-                       name='{}_{}'.format(self.atom.symbol, self.atom.ion),
-                       in36=self.in36,
-                       in2=self.in2,
-                       recorder=self.recorder,
-                       coupling_mode=self.ui.coupling_mode.currentIndex() + 1)
+        # 创建运行对象，在后台线程中运行，结束后在 slot_run_finished 中继续处理
+        run = Run(project_path=self.PROJECT_PATH,
+                  # name='{:0>4d}{:0>2d}{:0>2d}{:0>2d}{:0>2d}{:0>2d}_{}_{}'.format(
+                  #     current_time.year, current_time.month, current_time.day,
+                  #     current_time.hour, current_time.minute, current_time.second,
+                  #     self.atom.symbol, self.atom.ion),
+                  name=name,
+                  in36=copy.deepcopy(self.in36),
+                  in2=copy.deepcopy(self.in2),
+                  recorder=self.recorder,
+                  coupling_mode=self.ui.coupling_mode.currentIndex() + 1,
+                  auto_run=False)
+        # 计算结束时界面中的设置可能已经改变，展宽和保存使用提交时的设置
+        context = {'atom': copy.deepcopy(self.atom),
+                   'exp_data': copy.deepcopy(self.exp_data),
+                   'temperature': self.ui.temperature_1.value()}
+        self.run_log.clear()
+        self.run_log_dialog.show()
+        self.ui.run_cowan.setText('取消')
+        self.run_manager.submit(
+            run,
+            on_output=lambda stage, line: self.run_signals.output.emit(run.name, stage, line),
+            on_stage=lambda stage: self.run_signals.stage.emit(run.name, stage),
+            on_finished=lambda run_, error: self.run_signals.finished.emit(run_, error, context))
+
+    def slot_run_output(self, name, stage, line):
+        self.run_log.append(f'[{name} {stage}] {line}')
+
+    def slot_run_stage(self, name, stage):
+        self.ui.statusbar.showMessage(f'{name}：正在运行 {stage}（{Run.STAGES.index(stage) + 1}/{len(Run.STAGES)}）')
+
+    def slot_run_finished(self, run, error, context):
+        if not self.run_manager.is_running():
+            self.ui.run_cowan.setText('计算')
+        if error is not None:
+            QMessageBox.warning(self, '警告', f'{run.name} 计算出错：{error}')
+            return
+        if run.state == 'cancelled':
+            self.ui.statusbar.showMessage(f'{run.name} 计算已取消！')
+            return
+        if run.state == 'failed':
+            QMessageBox.warning(self, '警告', '{} 计算出错，程序的返回值不为0：{}'.format(
+                run.name, '，'.join(f'{stage} {code}' for stage, code in run.get_failed_stages().items())))
+            return
+        self.ui.statusbar.showMessage(f'{run.name} 计算完成！')
+        self.run = run
         self.update_run_obj_about()
-        # 创建计算数据对象
-        self.cal_data = CalData(project_path=self.PROJECT_PATH,
-                                exp_data=self.exp_data,
-                                name=self.run.name)
+        self.cal_data, self.widen = self.save_run_objects(run, context)
         self.update_cal_data_obj_about()
-        # 创建展宽对象
-        self.widen = Widen(project_path=self.PROJECT_PATH,
-                           exp_data=self.exp_data,
-                           cal_data=self.cal_data,
-                           delta_lambda=0.0,
-                           n=500)
-        self.widen.widen(temperature=self.ui.temperature_1.value())
         self.ui.gauss.setEnabled(True)
         self.ui.crossP.setEnabled(True)
         self.ui.crossNP.setEnabled(True)
         self.update_widen_obj_about()
+
+    def save_run_objects(self, run, context):
+        """
+        创建计算数据和展宽对象，并把此状态保存到 cal_result/<名称>/obj_info，双击历史记录时读取
+        Args:
+            run: 已经完成的计算
+            context: 提交计算时的设置，见 slot_run_cowan
+
+        Returns:
+            计算数据对象和展宽对象
+        """
+        from modules.cowan.data import CalData, Widen
+        from modules.cowan.store import save_objects
+        # 创建计算数据对象
+        cal_data = CalData(project_path=self.PROJECT_PATH,
+                           exp_data=context['exp_data'],
+                           name=run.name,
+                           plot=False)
+        # 创建展宽对象
+        widen = Widen(project_path=self.PROJECT_PATH,
+                      exp_data=context['exp_data'],
+                      cal_data=cal_data,
+                      delta_lambda=0.0,
+                      n=500)
+        widen.widen(temperature=context['temperature'])
         # 将此状态保存
-        obj_info = shelve.open(self.PROJECT_PATH.joinpath(f'cal_result/{self.run.name}/obj_info').as_posix())
-        obj_info['atom'] = self.atom
-        obj_info['cal_data'] = self.cal_data
-        obj_info['exp_data'] = self.exp_data
-        obj_info['in36'] = self.in36
-        obj_info['in2'] = self.in2
-        obj_info['cal_data'] = self.cal_data
-        obj_info['run'] = self.run
-        obj_info['widen'] = self.widen
-        obj_info.close()
+        save_objects(self.PROJECT_PATH.joinpath(f'cal_result/{run.name}/obj_info'),
+                     atom=context['atom'] or Atomic(run.in36.atomic_num, run.in36.atomic_ion),
+                     exp_data=context['exp_data'],
+                     in36=run.in36,
+                     in2=run.in2,
+                     run=run,
+                     cal_data=cal_data,
+                     widen=widen)
+        return cal_data, widen
+
+    def slot_batch_run(self):
+        # 正在批量计算时再次点击则取消
+        if self.batch_runner is not None:
+            self.batch_runner.cancel()
+            return
+        # 每个任务完成后与单个计算一样展宽并保存，需要实验数据
+        if self.exp_data is None:
+            self.ui.statusbar.showMessage('请先加载实验数据')
+            return
+        path, types = QFileDialog.getOpenFileName(self, '请选择任务文件', self.PROJECT_PATH.as_posix(), '(*.json)')
+        if not path:
+            return
+        # 任务文件中没有指定模板时，使用界面中的控制卡
+        self.get_in36_control_card()
+        self.get_in2_control_card()
+        try:
+            config = load_jobs(Path(path))
+            self.batch_runner = BatchRunner(self.PROJECT_PATH, config['jobs'],
+                                            config['in36'] or self.in36, config['in2'] or self.in2,
+                                            recorder=self.recorder, max_workers=config['workers'])
+        except Exception as e:
+            QMessageBox.warning(self, '警告', f'任务文件有误：{e}')
+            return
+        self.run_log.clear()
+        self.run_log_dialog.show()
+        self.ui.batch_run.setText('取消批量计算')
+        runner = self.batch_runner
+        # 各任务的原子不同，保存时由 in36 得到，见 save_run_objects
+        context = {'atom': None,
+                   'exp_data': copy.deepcopy(self.exp_data),
+                   'temperature': self.ui.temperature_1.value(),
+                   'runs': {run.name: run for run in runner.runs}}
+
+        def target():
+            error = None
+            try:
+                runner.run(on_output=lambda name, stage, line: self.run_signals.output.emit(name, stage, line),
+                           on_job_finished=lambda result: self.run_signals.batch_job_finished.emit(result, context))
+            except Exception as e:
+                error = e
+            self.run_signals.batch_finished.emit(runner, error)
+
+        threading.Thread(target=target, daemon=True).start()
+
+    def slot_batch_job_finished(self, result, context):
+        self.ui.statusbar.showMessage('{} {}，用时 {:.1f} s'.format(result['name'], result['state'], result['time']))
+        if result['state'] == 'finished':
+            # 历史记录中的计算结果要与 cal_result 中的 spectra.dat 对应，覆盖以前同名计算保存的状态
+            try:
+                self.save_run_objects(context['runs'][result['name']], context)
+            except Exception as e:
+                self.run_log.append(f'{result["name"]} 保存计算结果出错：{e}')
+        self.update_recorder_obj_about()
+
+    def slot_batch_finished(self, runner, error):
+        self.batch_runner = None
+        self.ui.batch_run.setText('批量计算')
+        if error is not None:
+            QMessageBox.warning(self, '警告', f'批量计算出错：{error}')
+            return
+        self.run_log.append(runner.get_summary_text())
+        self.update_recorder_obj_about()
+
+    def slot_clear_run_cache(self):
+        RunCache(self.PROJECT_PATH).clear()
+        self.ui.statusbar.showMessage('计算缓存已清除！')
 
     def slot_gauss(self):
-        self.ui.web_cal_widen.load(QUrl.fromLocalFile(self.widen.plot_path_gauss))
+        self.cal_widen_plot.set_figure(self.widen.get_figure('gauss'))
 
     def slot_crossp(self):
-        self.ui.web_cal_widen.load(QUrl.fromLocalFile(self.widen.plot_path_cross_P))
+        self.cal_widen_plot.set_figure(self.widen.get_figure('cross_P'))
 
     def slot_crossnp(self):
-        self.ui.web_cal_widen.load(QUrl.fromLocalFile(self.widen.plot_path_cross_NP))
+        self.cal_widen_plot.set_figure(self.widen.get_figure('cross_NP'))
 
     def slot_load_in36(self):
         path, types = QFileDialog.getOpenFileName(self, '请选择in36文件', self.PROJECT_PATH.as_posix(), '')
@@ -354,37 +635,42 @@ class MainWindow(QMainWindow):
         self.update_recorder_obj_about()
 
     def slot_load_history(self, index):
+        from modules.cowan.store import load_objects
         name = index.text()
-        obj_info = shelve.open(self.PROJECT_PATH.joinpath(f'cal_result/{name}/obj_info').as_posix())
+        try:
+            obj_info = load_objects(self.PROJECT_PATH.joinpath(f'cal_result/{name}/obj_info'), self.PROJECT_PATH,
+                                    self.recorder)
+        except FileNotFoundError:
+            QMessageBox.warning(self, '警告', f'{name} 没有保存的计算结果')
+            return
         self.atom = obj_info['atom']
-        self.cal_data = obj_info['cal_data']
         self.exp_data = obj_info['exp_data']
         self.in36 = obj_info['in36']
         self.in2 = obj_info['in2']
         self.cal_data = obj_info['cal_data']
         self.run = obj_info['run']
         self.widen = obj_info['widen']
-        obj_info.close()
         self.update_atom_obj_about()
         self.update_in36_obj_about()
         self.update_in2_obj_about()
-        self.update_exp_data_obj_about()
         self.update_run_obj_about()
-        self.update_cal_data_obj_about()
-        self.update_widen_obj_about()
+        self.set_page1_plots_stale()
+
+    def slot_page_changed(self, index):
+        if index == 0:
+            self.update_page1_plots()
 
     def slot_save_project(self):
-        obj_info = shelve.open(self.PROJECT_PATH.joinpath('.cowan/obj_info').as_posix())
-        obj_info['atom'] = self.atom
-        obj_info['cal_data'] = self.cal_data
-        obj_info['exp_data'] = self.exp_data
-        obj_info['in36'] = self.in36
-        obj_info['in2'] = self.in2
-        obj_info['cal_data'] = self.cal_data
-        obj_info['recorder'] = self.recorder
-        obj_info['run'] = self.run
-        obj_info['widen'] = self.widen
-        obj_info.close()
+        from modules.cowan.store import save_objects
+        save_objects(self.PROJECT_PATH.joinpath('.cowan/obj_info'),
+                     atom=self.atom,
+                     exp_data=self.exp_data,
+                     in36=self.in36,
+                     in2=self.in2,
+                     recorder=self.recorder,
+                     run=self.run,
+                     cal_data=self.cal_data,
+                     widen=self.widen)
         self.ui.statusbar.showMessage('项目保存成功！')
 
     def slot_exit_project(self):
@@ -394,21 +680,32 @@ class MainWindow(QMainWindow):
     def slot_page2_plot_spectrum(self):
         temperature = self.ui.page2_temperature.value()
         density = self.ui.page2_density_base.value() * 10 ** self.ui.page2_density_index.value()
+        from modules.cowan.data import CalData, Widen, SpectraAdd
         add_name_list = self.recorder.selection
-        cal_obj_list = [CalData(self.PROJECT_PATH, self.exp_data, name) for name in add_name_list]
+        cal_obj_list = [CalData(self.PROJECT_PATH, self.exp_data, name, plot=False) for name in add_name_list]
         widen_obj_list = [Widen(self.PROJECT_PATH, self.exp_data, cal_obj) for cal_obj in cal_obj_list]
 
         if self.spectra_add:
             self.spectra_add.widen_list = widen_obj_list
         else:
             self.spectra_add = SpectraAdd(self.PROJECT_PATH, self.atom, self.exp_data, widen_obj_list)
+        self.spectra_add.metrics = self.get_selected_metrics()
+        self.spectra_add.dtw_method = 'band' if self.ui.page2_dtw_band.isChecked() else 'fastdtw'
         self.spectra_add.get_add_data(temperature, density)
-        self.spectra_add.plot_html()
+        self.ui.statusbar.showMessage('，'.join(['{}：{:.4f}'.format(METRICS[name].label, value)
+                                               for name, value in self.spectra_add.similarities.items()]))
         self.update_spectra_add_obj_about()
 
     def slot_page2_cal_grid(self):
+        # 正在计算时再次点击按钮则取消计算
+        if self.grid_scheduler is not None and self.grid_scheduler.is_running():
+            self.grid_scheduler.cancel()
+            self.ui.page2_cal_grid.setEnabled(False)
+            return
+
+        from modules.cowan.data import CalData, Widen, SpectraAdd
         add_name_list = self.recorder.selection
-        cal_obj_list = [CalData(self.PROJECT_PATH, self.exp_data, name) for name in add_name_list]
+        cal_obj_list = [CalData(self.PROJECT_PATH, self.exp_data, name, plot=False) for name in add_name_list]
         widen_obj_list = [Widen(self.PROJECT_PATH, self.exp_data, cal_obj) for cal_obj in cal_obj_list]
 
         t_num = self.ui.temperature_num.value()
@@ -419,9 +716,62 @@ class MainWindow(QMainWindow):
             np.log10(self.ui.density_max_base.value() * 10 ** self.ui.density_max_index.value()),
             ne_num))
         self.spectra_add = SpectraAdd(self.PROJECT_PATH, self.atom, self.exp_data, widen_obj_list)
+        self.spectra_add.metrics = self.get_selected_metrics()
+        self.spectra_add.dtw_method = 'band' if self.ui.page2_dtw_band.isChecked() else 'fastdtw'
         self.ui.page2_progressBar.setValue(0)
-        self.spectra_add.get_cal_grid(ne_list, t_list, self.ui.page2_progressBar)
+        self.ui.page2_cal_grid.setText('停止计算')
+        if self.ui.page2_adaptive_search.isChecked():
+            self.grid_scheduler = self.spectra_add.start_adaptive_search(
+                (t_list[0], t_list[-1]), (ne_list[0], ne_list[-1]),
+                on_progress=lambda value: self.grid_signals.progress.emit(value),
+                on_finished=lambda scheduler: self.grid_signals.search_finished.emit(scheduler))
+            return
+        self.grid_plot_time = 0.0
+        self.grid_scheduler = self.spectra_add.start_cal_grid(
+            ne_list, t_list,
+            on_result=lambda start, block: self.grid_signals.updated.emit(start, block),
+            on_finished=lambda scheduler: self.grid_signals.finished.emit(scheduler))
+        self.update_grid_list()
+
+    def slot_page2_grid_updated(self, start, block):
+        if self.grid_scheduler is None:
+            return
+        finished = np.count_nonzero(~np.isnan(self.grid_scheduler.result))
+        self.ui.page2_progressBar.setValue(finished / self.grid_scheduler.result.size * 100)
+        self.update_grid_list(start, start + block.shape[1])
+        # 热力图最多每 0.2 秒刷新一次
+        if time.time() - self.grid_plot_time > 0.2:
+            self.grid_plot.set_figure(self.spectra_add.get_grid_figure())
+            self.grid_plot_time = time.time()
+
+    def slot_page2_grid_finished(self, scheduler):
+        self.ui.page2_cal_grid.setText('开始计算')
+        self.ui.page2_cal_grid.setEnabled(True)
+        if scheduler.error is not None:
+            QMessageBox.warning(self, '警告', f'网格计算出错：{scheduler.error}')
+            return
+        self.spectra_add.set_grid_data(scheduler.t_values, scheduler.n_values, scheduler.result, scheduler.results)
+        self.update_grid_list()
+        self.grid_plot.set_figure(self.spectra_add.get_grid_figure())
+        if scheduler.cancelled:
+            self.ui.statusbar.showMessage('网格计算已取消！')
+
+    def slot_page2_search_progress(self, value):
+        self.ui.page2_progressBar.setValue(value)
+
+    def slot_page2_search_finished(self, scheduler):
+        self.ui.page2_cal_grid.setText('开始计算')
+        self.ui.page2_cal_grid.setEnabled(True)
+        if scheduler.error is not None:
+            QMessageBox.warning(self, '警告', f'自适应搜索出错：{scheduler.error}')
+            return
+        if scheduler.cancelled:
+            self.ui.statusbar.showMessage('自适应搜索已取消！')
+            return
+        temperature, density, similarity = scheduler.best
         self.update_spectra_add_obj_about()
+        self.ui.statusbar.showMessage('最佳温度：{:.3f}，最佳密度：{:.3e}，共计算{}个点'.format(
+            temperature, density, self.spectra_add.search_data.shape[0]))
 
     def slot_page2_grid_list_clicked(self, item):
         temperature = self.spectra_add.grid_data['temperature'][item.column()]
@@ -432,6 +782,17 @@ class MainWindow(QMainWindow):
         self.ui.page2_density_index.setValue(eval(temp[1]))
         self.slot_page2_plot_spectrum()
 
+    def get_selected_metrics(self):
+        """
+        获取勾选的相似度名称，一个都没有勾选时使用 DTW
+        """
+        metrics = []
+        for i in range(self.ui.page2_metric_list.count()):
+            item = self.ui.page2_metric_list.item(i)
+            if item.checkState() == Qt.Checked:
+                metrics.append(item.data(Qt.UserRole))
+        return metrics or ['dtw']
+
     def get_in36_control_card(self):
         v0 = '{:>1}'.format(self.ui.in36_1.text())
         v1 = '{:>1}'.format(self.ui.in36_2.text())
@@ -535,6 +896,7 @@ class MainWindow(QMainWindow):
         for i in range(23):
             eval(f'self.ui.in36_{i + 1}').setText(self.in36.control_card[i].strip(' '))
         # 更新组态
+        import pandas as pd
         df = pd.DataFrame(self.in36.configuration_card, columns=['原子序数', '原子状态', '标识符', '空格', '组态'],
                           index=list(range(1, len(self.in36.configuration_card) + 1)))
         df['宇称'] = self.in36.parity
@@ -562,16 +924,16 @@ class MainWindow(QMainWindow):
                 eval(f'self.ui.{n}').setText(self.in2.input_card[i].strip(' '))
 
     def update_exp_data_obj_about(self):
-        self.ui.exp_web.load(QUrl.fromLocalFile(self.exp_data.plot_path))
+        self.exp_plot.set_figure(self.exp_data.get_figure())
 
     def update_run_obj_about(self):
         self.update_recorder_obj_about()
 
     def update_cal_data_obj_about(self):
-        self.ui.web_cal_line.load(QUrl.fromLocalFile(self.cal_data.plot_path))
+        self.cal_line_plot.set_figure(self.cal_data.get_figure())
 
     def update_widen_obj_about(self):
-        self.widen.plot_widen()
+        # 只显示当前选择的一张图，其余的在切换时显示
         if self.ui.crossP.isChecked():
             self.slot_crossp()
         elif self.ui.crossNP.isChecked():
@@ -579,6 +941,28 @@ class MainWindow(QMainWindow):
         elif self.ui.gauss.isChecked():
             self.slot_gauss()
 
+    def set_page1_plots_stale(self):
+        """
+        第一页的图需要更新，正在显示第一页时在事件循环空闲后更新，否则切换到第一页时再更新
+        """
+        self.page1_plots_stale = True
+        if self.ui.stackedWidget.currentIndex() == 0:
+            QTimer.singleShot(0, self.update_page1_plots)
+
+    def update_page1_plots(self):
+        """
+        更新第一页的实验谱、线状谱和展宽结果的图
+        """
+        if not self.page1_plots_stale:
+            return
+        self.page1_plots_stale = False
+        if self.exp_data is not None:
+            self.update_exp_data_obj_about()
+        if self.cal_data is not None:
+            self.update_cal_data_obj_about()
+        if self.widen is not None:
+            self.update_widen_obj_about()
+
     def update_recorder_obj_about(self):
         # 更新历史记录
         self.ui.run_history_list.clear()
@@ -597,23 +981,44 @@ class MainWindow(QMainWindow):
         fun_name = list(map(lambda x: x[3], inspect.stack()))
         # 如果是网格计算，就不绘图
         if 'slot_page2_cal_grid' not in fun_name:
-            self.ui.page2_add_spectrum_web.load(QUrl.fromLocalFile(self.spectra_add.plot_path))
+            self.add_spectrum_plot.set_figure(self.spectra_add.get_figure())
         # 绘制网格计算相关的东西
         if self.spectra_add.grid_data:
-            self.ui.page2_grid_web.load(QUrl.fromLocalFile(self.spectra_add.grid_path))
-            # 设置表格
+            self.grid_plot.set_figure(self.spectra_add.get_grid_figure())
+            self.update_grid_list()
+
+    def update_grid_list(self, start=None, stop=None):
+        """
+        设置网格计算的表格
+        Args:
+            start: 只更新从该温度开始的列，为None时重建整个表格
+            stop: 只更新到该温度为止的列（不包含）
+        """
+        similarity = self.spectra_add.similarity
+        row_num, column_num = similarity.shape
+        if start is None:
+            start, stop = 0, column_num
             self.ui.page2_grid_list.clear()
-            self.ui.page2_grid_list.setRowCount(self.spectra_add.similarity.shape[0])
-            self.ui.page2_grid_list.setColumnCount(self.spectra_add.similarity.shape[1])
-            self.ui.page2_grid_list.setHorizontalHeaderLabels(self.spectra_add.similarity.columns)
-            self.ui.page2_grid_list.setVerticalHeaderLabels(self.spectra_add.similarity.index[::-1])
-            sim_max = self.spectra_add.similarity.values.flatten().max()
-            for i in range(self.spectra_add.similarity.shape[0]):
-                for j in range(self.spectra_add.similarity.shape[1]):
-                    item = QTableWidgetItem('{:.4f}'.format(self.spectra_add.similarity.iloc[i, j], ))
-                    item.setBackground(QBrush(
-                        QColor(*rainbow_color(self.spectra_add.similarity.iloc[i, j] / sim_max))))
-                    self.ui.page2_grid_list.setItem(self.spectra_add.similarity.shape[0] - i - 1, j, item)
+            self.ui.page2_grid_list.setRowCount(row_num)
+            self.ui.page2_grid_list.setColumnCount(column_num)
+            self.ui.page2_grid_list.setHorizontalHeaderLabels(similarity.columns)
+            self.ui.page2_grid_list.setVerticalHeaderLabels(similarity.index[::-1])
+        values = similarity.values
+        if np.isnan(values).all():
+            return
+        sim_max = np.nanmax(values)
+        metric_grids = self.spectra_add.grid_data.get('metrics', {})
+        for i in range(row_num):
+            for j in range(start, stop):
+                if np.isnan(values[i, j]):
+                    continue
+                item = QTableWidgetItem('{:.4f}'.format(values[i, j]))
+                item.setBackground(QBrush(QColor(*rainbow_color(values[i, j] / sim_max))))
+                # 所有选择的相似度显示在提示中
+                if len(metric_grids) > 1:
+                    item.setToolTip('\n'.join(['{}：{:.4f}'.format(METRICS[name].label, value[i, j])
+                                               for name, value in metric_grids.items()]))
+                self.ui.page2_grid_list.setItem(row_num - i - 1, j, item)
 
     def update_first_page(self):
         pass
@@ -622,9 +1027,13 @@ class MainWindow(QMainWindow):
         pass
 
     def load_project(self):
-        obj_info = shelve.open(self.PROJECT_PATH.joinpath('.cowan/obj_info').as_posix())
+        from modules.cowan.store import load_objects
+        try:
+            obj_info = load_objects(self.PROJECT_PATH.joinpath('.cowan/obj_info'), self.PROJECT_PATH)
+        except FileNotFoundError:
+            self.ui.statusbar.showMessage('没有找到保存的项目文件')
+            return
         self.atom = obj_info['atom']
-        self.cal_data = obj_info['cal_data']
         self.exp_data = obj_info['exp_data']
         self.in36 = obj_info['in36']
         self.in2 = obj_info['in2']
@@ -632,17 +1041,22 @@ class MainWindow(QMainWindow):
         self.recorder = obj_info['recorder']
         self.run = obj_info['run']
         self.widen = obj_info['widen']
-        obj_info.close()
         self.update_atom_obj_about()
         self.update_in36_obj_about()
         self.update_in2_obj_about()
-        self.update_exp_data_obj_about()
         self.update_run_obj_about()
-        self.update_cal_data_obj_about()
-        self.update_widen_obj_about()
         self.update_recorder_obj_about()
+        self.set_page1_plots_stale()
 
     def closeEvent(self, event):
+        if self.run_manager.is_running():
+            self.run_manager.cancel()
+            self.run_manager.wait()
+        if self.batch_runner is not None:
+            self.batch_runner.cancel()
+        if self.grid_scheduler is not None and self.grid_scheduler.is_running():
+            self.grid_scheduler.cancel()
+            self.grid_scheduler.wait()
         self.slot_save_project()
         sys.exit()
 
@@ -1,4 +1 @@
-from .cowan import *
-from .ui import *
-
-from .tools import *
+# 子模块按需导入：cowan 为计算部分，ui 为界面，tools 为工具函数
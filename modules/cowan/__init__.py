@@ -1,4 +1,16 @@
+import importlib
+
 from .atom import *
-from .data import *
 from .input_files import *
 from .run import *
+
+
+def __getattr__(name):
+    """
+    data 依赖 pandas 和 scipy，第一次使用 ExpData、CalData、Widen、SpectraAdd 等名称时才导入
+    """
+    if not name.startswith('__'):
+        data = importlib.import_module('.data', __name__)
+        if hasattr(data, name):
+            return getattr(data, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
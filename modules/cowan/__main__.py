@@ -0,0 +1,20 @@
+# 命令行入口：
+#   python -m modules.cowan fit <项目路径> [配置文件] ...    拟合，见 pipeline.main
+#   python -m modules.cowan batch <项目路径> <任务文件> ...  批量运行 Cowan，见 batch.main
+import sys
+
+from . import batch, pipeline
+
+COMMANDS = {'fit': pipeline.main, 'batch': batch.main}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in COMMANDS:
+        print('用法：python -m modules.cowan {} ...'.format('|'.join(COMMANDS)))
+        return 2
+    return COMMANDS[argv[0]](argv[1:])
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
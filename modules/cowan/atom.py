@@ -1,7 +1,6 @@
 # 原子信息
-from typing import List
+from typing import Dict, List
 
-import matplotlib.pyplot as plt
 import numpy as np
 
 ATOM = {1: ['H', '氢'], 2: ['He', '氦'], 3: ['Li', '锂'], 4: ['Be', '铍'], 5: ['B', '硼'],
@@ -254,6 +253,20 @@ class Atomic:
 
         return a_over_S
 
+    def get_state(self) -> Dict:
+        """
+        保存到项目文件中的状态，见 store.ProjectStore
+        """
+        return {'num': self.num, 'ion': self.ion, 'electron_num': self.electron_num,
+                'electron_arrangement': dict(self.electron_arrangement)}
+
+    @classmethod
+    def from_state(cls, state: Dict) -> 'Atomic':
+        atom = cls(state['num'], state['ion'])
+        atom.electron_num = state['electron_num']
+        atom.electron_arrangement = dict(state['electron_arrangement'])
+        return atom
+
     #
     def __str__(self):
         """打印原子信息
@@ -0,0 +1,246 @@
+# 批量计算多个离子/组态
+import argparse
+import copy
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List
+
+from .atom import ATOM, Atomic
+from .input_files import In36, In2
+from .run import Recorder, Run
+
+
+def load_jobs(path: Path) -> Dict:
+    """
+    读取任务文件（json），格式为：
+    {
+        "in36": "cal_result/Al_3/in36",     # 可选，控制卡模板，只使用其中的控制卡
+        "in2": "cal_result/Al_3/in2",       # 可选，in2模板
+        "workers": 4,                       # 可选，同时运行的任务数
+        "jobs": [
+            {
+                "atom": 13,                 # 原子序数
+                "ion": 3,                   # 离化度
+                "configurations": ["2p06", "2p05 3s01"],    # 组态
+                "excitations": [["2p", "3d"]],              # 或者给出激发的支壳层，自动生成基组态和激发组态
+                "coupling_mode": 1,         # 可选，1是L-S耦合 2是j-j耦合
+                "name": "Al_3",             # 可选，默认为 元素符号_离化度，重复时在后面加序号
+                "in36": "...", "in2": "..." # 可选，覆盖上面的模板
+            }
+        ]
+    }
+    模板的相对路径相对于任务文件所在的文件夹
+    Args:
+        path: 任务文件的路径
+
+    Returns:
+        {'in36': 路径或None, 'in2': 路径或None, 'workers': 整数或None, 'jobs': 任务列表}
+    """
+    path = Path(path)
+    data = json.loads(path.read_text(encoding='utf-8'))
+
+    def resolve(value):
+        if value is None:
+            return None
+        value = Path(value)
+        return value if value.is_absolute() else path.parent / value
+
+    jobs = []
+    for job in data['jobs']:
+        job = dict(job)
+        job['in36'] = resolve(job.get('in36'))
+        job['in2'] = resolve(job.get('in2'))
+        jobs.append(job)
+    return {
+        'in36': resolve(data.get('in36')),
+        'in2': resolve(data.get('in2')),
+        'workers': data.get('workers'),
+        'jobs': jobs,
+    }
+
+
+class BatchRunner:
+    def __init__(self, project_path: Path, jobs: List[Dict], in36: In36 | Path | None = None,
+                 in2: In2 | Path | None = None, recorder: Recorder | None = None, max_workers: int | None = None):
+        """
+        批量计算，每个任务在 cal_result/<名称> 中独立运行，最多同时运行 max_workers 个
+        Args:
+            project_path: 项目路径
+            jobs: 任务列表，格式见 load_jobs
+            in36: 默认的控制卡模板，In36 对象或者 in36 文件的路径
+            in2: 默认的 in2 模板，In2 对象或者 in2 文件的路径
+            recorder: 计算完成后记录到其中，为None时新建一个
+            max_workers: 同时运行的任务数，为None时为 CPU 核数减一
+        """
+        self.project_path = Path(project_path)
+        self.recorder = recorder or Recorder(self.project_path)
+        if max_workers is None:
+            max_workers = max((os.cpu_count() or 1) - 1, 1)
+        self.max_workers = max_workers
+
+        self.runs: List[Run] = []
+        # 每个任务的结果，见 run
+        self.summary: List[Dict] = []
+        self.__cancelled = False
+
+        names = set()
+        for job in jobs:
+            name = self.__get_name(job, names)
+            names.add(name)
+            run = Run(project_path=self.project_path,
+                      name=name,
+                      in36=self.__get_in36(job, job.get('in36') or in36),
+                      in2=self.__get_in2(job.get('in2') or in2),
+                      recorder=self.recorder,
+                      coupling_mode=job.get('coupling_mode', 1),
+                      auto_run=False)
+            self.runs.append(run)
+
+    @staticmethod
+    def __get_name(job: Dict, names: set) -> str:
+        if 'name' in job:
+            if job['name'] in names:
+                raise ValueError(f'任务名称 {job["name"]} 重复')
+            return job['name']
+        name = '{}_{}'.format(ATOM[job['atom']][0], job['ion'])
+        index = 1
+        while name in names:
+            index += 1
+            name = '{}_{}_{}'.format(ATOM[job['atom']][0], job['ion'], index)
+        return name
+
+    @staticmethod
+    def __get_in36(job: Dict, template: In36 | Path | None) -> In36:
+        """
+        根据模板的控制卡和任务中的组态生成 In36
+        """
+        if template is None:
+            raise ValueError('没有指定 in36 模板')
+        if isinstance(template, In36):
+            in36 = copy.deepcopy(template)
+        else:
+            in36 = In36()
+            in36.read_from_file(Path(template))
+        in36.configuration_card = []
+        in36.atomic_num = job['atom']
+        in36.atomic_ion = job['ion']
+        for configuration in job.get('configurations', []):
+            in36.add_configuration(configuration)
+        if job.get('excitations'):
+            atom = Atomic(job['atom'], job['ion'])
+            for low_name, high_name in job['excitations']:
+                in36.add_configuration(' '.join(atom.get_configuration()))
+                atom.arouse_electron(low_name, high_name)
+                in36.add_configuration(' '.join(atom.get_configuration()))
+                atom.revert_to_ground_state()
+        if not in36.configuration_card:
+            raise ValueError('{}_{} 没有组态'.format(ATOM[job['atom']][0], job['ion']))
+        return in36
+
+    @staticmethod
+    def __get_in2(template: In2 | Path | None) -> In2:
+        if template is None:
+            raise ValueError('没有指定 in2 模板')
+        if isinstance(template, In2):
+            return copy.deepcopy(template)
+        in2 = In2()
+        in2.read_from_file(Path(template))
+        return in2
+
+    def run(self, on_output: Callable[[str, str, str], None] | None = None,
+            on_job_finished: Callable[[Dict], None] | None = None) -> List[Dict]:
+        """
+        运行所有任务，在当前线程中等待全部结束
+        Args:
+            on_output: 程序每输出一行调用一次，参数为任务名称、程序名称和这一行的内容
+            on_job_finished: 每个任务结束时调用，参数为该任务的结果
+
+        Returns:
+            每个任务的结果，按照任务的顺序：
+            {'name': 名称, 'state': finished/failed/cancelled, 'time': 用时（秒）, 'return_codes': 各程序的返回值, 'error': 错误信息}
+        """
+        lock = threading.Lock()
+
+        def target(run: Run):
+            result = {'name': run.name, 'state': 'cancelled', 'time': 0.0, 'return_codes': {}, 'error': None}
+            if not self.__cancelled:
+                start = time.perf_counter()
+                try:
+                    run.run(None if on_output is None else lambda stage, line: on_output(run.name, stage, line))
+                    result['state'] = run.state
+                    if run.state == 'failed':
+                        result['error'] = '返回值不为0：{}'.format(run.get_failed_stages())
+                except Exception as e:
+                    result['state'] = 'failed'
+                    result['error'] = repr(e)
+                result['time'] = time.perf_counter() - start
+                result['return_codes'] = dict(run.return_codes)
+            if on_job_finished is not None:
+                with lock:
+                    on_job_finished(result)
+            return result
+
+        self.__cancelled = False
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            try:
+                self.summary = list(executor.map(target, self.runs))
+            except BaseException:
+                # 例如 KeyboardInterrupt，先终止正在运行的程序，否则要等所有任务结束
+                self.cancel()
+                raise
+        return self.summary
+
+    def cancel(self):
+        """
+        取消计算，正在运行的任务被终止，尚未开始的任务不再运行
+        """
+        self.__cancelled = True
+        for run in self.runs:
+            run.cancel()
+
+    def get_summary_text(self) -> str:
+        """
+        计算结果的汇总表
+        """
+        lines = ['{:<16}{:<12}{:>10}  {}'.format('名称', '状态', '用时(s)', '错误')]
+        for result in self.summary:
+            lines.append('{:<16}{:<12}{:>10.1f}  {}'.format(
+                result['name'], result['state'], result['time'], result['error'] or ''))
+        total = sum(result['time'] for result in self.summary)
+        failed = sum(result['state'] != 'finished' for result in self.summary)
+        lines.append(f'共 {len(self.summary)} 个任务，{failed} 个未完成，累计用时 {total:.1f} s')
+        return '\n'.join(lines)
+
+
+def main(argv: List[str] | None = None):
+    parser = argparse.ArgumentParser(description='批量运行 Cowan 程序')
+    parser.add_argument('project', help='项目路径')
+    parser.add_argument('jobs', help='任务文件（json），格式见 load_jobs')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='同时运行的任务数')
+    parser.add_argument('-s', '--summary', default=None, help='把结果保存为json文件')
+    parser.add_argument('-v', '--verbose', action='store_true', help='显示程序的输出')
+    args = parser.parse_args(argv)
+
+    config = load_jobs(Path(args.jobs))
+    runner = BatchRunner(Path(args.project), config['jobs'], config['in36'], config['in2'],
+                         max_workers=args.workers or config['workers'])
+
+    def on_output(name, stage, line):
+        print(f'[{name} {stage}] {line}', flush=True)
+
+    def on_job_finished(result):
+        print('{} {} {:.1f} s'.format(result['name'], result['state'], result['time']), flush=True)
+
+    runner.run(on_output if args.verbose else None, on_job_finished)
+    print(runner.get_summary_text())
+    if args.summary:
+        Path(args.summary).write_text(json.dumps(runner.summary, ensure_ascii=False, indent=2), encoding='utf-8')
+    return 0 if all(result['state'] == 'finished' for result in runner.summary) else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,27 +1,104 @@
-import asyncio
+import hashlib
+import json
 import os
-from concurrent.futures import ProcessPoolExecutor
+import threading
+from collections import OrderedDict
 from pathlib import Path
-from typing import List, Dict
+from typing import Callable, List, Dict
 
 import numpy as np
 import pandas as pd
-import plotly.graph_objects as go
-from fastdtw import fastdtw
-from plotly.offline import plot
+from scipy import sparse
 from scipy.interpolate import interp1d
-from scipy.signal import find_peaks
+from scipy.optimize import minimize
+from scipy.signal import fftconvolve, find_peaks
 
 from .atom import Atomic
+from .figure import line_figure, write_html
+from .grid import AdaptiveScheduler, GridScheduler, SearchCancelled
+from .similarity import METRICS, SpectrumComparer, dtw_distance, nearest_point_distance
+
+
+def get_plot_key(*values) -> str:
+    """
+    图片内容的标识，数组按字节计算，其他值转换为 Python 的类型后按 repr 计算
+    """
+    sha = hashlib.sha1()
+    for value in values:
+        if isinstance(value, np.ndarray):
+            sha.update(np.ascontiguousarray(value).tobytes())
+        else:
+            sha.update(repr(np.asarray(value).tolist()).encode('utf-8'))
+    return sha.hexdigest()
+
+
+def plot_cached(path: str, key: str, draw: Callable[[], None]) -> bool:
+    """
+    图片已经存在并且旁边的 <path>.key 与 key 相同时不重新绘图，否则调用 draw 绘图并记录 key
+    同一个文件可能被不同的对象绘制（例如历史记录中的实验数据），因此 key 保存在文件旁边而不是对象中
+    Args:
+        path: 图片的路径
+        key: 图片内容的标识，见 get_plot_key
+        draw: 绘图的函数
+
+    Returns:
+        是否重新绘图
+    """
+    key_path = Path(path + '.key')
+    try:
+        if Path(path).exists() and key_path.read_text(encoding='utf-8') == key:
+            return False
+    except OSError:
+        pass
+    draw()
+    try:
+        key_path.write_text(key, encoding='utf-8')
+    except OSError:
+        pass
+    return True
+
+
+# get_cached_figure 缓存的图最多占用的字节数（只计算数组）
+FIGURE_CACHE_SIZE = 256 * 2 ** 20
+# {图的标识: (图, 字节数)}，按使用的先后排列
+_FIGURES: OrderedDict = OrderedDict()
+
+
+def get_cached_figure(key: str, build: Callable[[], Dict]) -> Dict:
+    """
+    在内存中按 key 缓存图，切换历史记录时内容相同的图不再重新生成（例如不再读取 spectra.dat）
+    超过 FIGURE_CACHE_SIZE 时删除最早使用的图，返回的图不能修改
+    Args:
+        key: 图内容的标识，见 get_plot_key
+        build: 生成图的函数
+
+    Returns:
+        plotly 格式的字典
+    """
+    if key in _FIGURES:
+        _FIGURES.move_to_end(key)
+        return _FIGURES[key][0]
+    figure = build()
+    size = 0
+    for trace in figure['data']:
+        for name in ('x', 'y', 'z'):
+            if trace.get(name) is not None:
+                size += np.asarray(trace[name]).nbytes
+    if size <= FIGURE_CACHE_SIZE:
+        _FIGURES[key] = (figure, size)
+        while sum(value[1] for value in _FIGURES.values()) > FIGURE_CACHE_SIZE:
+            _FIGURES.popitem(last=False)
+    return figure
 
 
 class ExpData:
-    def __init__(self, project_path: Path, filepath: Path):
+    def __init__(self, project_path: Path, filepath: Path, plot: bool = True):
         """
         实验数据
         Args:
             project_path: 项目路径
             filepath: 实验谱的文件路径
+            plot: 是否绘图，不绘图时不导入 plotly
         """
         self.plot_path = (project_path / 'figure/exp.html').as_posix()
         self.filepath: Path = filepath
@@ -30,18 +107,57 @@ class ExpData:
         self.x_range: List[float] | None = None
 
         self.__read_file()
-        self.__plot_html()
+        if plot:
+            self.plot_html()
+
+    def get_state(self) -> Dict:
+        """
+        保存到项目文件中的状态，见 store.ProjectStore
+        实验谱文件在重新加载实验数据时会被覆盖，历史记录要保留计算时的数据，因此数据以数组的形式保存
+        """
+        return {'filepath': Path(self.filepath).as_posix(), 'x_range': [float(v) for v in self.x_range],
+                'data': {key: self.data[key].values for key in self.data.columns}}
 
-    def set_range(self, x_range: List[float]):
+    @classmethod
+    def from_state(cls, state: Dict, project_path: Path) -> 'ExpData':
+        """
+        由 get_state 的结果恢复，不重新绘图
+        以前的项目文件中没有数据时从实验谱文件重新读取
+        """
+        exp_data = cls.__new__(cls)
+        exp_data.plot_path = (project_path / 'figure/exp.html').as_posix()
+        exp_data.filepath = Path(state['filepath'])
+        if state.get('data') is not None:
+            exp_data.data = pd.DataFrame(state['data'])
+            exp_data.x_range = state['x_range']
+            return exp_data
+        exp_data.__read_file()
+        if state['x_range'] != exp_data.x_range:
+            exp_data.x_range = state['x_range']
+            exp_data.data = exp_data.data[(exp_data.data['wavelength'] < exp_data.x_range[1]) &
+                                          (exp_data.data['wavelength'] > exp_data.x_range[0])]
+        return exp_data
+
+    def set_range(self, x_range: List[float], plot: bool = True):
         """
         设置x轴范围
         Args:
             x_range: x轴范围，单位是nm
+            plot: 是否重新绘图
         """
         self.x_range = x_range
         self.data = self.data[(self.data['wavelength'] < self.x_range[1]) &
                               (self.data['wavelength'] > self.x_range[0])]
-        self.__plot_html()
+        if plot:
+            self.plot_html()
+
+    def plot_html(self):
+        """
+        绘图，数据和范围都没有变化时使用以前的图片
+        历史记录中的数据可能与当前的实验谱文件不同，因此按数据本身计算标识
+        """
+        key = get_plot_key('exp', self.data['wavelength'].values, self.data['intensity'].values, self.x_range)
+        plot_cached(self.plot_path, key, self.__plot_html)
 
     def __read_file(self):
         """
@@ -60,67 +176,240 @@ class ExpData:
         self.data = temp_data
         self.x_range = [self.data['wavelength'].min(), self.data['wavelength'].max()]
 
-    def __plot_html(self):
-        trace1 = go.Scatter(x=self.data['wavelength'], y=self.data['intensity'], mode='lines')
-        data = [trace1]
-        layout = go.Layout(margin=go.layout.Margin(autoexpand=False, b=15, l=30, r=0, t=0),
-                           xaxis=go.layout.XAxis(range=self.x_range), )
-        # yaxis=go.layout.YAxis(range=[self.min_strength, self.max_strength]))
-        fig = go.Figure(data=data, layout=layout)
+    def get_figure(self) -> Dict:
+        """
+        实验谱的图，格式见 figure.line_figure
+        """
+        return line_figure([(self.data['wavelength'], self.data['intensity'])], self.x_range)
 
-        plot(fig, filename=self.plot_path, auto_open=False)
+    def __plot_html(self):
+        # 图片保存在 figure 文件夹中
+        write_html(self.get_figure(), self.plot_path, Path(self.plot_path).parent)
+
+
+SPECTRA_COLUMNS = ['energy_l', 'energy_h', 'wavelength_ev', 'intensity', 'index_l', 'index_h', 'J_l', 'J_h']
+# 流式读取时使用的紧凑数据类型
+SPECTRA_COMPACT_DTYPE = {'energy_l': np.float32, 'energy_h': np.float32, 'wavelength_ev': np.float32,
+                         'intensity': np.float32, 'index_l': np.int32, 'index_h': np.int32,
+                         'J_l': np.float32, 'J_h': np.float32}
+
+
+def get_lowest_levels(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    每个跃迁正例 (index_l, index_h) 中下态能量最低的能级，能量相同时取J值最小的
+    Args:
+        data: spectra.dat 中的数据，也可以是之前的结果拼接在一起
+
+    Returns:
+        列标题为 index_l, index_h, energy_l, J_l
+    """
+    data = data[['index_l', 'index_h', 'energy_l', 'J_l']].sort_values(['energy_l', 'J_l'], kind='stable')
+    return data.drop_duplicates(['index_l', 'index_h']).reset_index(drop=True)
+
+
+def read_spectra_stream(filepath, wavelength_range: List[float], min_intensity: float | None = None,
+                        chunk_size: int = 2 ** 20):
+    """
+    分块读取 spectra.dat，边读边筛选，内存占用只与保留下来的跃迁数有关，与文件大小无关
+    能量、强度和J值使用 float32，序号使用 int32
+    Args:
+        filepath: spectra.dat 的路径
+        wavelength_range: 保留的波长范围，单位是nm，与 Widen 相同不包含端点
+        min_intensity: 强度（绝对值）小于该值的跃迁不保留，为None时不筛选
+        chunk_size: 每块的行数
+
+    Returns:
+        data: 保留下来的跃迁
+        lowest_levels: 筛选前每个跃迁正例中能量最低的能级，见 get_lowest_levels
+    """
+    min_wavelength_ev = 1239.85 / wavelength_range[1]
+    max_wavelength_ev = 1239.85 / wavelength_range[0]
+    kept = []
+    lowest = []
+    with pd.read_csv(filepath, sep='\s+', names=SPECTRA_COLUMNS, dtype=SPECTRA_COMPACT_DTYPE,
+                     chunksize=chunk_size) as reader:
+        for chunk in reader:
+            lowest.append(get_lowest_levels(chunk))
+            mask = (chunk['wavelength_ev'] > min_wavelength_ev) & (chunk['wavelength_ev'] < max_wavelength_ev)
+            if min_intensity is not None:
+                mask &= chunk['intensity'].abs() >= min_intensity
+            kept.append(chunk[mask])
+    if not kept:
+        return pd.DataFrame(columns=SPECTRA_COLUMNS).astype(SPECTRA_COMPACT_DTYPE), None
+    data = pd.concat(kept, ignore_index=True)
+    return data, get_lowest_levels(pd.concat(lowest, ignore_index=True))
 
 
 class CalData:
-    def __init__(self, project_path: Path, exp_data: ExpData, name):
+    # spectra.dat 超过该大小（字节）时自动按实验数据的范围流式读取
+    stream_size = 512 * 2 ** 20
+
+    def __init__(self, project_path: Path, exp_data: ExpData, name, stream: bool | None = None,
+                 min_intensity: float | None = None, plot: bool = True):
         """
 
         Args:
             project_path: 项目路径
             exp_data: 实验数据类
             name: 计算的名称
+            stream: 是否流式读取，只保留实验数据范围内的跃迁，见 read_spectra_stream，
+                    为None时文件大于 stream_size 才流式读取
+            min_intensity: 流式读取时强度的下限，为None时不筛选
+            plot: 是否绘图，不绘图时在第一次使用 data 时才读取数据
         """
         self.name = name
         self.exp_data = exp_data
         self.plot_path = (project_path / f'figure/line/{self.name}.html').as_posix()
         self.filepath = (project_path / f'cal_result/{self.name}/spectra.dat').as_posix()
-        self.data: pd.DataFrame | None = None
+        self.stream = stream
+        self.min_intensity = min_intensity
+        # 流式读取时保留的波长范围，为None时 data 是完整的数据
+        self.filter_range: List[float] | None = None
+        # 流式读取时筛选前每个跃迁正例中能量最低的能级，Widen 用它计算布居
+        self.lowest_levels: pd.DataFrame | None = None
+        self.__data: pd.DataFrame | None = None
+
+        if plot:
+            self.plot_html()
+
+    def __setstate__(self, state):
+        # 以前的版本直接保存了 data
+        if 'data' in state:
+            state['_CalData__data'] = state.pop('data')
+        state.setdefault('stream', False)
+        state.setdefault('min_intensity', None)
+        state.setdefault('filter_range', None)
+        state.setdefault('lowest_levels', None)
+        self.__dict__.update(state)
+
+    def get_state(self) -> Dict:
+        """
+        保存到项目文件中的状态，见 store.ProjectStore，数据从 spectra.dat 重新读取
+        """
+        return {'name': self.name, 'stream': self.stream, 'min_intensity': self.min_intensity}
 
-        self.__read_file()
-        self.__plot_html()
+    @classmethod
+    def from_state(cls, state: Dict, project_path: Path, exp_data: ExpData) -> 'CalData':
+        """
+        由 get_state 的结果恢复，不读取数据，也不重新绘图
+        """
+        cal_data = cls.__new__(cls)
+        cal_data.name = state['name']
+        cal_data.exp_data = exp_data
+        cal_data.plot_path = (project_path / f'figure/line/{cal_data.name}.html').as_posix()
+        cal_data.filepath = (project_path / f'cal_result/{cal_data.name}/spectra.dat').as_posix()
+        cal_data.stream = state['stream']
+        cal_data.min_intensity = state['min_intensity']
+        cal_data.filter_range = None
+        cal_data.lowest_levels = None
+        cal_data.__data = None
+        return cal_data
+
+    @property
+    def data(self) -> pd.DataFrame:
+        """
+        spectra.dat 中的数据，第一次使用时才读取
+        流式读取的数据不包含当前实验数据范围时重新读取
+        """
+        if self.__data is not None and self.filter_range is not None:
+            x_range = self.exp_data.x_range
+            if x_range[0] < self.filter_range[0] or x_range[1] > self.filter_range[1]:
+                self.__data = None
+        if self.__data is None:
+            if self.__use_stream():
+                self.filter_range = list(self.exp_data.x_range)
+                self.__data, self.lowest_levels = read_spectra_stream(
+                    self.filepath, self.filter_range, self.min_intensity)
+            else:
+                self.filter_range = None
+                self.lowest_levels = None
+                self.__data = self.__read_file()
+        return self.__data
+
+    def __use_stream(self) -> bool:
+        if self.stream is None:
+            return os.path.getsize(self.filepath) > self.stream_size
+        return self.stream
+
+    @data.setter
+    def data(self, value: pd.DataFrame):
+        self.__data = value
+
+    def __read_file(self) -> pd.DataFrame:
+        """
+        读取 spectra.dat
+        第一次读取后在旁边保存二进制文件 spectra.npy，并在 spectra.npy.json 中记录 spectra.dat 的大小和修改时间，
+        之后 spectra.dat 没有变化时以内存映射的方式读取 spectra.npy，不再解析文本
+        """
+        path = Path(self.filepath)
+        npy_path = path.with_suffix('.npy')
+        meta_path = path.with_suffix('.npy.json')
+        stat = path.stat()
+        meta = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+        try:
+            if json.loads(meta_path.read_text(encoding='utf-8')) == meta:
+                # 每一列都是内存映射的视图，不复制数据，因此得到的数据是只读的
+                records = np.load(npy_path, mmap_mode='r')
+                return pd.DataFrame({name: records[name] for name in records.dtype.names}, copy=False)
+        except (OSError, ValueError):
+            pass
+
+        data = pd.read_csv(self.filepath, sep='\s+', names=SPECTRA_COLUMNS)
+        # 先写临时文件再替换，避免读到不完整的文件
+        try:
+            temp_path = path.with_suffix('.npy.tmp')
+            with open(temp_path, 'wb') as f:
+                np.save(f, data.to_records(index=False))
+            os.replace(temp_path, npy_path)
+            meta_path.write_text(json.dumps(meta), encoding='utf-8')
+        except OSError:
+            pass
+        return data
 
-    def __read_file(self):
-        self.data = pd.read_csv(self.filepath, sep='\s+',
-                                names=['energy_l', 'energy_h', 'wavelength_ev', 'intensity',
-                                       'index_l', 'index_h', 'J_l', 'J_h'])
+    def plot_html(self):
+        """
+        绘图，spectra.dat 和实验数据的范围都没有变化时使用以前的图片，不读取数据
+        """
+        plot_cached(self.plot_path, self.__get_plot_key(), self.__plot_html)
+
+    def get_figure(self) -> Dict:
+        """
+        线状谱的图，格式见 figure.line_figure
+        spectra.dat 和实验数据的范围都没有变化时使用内存中缓存的图，不读取数据，见 get_cached_figure
+        """
+        def build():
+            temp_data = self.__get_line_data(self.data[['wavelength_ev', 'intensity']])
+            return line_figure([(temp_data['wavelength'], temp_data['intensity'])], self.exp_data.x_range)
+
+        return get_cached_figure(self.__get_plot_key(), build)
+
+    def __get_plot_key(self) -> str:
+        stat = os.stat(self.filepath)
+        return get_plot_key('line', self.filepath, stat.st_mtime_ns, stat.st_size, self.exp_data.x_range,
+                            self.min_intensity)
 
     def __plot_html(self):
-        temp_data = self.__get_line_data(self.data[['wavelength_ev', 'intensity']])
-        trace1 = go.Scatter(x=temp_data['wavelength'], y=temp_data['intensity'], mode='lines')
-        data = [trace1]
-        layout = go.Layout(margin=go.layout.Margin(autoexpand=False, b=15, l=30, r=0, t=0),
-                           xaxis=go.layout.XAxis(range=self.exp_data.x_range),
-                           )
-        # yaxis=go.layout.YAxis(range=[self.min_strength, self.max_strength]))
-        fig = go.Figure(data=data, layout=layout)
-        plot(fig, filename=self.plot_path, auto_open=False)
+        # 图片保存在 figure/line 文件夹中
+        write_html(self.get_figure(), self.plot_path, Path(self.plot_path).parents[1])
 
     def __get_line_data(self, origin_data):
-        temp_data = origin_data.copy()
-        temp_data['wavelength'] = 1239.85 / temp_data['wavelength_ev']
-        temp_data = temp_data[(temp_data['wavelength'] < self.exp_data.x_range[1]) &
-                              (temp_data['wavelength'] > self.exp_data.x_range[0])]
-        lambda_ = []
-        strength = []
-        if temp_data['wavelength'].min() > self.exp_data.x_range[0]:
-            lambda_ += [self.exp_data.x_range[0]]
-            strength += [0]
-        for x, y in zip(temp_data['wavelength'], temp_data['intensity']):
-            lambda_ += [x, x, x]
-            strength += [0, y, 0]
-        if temp_data['wavelength'].max() < self.exp_data.x_range[1]:
-            lambda_ += [self.exp_data.x_range[1]]
-            strength += [0]
+        """
+        线状谱的折线：每条线为 (x, 0), (x, y), (x, 0) 三个点，两端补上实验数据范围的端点
+        """
+        x_min, x_max = self.exp_data.x_range
+        wavelength = 1239.85 / origin_data['wavelength_ev'].values
+        mask = (wavelength < x_max) & (wavelength > x_min)
+        wavelength = wavelength[mask]
+        lambda_ = np.repeat(wavelength, 3)
+        strength = np.zeros(lambda_.size)
+        strength[1::3] = origin_data['intensity'].values[mask]
+        if wavelength.size:
+            if wavelength.min() > x_min:
+                lambda_ = np.r_[x_min, lambda_]
+                strength = np.r_[0, strength]
+            if wavelength.max() < x_max:
+                lambda_ = np.r_[lambda_, x_max]
+                strength = np.r_[strength, 0]
         temp = pd.DataFrame({
             'wavelength': lambda_,
             'intensity': strength
@@ -129,12 +418,34 @@ class CalData:
 
 
 class Widen:
+    # get_temperature_basis 缓存的温度无关部分（float64）最多占用的字节数，超过时每次直接计算
+    basis_size = 32 * 2 ** 20
+
     def __init__(self,
                  project_path: Path,
                  exp_data: ExpData,
                  cal_data: CalData,
                  delta_lambda=0.0,
-                 n=None):
+                 n=None,
+                 method='batch',
+                 chunk_size=2 ** 22,
+                 cutoff=10.0):
+        """
+
+        Args:
+            project_path: 项目路径
+            exp_data: 实验数据类
+            cal_data: 计算数据类
+            delta_lambda: 波长偏移量，单位是nm
+            n: 展宽网格的点数，为None时使用实验数据的波长点
+            method: 展宽方式
+                'point': 逐个网格点计算（原始实现）
+                'batch': 整个网格一次性矩阵计算，结果与 'point' 相同
+                'window': 只累加每个网格点附近 cutoff 个半高宽以内的跃迁，洛伦兹线型的远端用解析式补偿
+                'fft': 将跃迁强度分配到均匀网格上，再与线型做FFT卷积，计算量与跃迁数无关，需要设置 n
+            chunk_size: 分块计算时每块的最大元素个数，用于限制内存占用
+            cutoff: 'window' 方式下的截断距离，单位是半高宽
+        """
         self.exp_data = exp_data
         self.cal_data = cal_data
         self.name = cal_data.name
@@ -150,11 +461,84 @@ class Widen:
         self.delta_lambda: float = delta_lambda
 
         self.n = n
+        self.method = method
+        self.chunk_size = chunk_size
+        self.cutoff = cutoff
+        # 'window' 方式相对于精确求和的最大偏差（相对于各列的最大值），键为 gauss, lorentz
+        self.window_deviation: Dict[str, float] | None = None
 
-        self.init_data = self.cal_data.data.copy()
+        self.__init_data: pd.DataFrame | None = None
 
         self.widen_data: pd.DataFrame | None = None
         self.grouped_widen_data: Dict[str: pd.DataFrame] | None = None
+        # 与温度无关的展宽结果，见 get_temperature_basis
+        self.__basis: Dict | None = None
+
+    def __getstate__(self):
+        # 缓存可以重新计算，不需要保存
+        state = self.__dict__.copy()
+        state['_Widen__basis'] = None
+        return state
+
+    def __setstate__(self, state):
+        # 以前的版本直接保存了 init_data，也没有展宽方式等参数
+        if 'init_data' in state:
+            state['_Widen__init_data'] = state.pop('init_data')
+        state.setdefault('method', 'batch')
+        state.setdefault('chunk_size', 2 ** 22)
+        state.setdefault('cutoff', 10.0)
+        state.setdefault('window_deviation', None)
+        state.setdefault('_Widen__basis', None)
+        self.__dict__.update(state)
+
+    @property
+    def init_data(self) -> pd.DataFrame:
+        """
+        计算数据，与 cal_data.data 相同，不复制（可能是只读的内存映射），不能在原地修改
+        """
+        if self.__init_data is None:
+            self.__init_data = self.cal_data.data
+        return self.__init_data
+
+    @init_data.setter
+    def init_data(self, value: pd.DataFrame):
+        self.__init_data = value
+
+    def get_state(self) -> Dict:
+        """
+        保存到项目文件中的状态，见 store.ProjectStore
+        展宽结果以数组的形式保存，计算数据不保存
+        """
+        return {
+            'delta_lambda': self.delta_lambda,
+            'n': self.n,
+            'method': self.method,
+            'chunk_size': self.chunk_size,
+            'cutoff': self.cutoff,
+            'plot_path_by_group_gauss': self.plot_path_by_group_gauss,
+            'plot_path_by_group_cross_NP': self.plot_path_by_group_cross_NP,
+            'plot_path_by_group_cross_P': self.plot_path_by_group_cross_P,
+            'widen_data': None if self.widen_data is None else
+            {key: self.widen_data[key].values for key in self.widen_data.columns},
+        }
+
+    @classmethod
+    def from_state(cls, state: Dict, project_path: Path, exp_data: ExpData, cal_data: CalData) -> 'Widen':
+        """
+        由 get_state 的结果恢复，不读取计算数据，也不重新绘图
+        """
+        widen = cls(project_path, exp_data, cal_data,
+                    delta_lambda=state['delta_lambda'],
+                    n=state['n'],
+                    method=state['method'],
+                    chunk_size=state['chunk_size'],
+                    cutoff=state['cutoff'])
+        widen.plot_path_by_group_gauss = state['plot_path_by_group_gauss']
+        widen.plot_path_by_group_cross_NP = state['plot_path_by_group_cross_NP']
+        widen.plot_path_by_group_cross_P = state['plot_path_by_group_cross_P']
+        if state['widen_data'] is not None:
+            widen.widen_data = pd.DataFrame(state['widen_data'])
+        return widen
 
     def widen(self,
               temperature: float,
@@ -169,21 +553,196 @@ class Widen:
                 pandas的DataFrame格式数据
                 列标题依次为：energy_l, energy_h, wavelength_ev, intensity, index_l, index_h, J_l, J_h
                 分别代表：下态能量，上态能量，波长，强度，下态序号，上态序号，下态J值，上态J值
+                为None时展宽全部数据，此时 'batch' 方式使用缓存的温度无关部分，只需计算一次矩阵向量乘法；
+                'window' 和 'fft' 方式的计算量与能级数无关，直接把布居乘到权重上计算
             temperature (float): 等离子体温度
 
         Returns:
             返回一个DataFrame，包含了展宽后的数据
             列标题为：wavelength, gaussian, cross-NP, cross-P
         """
+        if data is None and self.method == 'batch':
+            basis = self.get_temperature_basis()
+            if basis is not None:
+                result = pd.DataFrame()
+                result['wavelength'] = basis['wavelength']
+                result['gauss'] = basis['gauss']
+                result['cross_NP'] = basis['cross_NP']
+                result['cross_P'] = basis['basis'] @ np.exp(-basis['energy'] * 0.124 / temperature)
+                if save_in_memory:
+                    self.widen_data = result
+                return result
+        whole = data is None
         if data is None:
-            data = self.init_data.copy()
+            data = self.init_data
         fwhmgauss = self.__fwhmgauss
+
+        line = self.__get_line_info(data, whole)
+        if line is None:
+            return -1
+        wave = line['wave']
+        new_wavelength = line['wavelength']
+        new_intensity = line['intensity']
+        new_J = line['J']
+        # 计算布居
+        population = (2 * new_J + 1) * np.exp(-line['energy'] * 0.124 / temperature) / (2 * line['min_J'] + 1)
+        result = pd.DataFrame()
+        result['wavelength'] = 1239.85 / wave
+
+        if self.method == 'point':
+            res = [self.__complex_cal(val, new_intensity, fwhmgauss(val), new_wavelength, population, new_J)
+                   for val in wave]
+            res = list(zip(*res))
+        else:
+            lorentz_weight = np.column_stack([new_intensity / (2 * new_J + 1),
+                                              new_intensity * population / (2 * new_J + 1)])
+            gauss, lorentz = self.__profile(wave, line['fwhm'], new_wavelength, new_intensity, lorentz_weight)
+            # 只对保存的展宽结果（而不是按组展宽的结果）估计偏差
+            if self.method == 'window' and save_in_memory:
+                self.window_deviation = self.__window_deviation(wave, line['fwhm'], new_wavelength, new_intensity,
+                                                                sparse.csr_matrix(lorentz_weight), gauss, lorentz)
+            res = [gauss, lorentz[:, 0], lorentz[:, 1]]
+        result['gauss'] = res[0]
+        result['cross_NP'] = res[1]
+        result['cross_P'] = res[2]
+        if save_in_memory:
+            self.widen_data = result
+        return result
+
+    def get_temperature_basis(self):
+        """
+        获取全部数据展宽结果中与温度无关的部分，第一次调用时计算，之后直接使用缓存，只用于 'batch' 方式
+        布居中只有 exp(-ΔE * 0.124 / T) 与温度有关，将跃迁按上态能量 ΔE 分组，
+        每组的洛伦兹展宽结果作为一列，则
+            cross_P = basis @ exp(-energy * 0.124 / temperature)
+        Returns:
+            返回一个字典，键为 wavelength, gauss, cross_NP, basis, energy
+            basis 的形状为 (网格点数, 能级数)，energy 为各能级相对于最低能级的能量
+            如果没有跃迁正例，或者 basis 占用的内存超过 basis_size，返回None
+        """
+        key = self.__get_basis_key()
+        if self.__basis is not None and self.__basis['key'] == key:
+            return self.__basis
+        self.__basis = None
+
+        line = self.__get_line_info(self.init_data, True)
+        if line is None:
+            return None
+        level, inverse = np.unique(line['energy'], return_inverse=True)
+        if line['wave'].shape[0] * level.shape[0] * 8 > self.basis_size:
+            return None
+
+        wave = line['wave']
+        new_intensity = line['intensity']
+        # 洛伦兹线型的权重矩阵：第0列为 cross_NP，之后每个能级一列
+        row = np.arange(new_intensity.shape[0])
+        lorentz_weight = sparse.csr_matrix(
+            (np.concatenate([new_intensity / (2 * line['J'] + 1), new_intensity / (2 * line['min_J'] + 1)]),
+             (np.concatenate([row, row]), np.concatenate([np.zeros_like(row), inverse + 1]))),
+            shape=(row.shape[0], level.shape[0] + 1))
+        gauss, lorentz = self.__profile(wave, line['fwhm'], line['wavelength'], new_intensity, lorentz_weight)
+
+        self.__basis = {
+            'key': key,
+            'wavelength': 1239.85 / wave,
+            'gauss': gauss,
+            'cross_NP': lorentz[:, 0],
+            'basis': lorentz[:, 1:],
+            'energy': level,
+        }
+        return self.__basis
+
+    def get_line_arrays(self) -> Dict[str, np.ndarray] | None:
+        """
+        展宽全部数据所需要的数组，与 get_settings 一起用于在子进程中展宽，见 widen_lines
+        Returns:
+            返回一个字典，键与 __get_line_info 相同，min_J 为0维数组；如果没有跃迁正例，返回None
+        """
+        line = self.__get_line_info(self.init_data, True)
+        if line is not None:
+            line['min_J'] = np.array(float(line['min_J']))
+        return line
+
+    def get_settings(self) -> Dict:
+        """
+        展宽方式的参数，见 from_settings
+        """
+        return {'n': self.n, 'method': self.method, 'chunk_size': self.chunk_size, 'cutoff': self.cutoff}
+
+    @classmethod
+    def from_settings(cls, settings: Dict) -> 'Widen':
+        """
+        只有展宽方式参数的对象，没有实验数据和计算数据，只能调用 widen_lines
+        """
+        widen = cls.__new__(cls)
+        widen.__dict__.update(settings)
+        return widen
+
+    def widen_lines(self, line: Dict[str, np.ndarray], temperatures: np.ndarray) -> np.ndarray:
+        """
+        计算多个温度下的 cross_P，每个温度的布居作为洛伦兹线型权重的一列，一次展宽
+        'point' 方式的结果与 'batch' 方式相同，按 'batch' 方式计算
+        Args:
+            line: get_line_arrays 的结果
+            temperatures: 温度列表
+
+        Returns:
+            形状为 (温度个数, 网格点数)
+        """
+        factor = np.exp(-np.outer(line['energy'], 0.124 / np.asarray(temperatures, dtype=float)))
+        lorentz_weight = sparse.csr_matrix(line['intensity'][:, None] * factor / (2 * line['min_J'] + 1))
+        if self.method == 'point':
+            _, lorentz = self.__batch_cal(line['wave'], line['fwhm'], line['wavelength'], None, lorentz_weight)
+        else:
+            _, lorentz = self.__profile(line['wave'], line['fwhm'], line['wavelength'], None, lorentz_weight)
+        return lorentz.T
+
+    def __get_basis_key(self):
+        """
+        影响 get_temperature_basis 结果的参数，任何一个改变都需要重新计算
+        """
+        if self.n is None:
+            grid = tuple(self.exp_data.data['wavelength'].values[[0, -1]]) + (self.exp_data.data.shape[0],)
+        else:
+            grid = (self.n,)
+        return (self.method, self.delta_lambda, self.cutoff, self.chunk_size,
+                tuple(self.exp_data.x_range), grid, self.init_data.shape[0])
+
+    def __get_line_info(self, data: pd.DataFrame, whole: bool = False):
+        """
+        获取展宽所需要的数据
+        Args:
+            data: 与 widen 的 data 参数相同
+            whole: data 是否为全部数据，流式读取时用于确定最低能级
+
+        Returns:
+            返回一个字典，键为
+                wave: 网格点，单位是ev
+                fwhm: 每个网格点对应的半高宽
+                wavelength: 平移后的跃迁能量，单位是ev
+                intensity: 跃迁强度
+                energy: 上态能量与最低能量之差
+                J: 上态J值
+                min_J: 最低能量对应的J值
+            如果实验数据范围内没有跃迁正例，返回None
+        """
         lambda_range = self.exp_data.x_range
 
-        new_data = data.copy()
+        new_data = data
         # 找到下态最小能量和最小能量对应的J值
-        min_energy = new_data['energy_l'].min()
-        min_J = new_data[new_data['energy_l'] == min_energy]['J_l'].min()
+        lowest_levels = self.cal_data.lowest_levels
+        if lowest_levels is not None and not whole:
+            # 流式读取时数据已经按波长筛选过，最低能级要从筛选前的结果中找：
+            # 展宽全部数据时使用所有组态的最低能级（包括谱线都在波长范围外的组态），
+            # 只展宽部分跃迁正例时（如 widen_by_group）使用这些跃迁正例的最低能级
+            groups = new_data[['index_l', 'index_h']].drop_duplicates()
+            lowest_levels = lowest_levels.merge(groups, on=['index_l', 'index_h'])
+        if lowest_levels is not None and not lowest_levels.empty:
+            min_energy = lowest_levels['energy_l'].min()
+            min_J = lowest_levels[lowest_levels['energy_l'] == min_energy]['J_l'].min()
+        else:
+            min_energy = new_data['energy_l'].min()
+            min_J = new_data[new_data['energy_l'] == min_energy]['J_l'].min()
         # 筛选波长范围在实验数据范围内的跃迁正例个数
         min_wavelength_nm = lambda_range[0]
         max_wavelength_nm = lambda_range[1]
@@ -192,7 +751,7 @@ class Widen:
         new_data = new_data[(new_data['wavelength_ev'] > min_wavelength_ev) &
                             (new_data['wavelength_ev'] < max_wavelength_ev)]
         if new_data.empty:
-            return -1
+            return None
         new_data = new_data.reindex()
         # 获取展宽所需要的数据
         new_wavelength = abs(1239.85 / (1239.85 / new_data['wavelength_ev'] - self.delta_lambda))  # 单位时ev
@@ -209,24 +768,19 @@ class Widen:
         temp_2 = new_data['J_h'][not_flag]
         new_J = temp_1.combine_first(temp_2)
         new_J = new_J.values
-        # 计算布居
-        population = (2 * new_J + 1) * np.exp(-abs(new_energy - min_energy) * 0.124 / temperature) / (2 * min_J + 1)
         if self.n is None:
             wave = 1239.85 / np.array(self.exp_data.data['wavelength'].values)
         else:
             wave = np.linspace(min_wavelength_ev, max_wavelength_ev, self.n)
-        result = pd.DataFrame()
-        result['wavelength'] = 1239.85 / wave
-
-        res = [self.__complex_cal(val, new_intensity, fwhmgauss(val), new_wavelength, population, new_J)
-               for val in wave]
-        res = list(zip(*res))
-        result['gauss'] = res[0]
-        result['cross_NP'] = res[1]
-        result['cross_P'] = res[2]
-        if save_in_memory:
-            self.widen_data = result
-        return result
+        return {
+            'wave': wave,
+            'fwhm': np.array([self.__fwhmgauss(val) for val in wave]),
+            'wavelength': new_wavelength,
+            'intensity': new_intensity,
+            'energy': abs(new_energy - min_energy),
+            'J': new_J,
+            'min_J': min_J,
+        }
 
     def widen_by_group(self, temperature):
         """
@@ -252,11 +806,6 @@ class Widen:
         self.grouped_widen_data = temp_data
         # self.plot_widen_by_group()
 
-    def plot_widen(self):
-        self.__plot_html(self.widen_data, self.plot_path_gauss, 'wavelength', 'gauss')
-        self.__plot_html(self.widen_data, self.plot_path_cross_NP, 'wavelength', 'cross_NP')
-        self.__plot_html(self.widen_data, self.plot_path_cross_P, 'wavelength', 'cross_P')
-
     def plot_widen_by_group(self):
         self.plot_path_by_group_gauss = {}
         self.plot_path_by_group_cross_NP = {}
@@ -268,19 +817,19 @@ class Widen:
             self.plot_path_by_group_gauss[key] = temp_path_1
             self.plot_path_by_group_cross_NP[key] = temp_path_2
             self.plot_path_by_group_cross_P[key] = temp_path_3
-            self.__plot_html(value, temp_path_1, 'wavelength', 'gauss')
-            self.__plot_html(value, temp_path_2, 'wavelength', 'cross_NP')
-            self.__plot_html(value, temp_path_3, 'wavelength', 'cross_P')
-
-    def __plot_html(self, data, path, x_name, y_name):
-        trace1 = go.Scatter(x=data[x_name], y=data[y_name], mode='lines')
-        data = [trace1]
-        layout = go.Layout(margin=go.layout.Margin(autoexpand=False, b=15, l=30, r=0, t=0),
-                           xaxis=go.layout.XAxis(range=self.exp_data.x_range),
-                           )
-        # yaxis=go.layout.YAxis(range=[self.min_strength, self.max_strength]))
-        fig = go.Figure(data=data, layout=layout)
-        plot(fig, filename=path, auto_open=False)
+            write_html(self.get_figure('gauss', value), temp_path_1, self.project_path / 'figure')
+            write_html(self.get_figure('cross_NP', value), temp_path_2, self.project_path / 'figure')
+            write_html(self.get_figure('cross_P', value), temp_path_3, self.project_path / 'figure')
+
+    def get_figure(self, name: str, data: pd.DataFrame | None = None) -> Dict:
+        """
+        展宽结果的图，格式见 figure.line_figure
+        Args:
+            name: 要绘制的列，gauss, cross_NP, cross_P 中的一个
+            data: 展宽结果，为None时使用 widen_data
+        """
+        data = self.widen_data if data is None else data
+        return line_figure([(data['wavelength'], data[name])], self.exp_data.x_range)
 
     @staticmethod
     def __complex_cal(wave: float,
@@ -298,6 +847,221 @@ class Widen:
 
         return tt.sum(), ss.sum(), uu.sum()
 
+    def __profile(self,
+                  wave: np.ndarray,
+                  fwhmgauss: np.ndarray,
+                  new_wavelength: np.ndarray,
+                  gauss_weight: np.ndarray | None,
+                  lorentz_weight):
+        """
+        按照 self.method 选择展宽的计算方式，参数和返回值与 __batch_cal 相同
+        """
+        lorentz_weight = sparse.csr_matrix(lorentz_weight)
+        if self.method == 'batch':
+            gauss, lorentz = self.__batch_cal(wave, fwhmgauss, new_wavelength, gauss_weight, lorentz_weight)
+        elif self.method == 'window':
+            gauss, lorentz = self.__window_cal(wave, fwhmgauss, new_wavelength, gauss_weight, lorentz_weight)
+        elif self.method == 'fft':
+            gauss, lorentz = self.__fft_cal(wave, fwhmgauss, new_wavelength, gauss_weight, lorentz_weight)
+        else:
+            raise ValueError(f'method {self.method} is not supported')
+        return gauss, lorentz
+
+    def __batch_cal(self,
+                    wave: np.ndarray,
+                    fwhmgauss: np.ndarray,
+                    new_wavelength: np.ndarray,
+                    gauss_weight: np.ndarray | None,
+                    lorentz_weight: sparse.csr_matrix):
+        """
+        一次性计算整个网格上的展宽结果，与 __complex_cal 逐点计算的结果相同
+        为了限制内存，按照 chunk_size 将网格分块，每块构造（网格点数 × 跃迁数）的矩阵
+        Args:
+            wave: 网格点，单位是ev
+            fwhmgauss: 每个网格点对应的半高宽
+            new_wavelength: 跃迁的能量，单位是ev
+            gauss_weight: 每条跃迁的高斯线型权重，形状为 (跃迁数,)，为None时不计算高斯线型
+            lorentz_weight: 每条跃迁的洛伦兹线型权重，稀疏矩阵，形状为 (跃迁数, m)
+
+        Returns:
+            gauss: 形状为 (网格点数,)，gauss_weight为None时返回None
+            lorentz: 形状为 (网格点数, m)
+        """
+        gauss = None if gauss_weight is None else np.zeros(wave.shape[0])
+        lorentz = np.zeros((wave.shape[0], lorentz_weight.shape[1]))
+        step = max(1, self.chunk_size // max(new_wavelength.shape[0], 1))
+        for start in range(0, wave.shape[0], step):
+            end = start + step
+            fwhm = fwhmgauss[start:end, None]
+            # 原地计算，避免产生多个 (网格点数 × 跃迁数) 的临时数组
+            delta = new_wavelength[None, :] - wave[start:end, None]
+            np.square(delta, out=delta)
+            temp = delta * (-2.355 ** 2 / fwhm ** 2 / 2)
+            if gauss is not None:
+                np.exp(temp, out=temp)
+                gauss[start:end] = (temp @ gauss_weight) / np.sqrt(2 * np.pi) / fwhm[:, 0] * 2.355
+            np.add(delta, fwhm ** 2, out=temp)
+            np.reciprocal(temp, out=temp)
+            lorentz[start:end] = (temp @ lorentz_weight) * fwhm / np.pi
+        return gauss, lorentz
+
+    def __window_cal(self,
+                     wave: np.ndarray,
+                     fwhmgauss: np.ndarray,
+                     new_wavelength: np.ndarray,
+                     gauss_weight: np.ndarray | None,
+                     lorentz_weight: sparse.csr_matrix):
+        """
+        截断线型的展宽，参数和返回值与 __batch_cal 相同
+        将跃迁按能量排序后，用 searchsorted 找到每个网格点 cutoff 个半高宽以内的跃迁，只累加这些跃迁的贡献，
+        计算量近似与跃迁数成线性关系。
+        窗口外的高斯线型可以忽略；窗口外的洛伦兹线型按照跃迁在窗口两侧均匀分布的假设，
+        对线型的积分 arctan 进行解析补偿。
+        """
+        order = np.argsort(new_wavelength)
+        x = new_wavelength[order]
+        lorentz_weight = lorentz_weight[order]
+        if gauss_weight is not None:
+            gauss_weight = gauss_weight[order]
+
+        half = self.cutoff * fwhmgauss
+        lo = np.searchsorted(x, wave - half, side='left')
+        hi = np.searchsorted(x, wave + half, side='right')
+        # 窗口内的跃迁：把（网格点，跃迁）对展开成一维数组，按 chunk_size 分块计算
+        count = hi - lo
+        count_sum = np.concatenate([[0], np.cumsum(count)])
+        gauss = None if gauss_weight is None else np.zeros(wave.shape[0])
+        lorentz = np.zeros((wave.shape[0], lorentz_weight.shape[1]))
+        start = 0
+        while start < wave.shape[0]:
+            end = np.searchsorted(count_sum, count_sum[start] + self.chunk_size, side='right') - 1
+            end = min(max(end, start + 1), wave.shape[0])
+            row = np.repeat(np.arange(start, end), count[start:end])
+            col = np.arange(row.shape[0]) - np.repeat(count_sum[start:end] - count_sum[start], count[start:end]) \
+                + np.repeat(lo[start:end], count[start:end])
+            fwhm = fwhmgauss[row]
+            delta = (x[col] - wave[row]) ** 2
+            if gauss is not None:
+                temp = np.exp(-2.355 ** 2 * delta / fwhm ** 2 / 2) / np.sqrt(2 * np.pi) / fwhm * 2.355
+                gauss[start:end] = np.bincount(row - start, temp * gauss_weight[col], minlength=end - start)
+            temp = 2 * fwhm / (2 * np.pi * (delta + np.power(2 * fwhm, 2) / 4))
+            temp = sparse.csr_matrix((temp, (row - start, col)), shape=(end - start, x.shape[0]))
+            lorentz[start:end] = (temp @ lorentz_weight).toarray()
+            start = end
+
+        # 窗口外的洛伦兹线型：线型为 γ/(π(Δ²+γ²))，其中 γ = fwhmgauss
+        # 假设窗口左侧（右侧）的跃迁均匀分布在 [x_min, wave - half]（[wave + half, x_max]）内，
+        # 则其贡献为 ρ/π * (arctan(D/γ) - arctan(half/γ))，ρ 为线密度，D 为网格点到最远跃迁的距离
+        gamma = fwhmgauss
+        near = np.arctan(half / gamma)
+        total = np.asarray(lorentz_weight.sum(axis=0))
+        for weight, span, far in [(self.__prefix_sum(lorentz_weight, lo), wave - half - x[0], wave - x[0]),
+                                  (total - self.__prefix_sum(lorentz_weight, hi), x[-1] - wave - half, x[-1] - wave)]:
+            span = np.maximum(span, 0)
+            # 所有跃迁都挤在窗口边缘时，退化为窗口边缘处的线型值
+            tail = np.where(span > 1e-9 * gamma,
+                            (np.arctan(far / gamma) - near) / np.pi / np.where(span > 0, span, 1),
+                            gamma / (np.pi * (half ** 2 + gamma ** 2)))
+            lorentz += weight * tail[:, None]
+        return gauss, lorentz
+
+    @staticmethod
+    def __prefix_sum(weight: sparse.csr_matrix, index: np.ndarray):
+        """
+        计算稀疏矩阵前 index[j] 行之和
+        Args:
+            weight: 形状为 (跃迁数, m)
+            index: 形状为 (网格点数,)
+
+        Returns:
+            形状为 (网格点数, m)，第 j 行为 weight[:index[j]].sum(axis=0)
+        """
+        order = np.argsort(index, kind='stable')
+        bounds = index[order]
+        # 第 i 行属于第 k 段，当且仅当 bounds[k-1] <= i < bounds[k]，超出最后一段的行不参与求和
+        segment = np.searchsorted(bounds, np.arange(weight.shape[0]), side='right')
+        keep = segment < bounds.shape[0]
+        selector = sparse.csr_matrix((np.ones(keep.sum()), (segment[keep], np.arange(weight.shape[0])[keep])),
+                                     shape=(bounds.shape[0], weight.shape[0]))
+        result = np.empty((index.shape[0], weight.shape[1]))
+        result[order] = np.cumsum((selector @ weight).toarray(), axis=0)
+        return result
+
+    def __fft_cal(self,
+                  wave: np.ndarray,
+                  fwhmgauss: np.ndarray,
+                  new_wavelength: np.ndarray,
+                  gauss_weight: np.ndarray | None,
+                  lorentz_weight: sparse.csr_matrix,
+                  points_per_fwhm: int = 10):
+        """
+        直方图 + FFT 卷积的展宽，参数和返回值与 __batch_cal 相同
+        先把跃迁强度按线性插值分配到细分后的均匀网格上（每个半高宽至少 points_per_fwhm 个点），
+        再与高斯、洛伦兹线型做FFT卷积，最后在原网格点处取值。
+        计算量为 O(M log M)，M 为细分网格点数，与跃迁数无关。
+        """
+        if self.n is None:
+            raise ValueError('fft 方式需要均匀的能量网格，请设置 n')
+        if np.ptp(fwhmgauss) > 0:
+            raise ValueError('fft 方式要求半高宽在整个网格上为常数')
+        fwhm = fwhmgauss[0]
+        sample = max(1, int(np.ceil((wave[1] - wave[0]) * points_per_fwhm / fwhm)))
+        step = (wave[1] - wave[0]) / sample
+
+        # 线性插值分配到细网格上，网格向左扩展以容纳超出范围的跃迁
+        position = (new_wavelength - wave[0]) / step
+        index = np.floor(position).astype(int)
+        frac = position - index
+        shift = min(index.min(), 0)
+        index -= shift
+        size = max(index.max() + 2, (wave.shape[0] - 1) * sample + 1 - shift)
+        line = np.arange(new_wavelength.shape[0])
+        deposit = sparse.csr_matrix((np.concatenate([1 - frac, frac]),
+                                     (np.concatenate([index, index + 1]), np.concatenate([line, line]))),
+                                    shape=(size, new_wavelength.shape[0]))
+
+        # 线型在 [-half, half] 个细网格点上的取值
+        half = size + (wave.shape[0] - 1) * sample
+        delta = (np.arange(-half, half + 1) * step) ** 2
+        kernel_lorentz = fwhm / np.pi / (delta + fwhm ** 2)
+        index = np.arange(wave.shape[0]) * sample - shift + half
+        gauss = None
+        if gauss_weight is not None:
+            kernel_gauss = np.exp(-2.355 ** 2 * delta / fwhm ** 2 / 2) / np.sqrt(2 * np.pi) / fwhm * 2.355
+            gauss = fftconvolve(deposit @ gauss_weight, kernel_gauss)[index]
+        # 按列分块卷积，限制内存
+        lorentz = np.zeros((wave.shape[0], lorentz_weight.shape[1]))
+        step = max(1, self.chunk_size // (size + 2 * half))
+        for start in range(0, lorentz_weight.shape[1], step):
+            hist = (deposit @ lorentz_weight[:, start:start + step]).toarray()
+            lorentz[:, start:start + step] = fftconvolve(hist, kernel_lorentz[:, None], axes=0)[index]
+        return gauss, lorentz
+
+    def __window_deviation(self,
+                           wave: np.ndarray,
+                           fwhmgauss: np.ndarray,
+                           new_wavelength: np.ndarray,
+                           gauss_weight: np.ndarray,
+                           lorentz_weight: sparse.csr_matrix,
+                           gauss: np.ndarray,
+                           lorentz: np.ndarray,
+                           check_num: int = 20):
+        """
+        在均匀抽取的 check_num 个网格点上与精确求和比较，估计 'window' 方式的偏差
+
+        Returns:
+            返回一个字典，键为 gauss, lorentz，值为最大偏差与该列最大值之比（lorentz 取所有列中的最大值）
+        """
+        index = np.unique(np.linspace(0, wave.shape[0] - 1, min(check_num, wave.shape[0])).astype(int))
+        exact_gauss, exact_lorentz = self.__batch_cal(wave[index], fwhmgauss[index], new_wavelength,
+                                                      gauss_weight, lorentz_weight)
+        scale = np.abs(exact_gauss).max()
+        deviation = {'gauss': float(np.abs(gauss[index] - exact_gauss).max() / scale) if scale > 0 else 0.0}
+        scale = np.abs(exact_lorentz).max(axis=0)
+        temp = np.abs(lorentz[index] - exact_lorentz).max(axis=0)
+        deviation['lorentz'] = float((temp[scale > 0] / scale[scale > 0]).max(initial=0.0))
+        return deviation
+
     @staticmethod
     def __fwhmgauss(wavelength: float):
         return 0.5
@@ -313,14 +1077,82 @@ class SpectraAdd:
         self.grid_path = self.project_path.joinpath('figure/grid.html').as_posix()
         self.similarity: pd.DataFrame | None = None
         self.grid_data: Dict | None = None
+        # 自适应搜索计算过的所有点，列标题为：temperature, density, similarity, stage
+        self.search_data: pd.DataFrame | None = None
+        # 选择的相似度，名称见 similarity.METRICS，第一个用于网格的热力图和自适应搜索
+        self.metrics: List[str] = ['dtw']
+        # 最近一次 get_add_data 得到的所有相似度 {名称: 相似度}
+        self.similarities: Dict[str, float] = {}
+        # DTW 相似度的设置，见 spectrum_similarity3
+        # 默认为 fastdtw，'band' 需要手动选择，两者的数值范围不同，不能直接比较
+        self.dtw_method = 'fastdtw'
+        self.dtw_window = 0.1
+        # 网格计算时，相似度超过当前最小值的多少倍就不再精确计算，为None时全部精确计算
+        self.dtw_prune: float | None = None
 
         self.result: pd.DataFrame | None = None
+        self.__comparer: SpectrumComparer | None = None
 
     def get_add_data(self, temperature, electron_density):
-        abundance = self.atom.get_ion_abundance2(temperature, electron_density)
         for widen in self.widen_list:
             # if widen.widen_data is None:
             widen.widen(temperature)
+        res = self.__add_widen_data(temperature, electron_density)
+        self.result = res
+        self.similarities = {name: value[0] for name, value in self.get_comparer(res['wavelength'].values).evaluate(
+            res['intensity'].values, self.metrics, self.get_metric_options()).items()}
+        similarity = self.similarities[self.metrics[0]]
+        return res, similarity
+
+    def get_metric_options(self) -> Dict[str, dict]:
+        """
+        各相似度的参数 {名称: 参数}
+        """
+        return {'dtw': {'method': self.dtw_method, 'window': self.dtw_window, 'prune': self.dtw_prune}}
+
+    def get_comparer(self, wavelength: np.ndarray) -> SpectrumComparer:
+        """
+        获取与实验光谱比较用的 SpectrumComparer，模拟光谱的波长不变时复用
+        Args:
+            wavelength: 模拟光谱的波长
+        """
+        if self.__comparer is None or not np.array_equal(self.__comparer.wavelength, wavelength):
+            self.__comparer = SpectrumComparer(self.exp_data.data['wavelength'].values,
+                                               self.exp_data.data['intensity'].values, wavelength)
+        return self.__comparer
+
+    def is_higher_better(self) -> bool:
+        """
+        第一个相似度是否越大越好
+        """
+        return METRICS[self.metrics[0]].higher_is_better
+
+    def get_temperature_column(self, temperature, n_values: np.ndarray):
+        """
+        计算某一温度下，各个电子密度对应的相似度
+        展宽与电子密度无关，所以每个离子只展宽一次，不同密度只改变离子丰度的权重
+        Args:
+            temperature: 等离子体温度
+            n_values: 电子密度列表
+
+        Returns:
+            返回一个列表，每个元素为对应密度的相似度（第一个相似度）
+        """
+        for widen in self.widen_list:
+            widen.widen(temperature)
+        ion = [int(widen.name.split('_')[-1]) for widen in self.widen_list]
+        cross_p = np.array([widen.widen_data['cross_P'].values for widen in self.widen_list])
+        abundance = np.array([self.atom.get_ion_abundance2(temperature, n) for n in n_values])[:, ion]
+        comparer = self.get_comparer(self.widen_list[0].widen_data['wavelength'].values)
+        return list(comparer.evaluate(abundance @ cross_p, self.metrics[:1], self.get_metric_options())[self.metrics[0]])
+
+    def __add_widen_data(self, temperature, electron_density):
+        """
+        按照离子丰度将各离子已经展宽好的 cross_P 相加
+        Returns:
+            返回一个DataFrame，列标题为：wavelength, intensity
+        """
+        abundance = self.atom.get_ion_abundance2(temperature, electron_density)
         res = pd.DataFrame()
         res['wavelength'] = self.widen_list[0].widen_data['wavelength']
         temp = np.zeros(res.shape[0])
@@ -328,82 +1160,235 @@ class SpectraAdd:
             ion = int(widen.name.split('_')[-1])
             temp += widen.widen_data['cross_P'].values * abundance[ion]
         res['intensity'] = temp
-        self.result = res
-        similarity = self.get_similarity()
-        return res, similarity
+        return res
+
+    def get_cal_grid(self, n_values: np.ndarray, t_values: np.ndarray, pbar=None, plot: bool = True):
+        """
+        计算整个网格，计算完成后才返回
+        Args:
+            n_values: 电子密度列表
+            t_values: 温度列表
+            pbar: 进度条，需要有 setValue 方法
+            plot: 是否绘制热力图
+        """
+        self.search_data = None
+        scheduler = GridScheduler(self, t_values, n_values)
+        finish_count = 0
+
+        def on_result(start, block):
+            nonlocal finish_count
+            finish_count += block.size
+            if pbar is not None:
+                pbar.setValue(finish_count / scheduler.result.size * 100)
+
+        scheduler.run(on_result)
+        self.set_grid_data(t_values, n_values, scheduler.result, scheduler.results)
+        if plot:
+            self.plot_grid()
+
+    def start_cal_grid(self, n_values: np.ndarray, t_values: np.ndarray,
+                       on_result=None, on_finished=None) -> GridScheduler:
+        """
+        在后台线程中计算网格，立即返回调度器，可以通过调度器取消
+        每完成一块，grid_data 和 similarity 随之更新（未完成的位置为nan），然后调用 on_result(start, block)；
+        结束时调用 on_finished(scheduler)，参数见 GridScheduler.start
+        """
+        self.search_data = None
+        scheduler = GridScheduler(self, t_values, n_values)
+        self.set_grid_data(t_values, n_values, scheduler.result)
 
-    def get_cal_grid(self, n_values: np.ndarray, t_values: np.ndarray, pbar):
-        loop = asyncio.get_event_loop()
-        res = []
-
-        async def cal_grid():
-            pool = ProcessPoolExecutor(os.cpu_count() - 1)
-            sum_count = n_values.shape[0] * t_values.shape[0]
-            finish_count = 0
-            tasks_out = []
-
-            for n in n_values:
-                tasks_in = []
-                for t in t_values:
-                    temp_task = loop.run_in_executor(pool, self.get_add_data, t, n)
-                    tasks_in.append(temp_task)
-                tasks_out.append(tasks_in)
-
-            # 等待所有任务完成并跟踪进度
-            for tasks in tasks_out:
-                temp = []
-                for future in asyncio.as_completed(tasks):
-                    # 处理已完成任务的结果
-                    result = await future
-                    temp.append(result[1])
-                    finish_count += 1
-                    pbar.setValue(finish_count / sum_count * 100)
-                res.append(temp)
-
-        loop.run_until_complete(cal_grid())
+        def on_result_(start, block):
+            self.set_grid_data(t_values, n_values, scheduler.result, scheduler.results)
+            if on_result is not None:
+                on_result(start, block)
+
+        scheduler.start(on_result_, on_finished)
+        return scheduler
+
+    def set_grid_data(self, t_values: np.ndarray, n_values: np.ndarray, grid: np.ndarray,
+                      metric_grids: Dict[str, np.ndarray] | None = None):
+        """
+        设置网格计算的结果
+        Args:
+            t_values: 温度列表
+            n_values: 电子密度列表
+            grid: 形状为 (密度个数, 温度个数) 的相似度（第一个相似度）
+            metric_grids: 所有选择的相似度 {名称: 形状同 grid 的数组}
+        """
         self.grid_data = {
             'temperature': t_values,
             'density': n_values,
-            'grid_data': np.array(res)
+            'grid_data': grid.copy(),
+            'metrics': {name: value.copy() for name, value in (metric_grids or {}).items()}
         }
 
-        self.similarity = pd.DataFrame(res)
+        self.similarity = pd.DataFrame(self.grid_data['grid_data'])
         self.similarity.columns = list(map(lambda x: '{:.3f}'.format(x), t_values))
         self.similarity.index = list(map(lambda x: '{:.3e}'.format(x), n_values))
 
-        self.plot_grid()
+    def get_adaptive_search(self, t_range, n_range, coarse_num=(5, 5), levels=3, keep=3, polish=True, pbar=None,
+                            plot: bool = True, cancel_event: threading.Event | None = None):
+        """
+        由粗到细搜索最佳的温度和电子密度，计算量远小于同样分辨率的密集网格
+        1. 在 (温度, log10(电子密度)) 上计算一个粗网格
+        2. 每一轮把步长减半，在当前最好的 keep 个点周围的 3x3 邻域内补充计算
+        3. 以最好的点为起点，用带边界的 Nelder-Mead 继续优化
+        使用 metrics 中的第一个相似度
+        前两步每一轮的点所在的温度和密度组成一个小网格，用 GridScheduler 在进程池中计算，网格中多算的点也一并记录；
+        第三步每次只有一个点，在当前进程中计算
+        Args:
+            t_range: 温度范围 (最小值, 最大值)
+            n_range: 电子密度范围 (最小值, 最大值)
+            coarse_num: 粗网格的 (温度个数, 密度个数)
+            levels: 细化的轮数
+            keep: 每一轮在多少个最好的点周围细化
+            polish: 是否用 Nelder-Mead 继续优化
+            pbar: 进度条，需要有 setValue 方法
+            plot: 是否绘制热力图
+            cancel_event: 取消搜索的事件，被设置后抛出 SearchCancelled，见 AdaptiveScheduler
+
+        Returns:
+            最佳的 (温度, 电子密度, 相似度)
+        """
+        t_min, t_max = t_range
+        l_min, l_max = np.log10(n_range[0]), np.log10(n_range[1])
+        records = {}
+        # 统一转换为越小越好
+        sign = -1 if self.is_higher_better() else 1
+
+        def evaluate(points, stage):
+            # 同一温度只展宽一次
+            points = {(round(float(np.clip(t, t_min, t_max)), 10), round(float(np.clip(l, l_min, l_max)), 10))
+                      for t, l in points}
+            points = [point for point in points if point not in records]
+            if cancel_event is not None and cancel_event.is_set():
+                raise SearchCancelled()
+            if len(points) == 1:
+                t, l = points[0]
+                records[(t, l)] = (self.get_temperature_column(t, np.power(10, [l]))[0], stage)
+            elif points:
+                t_values = np.array(sorted({point[0] for point in points}))
+                l_values = np.array(sorted({point[1] for point in points}))
+                scheduler = GridScheduler(self, t_values, np.power(10, l_values), cancel_event=cancel_event)
+                if not scheduler.run():
+                    raise SearchCancelled()
+                for i, l in enumerate(l_values):
+                    for j, t in enumerate(t_values):
+                        records.setdefault((float(t), float(l)), (scheduler.result[i, j], stage))
+
+        def best_points(num):
+            return sorted(records, key=lambda k: sign * records[k][0])[:num]
+
+        # 粗网格
+        t_values = np.linspace(t_min, t_max, coarse_num[0])
+        l_values = np.linspace(l_min, l_max, coarse_num[1])
+        evaluate([(t, l) for t in t_values for l in l_values], 0)
+        grid = np.array([[records[(round(t, 10), round(l, 10))][0] for t in t_values] for l in l_values])
+        self.set_grid_data(t_values, np.power(10, l_values), grid)
+        if pbar is not None:
+            pbar.setValue(100 / (levels + 2))
+
+        # 逐级细化
+        t_step = (t_max - t_min) / max(coarse_num[0] - 1, 1)
+        l_step = (l_max - l_min) / max(coarse_num[1] - 1, 1)
+        for level in range(levels):
+            t_step, l_step = t_step / 2, l_step / 2
+            evaluate([(t + i * t_step, l + j * l_step)
+                      for t, l in best_points(keep) for i in (-1, 0, 1) for j in (-1, 0, 1)], level + 1)
+            if pbar is not None:
+                pbar.setValue(100 * (level + 2) / (levels + 2))
+
+        # 在归一化的坐标中优化，使两个方向的步长相当
+        if polish:
+            scale = np.array([max(t_max - t_min, 1e-12), max(l_max - l_min, 1e-12)])
+            offset = np.array([t_min, l_min])
+
+            def fun(x):
+                t, l = x * scale + offset
+                evaluate([(t, l)], levels + 1)
+                key = (round(float(np.clip(t, t_min, t_max)), 10), round(float(np.clip(l, l_min, l_max)), 10))
+                return sign * records[key][0]
+
+            x0 = (np.array(best_points(1)[0]) - offset) / scale
+            step = np.array([t_step, l_step]) / scale
+            minimize(fun, x0, method='Nelder-Mead', bounds=[(0, 1), (0, 1)],
+                     options={'initial_simplex': [x0, x0 + [step[0], 0], x0 + [0, step[1]]],
+                              'xatol': 1e-3, 'fatol': 1e-6, 'maxfev': 40})
+        if pbar is not None:
+            pbar.setValue(100)
+
+        self.search_data = pd.DataFrame(
+            [(t, 10 ** l, sim, stage) for (t, l), (sim, stage) in records.items()],
+            columns=['temperature', 'density', 'similarity', 'stage'])
+        t, l = best_points(1)[0]
+        self.get_add_data(t, 10 ** l)
+        if plot:
+            self.plot_grid()
+        return t, 10 ** l, records[(t, l)][0]
+
+    def start_adaptive_search(self, t_range, n_range, on_progress=None, on_finished=None,
+                              **options) -> AdaptiveScheduler:
+        """
+        在后台线程中进行自适应搜索，立即返回调度器，可以通过调度器取消
+        每完成一轮调用 on_progress(进度)，结束时调用 on_finished(scheduler)，参数见 AdaptiveScheduler.start
+        Args:
+            t_range: 温度范围 (最小值, 最大值)
+            n_range: 电子密度范围 (最小值, 最大值)
+            **options: get_adaptive_search 的其他参数
+        """
+        scheduler = AdaptiveScheduler(self, t_range, n_range, **options)
+        scheduler.start(on_progress, on_finished)
+        return scheduler
 
-    def plot_grid(self):
-        trace1 = go.Heatmap(x=self.grid_data['temperature'], y=self.grid_data['density'], z=self.grid_data['grid_data'])
-        data = [trace1]
-        layout = go.Layout(
-            margin=go.layout.Margin(b=15, l=60, r=0, t=0),
-            yaxis={
+    def get_grid_figure(self) -> Dict:
+        """
+        温度-密度网格的热力图，格式与 figure.line_figure 相同
+        """
+        data = [{'type': 'heatmap', 'x': self.grid_data['temperature'], 'y': self.grid_data['density'],
+                 'z': self.grid_data['grid_data']}]
+        # 自适应搜索时，把计算过的点画在粗网格上
+        if self.search_data is not None:
+            if self.is_higher_better():
+                best = self.search_data['similarity'].idxmax()
+            else:
+                best = self.search_data['similarity'].idxmin()
+            data.append({'type': 'scatter', 'x': self.search_data['temperature'], 'y': self.search_data['density'],
+                         'mode': 'markers', 'text': self.search_data['similarity'],
+                         'marker': {'size': 5, 'color': 'white', 'line': {'width': 1, 'color': 'black'}},
+                         'showlegend': False})
+            data.append({'type': 'scatter', 'x': [self.search_data['temperature'][best]],
+                         'y': [self.search_data['density'][best]],
+                         'mode': 'markers', 'marker': {'size': 12, 'symbol': 'x', 'color': 'red'},
+                         'showlegend': False})
+        layout = {
+            'margin': {'b': 15, 'l': 60, 'r': 0, 't': 0},
+            'yaxis': {
                 'type': 'log',
                 'tickformat': '.2e'
             }
-        )
-        fig = go.Figure(data=data, layout=layout)
-        plot(fig, filename=self.grid_path, auto_open=False)
+        }
+        return {'data': data, 'layout': layout}
+
+    def plot_grid(self):
+        write_html(self.get_grid_figure(), self.grid_path, self.project_path / 'figure')
 
     def get_similarity(self):
-        return self.spectrum_similarity3(self.exp_data.data[['wavelength', 'intensity']],
-                                         self.result[['wavelength', 'intensity']])
+        comparer = self.get_comparer(self.result['wavelength'].values)
+        return comparer.evaluate(self.result['intensity'].values, self.metrics[:1],
+                                 self.get_metric_options())[self.metrics[0]][0]
 
-    def plot_html(self):
+    def get_figure(self) -> Dict:
+        """
+        实验谱与叠加结果的对比图，格式见 figure.line_figure
+        """
         x1 = self.exp_data.data['wavelength']
         y1 = self.exp_data.data['intensity'] / self.exp_data.data['intensity'].max() + 0.5
         x2 = self.result['wavelength']
         y2 = self.result['intensity'] / self.result['intensity'].max()
-        trace1 = go.Scatter(x=x1, y=y1, mode='lines')
-        trace2 = go.Scatter(x=x2, y=y2, mode='lines')
-        data = [trace1, trace2]
-        layout = go.Layout(margin=go.layout.Margin(autoexpand=False, b=15, l=30, r=0, t=0),
-                           xaxis=go.layout.XAxis(range=self.exp_data.x_range),
-                           )
-        # yaxis=go.layout.YAxis(range=[self.min_strength, self.max_strength]))
-        fig = go.Figure(data=data, layout=layout)
-        plot(fig, filename=self.plot_path, auto_open=False)
+        return line_figure([(x1, y1), (x2, y2)], self.exp_data.x_range)
+
+    def plot_html(self):
+        write_html(self.get_figure(), self.plot_path, self.project_path / 'figure')
 
     @staticmethod
     def spectrum_similarity1(fax: pd.DataFrame, fbx: pd.DataFrame):
@@ -426,10 +1411,7 @@ class SpectraAdd:
         y1 = y1 / y1.max()
         y2 = y2 / y2.max()
 
-        res = 0
-        for i in range(fax.shape[0]):
-            res += min(np.sqrt((x1[i] - x2) ** 2 + (y1[i] - y2) ** 2))
-        return res / fax.shape[0]
+        return nearest_point_distance(x1, y1, x2, y2)
 
     def spectrum_similarity2(self, fax: pd.DataFrame, fbx: pd.DataFrame):
         """
@@ -452,11 +1434,27 @@ class SpectraAdd:
         else:
             return R2
 
-    def spectrum_similarity3(self, fax: pd.DataFrame, fbx: pd.DataFrame):
-        y1, y2 = self.get_y1y2(fax, fbx)
-
-        distance, path = fastdtw(y1, y2)
-        return distance
+    @staticmethod
+    def spectrum_similarity3(fax: pd.DataFrame, fbx: pd.DataFrame, method='fastdtw', window=0.1, threshold=np.inf):
+        """
+        DTW 距离，越小越相似
+        Args:
+            fax: 实验光谱
+            fbx: 模拟光谱
+            method: 'fastdtw' 为原来的 fastdtw 近似（默认）；'band' 为带 Sakoe-Chiba 约束的精确 DTW，
+                对齐路径被限制在带宽内，得到的距离通常比 fastdtw 大得多，两者不能混在一起比较
+            window: 带宽占光谱点数的比例，为None时不限制，仅用于 'band'
+            threshold: 距离超过该值时提前停止，返回值为不小于该值的下界，仅用于 'band'
+        """
+        y1, y2 = SpectraAdd.get_y1y2(fax, fbx)
+
+        if method == 'fastdtw':
+            from fastdtw import fastdtw
+            distance, path = fastdtw(y1, y2)
+            return distance
+        if window is not None:
+            window = max(int(np.ceil(window * y1.shape[0])), 1)
+        return dtw_distance(y1, y2, window, threshold)
 
     def spectrum_similarity4(self, fax: pd.DataFrame, fbx: pd.DataFrame):
         y1, y2 = self.get_y1y2(fax, fbx)
@@ -0,0 +1,304 @@
+# 图的数据
+# 各数据类只生成 plotly 格式的字典 {'data': [...], 'layout': {...}}，不依赖 plotly，
+# 界面中在已经加载的网页里用 Plotly.react 更新，需要保存时再导出为 HTML 文件
+# 数组以 float32 的 base64 保存（plotly.js 的 typed array，需要 plotly.js 2.28 以上，见 get_plotly_js），HTML 文件共用 figure 文件夹中的 plotly.min.js
+# 点数很多的折线在网页中保留完整的数据，只把当前 x 范围内的点抽稀后交给 plotly.js，缩放后重新抽稀，见 PLOT_SCRIPT
+import base64
+import json
+import os
+import re
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+# 与以前的图相同的边距
+LINE_MARGIN = {'autoexpand': False, 'b': 15, 'l': 30, 'r': 0, 't': 0}
+
+# 共用的 plotly.js 的文件名，保存在项目的 figure 文件夹中
+PLOTLY_JS = 'plotly.min.js'
+# typed array（{'dtype', 'bdata'}）需要的最低 plotly.js 版本，plotly 5.19 以上的包中的 plotly.js 满足要求
+PLOTLY_JS_MIN_VERSION = (2, 28, 0)
+# 以 typed array 保存的轨迹属性
+ARRAY_KEYS = ('x', 'y', 'z')
+# 折线图抽稀时 x 方向的分段数，约为图的宽度（像素），点数不超过 4 * PIXELS 的折线不抽稀
+PIXELS = 2000
+
+PAGE = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<script src="{js}"></script>
+<style>html, body, #plot {{margin: 0; width: 100%; height: 100%; overflow: hidden;}}</style>
+</head>
+<body>
+<div id="plot"></div>
+<script>
+{script}
+</script>
+</body>
+</html>
+'''
+
+# 显示图的脚本，界面中的网页和导出的 HTML 文件共用，update(figure) 显示新的图
+# 折线的抽稀：按当前 x 轴范围把点分为 PIXELS 段，每段只保留第一个、最后一个、y 最小和 y 最大的点，
+# 每段对应不超过一个像素时，画出的图与完整的数据相同；线状谱（每条线为 (x, 0), (x, y), (x, 0) 三个点）在每段中保留最高的一条线
+# 范围两侧各保留一个点，使连到范围外的线段不变；整条线的端点和 y 的最值点也始终保留，使自动范围与完整的数据相同
+PLOT_SCRIPT = f'var PIXELS = {PIXELS};\n' + '''// 当前的图，以及每条轨迹按 x 排序后的完整数据（不抽稀的轨迹为 null）
+var current = null;
+var lines = [];
+var listening = false;
+
+function decode(value) {
+    var text = atob(value.bdata);
+    var bytes = new Uint8Array(text.length);
+    for (var i = 0; i < text.length; i++) {
+        bytes[i] = text.charCodeAt(i);
+    }
+    return new Float32Array(bytes.buffer);
+}
+
+function prepare(trace) {
+    // 只抽稀点数很多、x 和 y 都是 typed array 的折线
+    if (trace.type !== 'scatter' || !trace.x || !trace.y || trace.x.bdata === undefined || trace.y.bdata === undefined) {
+        return null;
+    }
+    var x = decode(trace.x), y = decode(trace.y);
+    var n = x.length;
+    if (n <= 4 * PIXELS || y.length !== n) {
+        return null;
+    }
+    for (var i = 1; i < n; i++) {
+        if (x[i] < x[i - 1]) {
+            // x 无序时按 x 排序，相同的 x 保持原来的顺序
+            var order = Array.from(x.keys()).sort(function (a, b) { return x[a] - x[b] || a - b; });
+            x = Float32Array.from(order, function (j) { return x[j]; });
+            y = Float32Array.from(order, function (j) { return y[j]; });
+            break;
+        }
+    }
+    var min = 0, max = 0;
+    for (i = 1; i < n; i++) {
+        if (y[i] < y[min]) min = i;
+        if (y[i] > y[max]) max = i;
+    }
+    return {x: x, y: y, fixed: [0, n - 1, min, max]};
+}
+
+function search(x, value, right) {
+    // 第一个不小于 value 的位置，right 为 true 时为第一个大于 value 的位置
+    var lo = 0, hi = x.length;
+    while (lo < hi) {
+        var mid = (lo + hi) >> 1;
+        if (x[mid] < value || (right && x[mid] === value)) lo = mid + 1; else hi = mid;
+    }
+    return lo;
+}
+
+function decimate(line, range) {
+    var x = line.x, y = line.y, n = x.length;
+    var lo = range ? Math.min(range[0], range[1]) : x[0];
+    var hi = range ? Math.max(range[0], range[1]) : x[n - 1];
+    if (!(hi > lo)) {
+        lo = x[0];
+        hi = x[n - 1];
+    }
+    var start = Math.max(search(x, lo) - 1, 0);
+    var end = Math.min(search(x, hi, true) + 1, n);
+    var index = line.fixed.slice();
+    if (end - start <= 4 * PIXELS) {
+        for (var i = start; i < end; i++) index.push(i);
+    } else {
+        var width = hi > lo ? hi - lo : Infinity;
+        i = start;
+        while (i < end) {
+            var bucket = Math.min(Math.floor((x[i] - lo) / width * PIXELS), PIXELS - 1);
+            var min = i, max = i, j = i + 1;
+            while (j < end && Math.min(Math.floor((x[j] - lo) / width * PIXELS), PIXELS - 1) === bucket) {
+                if (y[j] < y[min]) min = j;
+                if (y[j] > y[max]) max = j;
+                j++;
+            }
+            index.push(i, min, max, j - 1);
+            i = j;
+        }
+    }
+    index.sort(function (a, b) { return a - b; });
+    var keep = index.filter(function (value, k) { return k === 0 || value !== index[k - 1]; });
+    return [Float32Array.from(keep, function (k) { return x[k]; }), Float32Array.from(keep, function (k) { return y[k]; })];
+}
+
+function render(layout) {
+    var axis = layout.xaxis || {};
+    var range = !axis.autorange && axis.range ? [Number(axis.range[0]), Number(axis.range[1])] : null;
+    var data = current.data.map(function (trace, i) {
+        if (!lines[i]) return trace;
+        var result = decimate(lines[i], range);
+        return Object.assign({}, trace, {x: result[0], y: result[1]});
+    });
+    return Plotly.react('plot', data, layout, {responsive: true});
+}
+
+function update(figure) {
+    current = figure;
+    lines = figure.data.map(prepare);
+    render(figure.layout).then(function (plot) {
+        if (listening) return;
+        listening = true;
+        // 缩放、平移或恢复 x 轴范围后按新的范围重新抽稀
+        plot.on('plotly_relayout', function (event) {
+            if (lines.some(Boolean) && Object.keys(event).some(function (key) { return key.indexOf('xaxis') === 0; })) {
+                render(plot.layout);
+            }
+        });
+    });
+}'''
+
+# 界面中显示图的网页，只加载一次，之后通过 update 更新
+VIEW_PAGE = PAGE.format(js=PLOTLY_JS, script=PLOT_SCRIPT)
+
+
+def line_figure(lines: List[Tuple], x_range: List[float] | None = None) -> Dict:
+    """
+    折线图，保留完整的数据，点数很多时在网页中按当前的 x 轴范围抽稀，见 PLOT_SCRIPT
+    Args:
+        lines: 每条线的 (x, y)
+        x_range: x轴的范围
+
+    Returns:
+        plotly 格式的字典
+    """
+    layout = {'margin': LINE_MARGIN}
+    if x_range is not None:
+        layout['xaxis'] = {'range': [float(x_range[0]), float(x_range[1])]}
+    data = []
+    for x, y in lines:
+        data.append({'type': 'scatter', 'x': x, 'y': y, 'mode': 'lines'})
+    return {'data': data, 'layout': layout}
+
+
+def encode_array(value) -> Dict:
+    """
+    把数值数组转换为 plotly.js 的 typed array：{'dtype': 'f4', 'bdata': float32 的 base64, 'shape': '行, 列'}
+    """
+    array = np.ascontiguousarray(value, dtype='<f4')
+    result = {'dtype': 'f4', 'bdata': base64.b64encode(array.tobytes()).decode('ascii')}
+    if array.ndim == 2:
+        result['shape'] = '{}, {}'.format(*array.shape)
+    return result
+
+
+def pack_figure(figure: Dict) -> Dict:
+    """
+    把轨迹中的 x, y, z 数组转换为 typed array，长度很短的列表保持不变
+    """
+    data = []
+    for trace in figure['data']:
+        trace = dict(trace)
+        for key in ARRAY_KEYS:
+            value = trace.get(key)
+            if hasattr(value, 'values') and not isinstance(value, dict):
+                value = value.values
+            if isinstance(value, np.ndarray) and value.dtype.kind in 'fiu':
+                trace[key] = encode_array(value)
+        data.append(trace)
+    return dict(figure, data=data)
+
+
+def to_json(figure: Dict) -> str:
+    """
+    把图转换为 JavaScript 的对象字面量，x, y, z 数组见 pack_figure，其余数组转换为列表，nan 保留为 NaN
+    """
+    def default(value):
+        if hasattr(value, 'values') and not isinstance(value, dict):
+            value = value.values
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        if isinstance(value, np.generic):
+            return value.item()
+        raise TypeError(f'无法转换 {type(value)}')
+
+    return json.dumps(pack_figure(figure), default=default, ensure_ascii=False)
+
+
+def get_plotly_js_version(text: str) -> Tuple[int, ...] | None:
+    """
+    plotly.js 文件开头注释中的版本号，如 (2, 35, 2)，找不到时返回None
+    """
+    match = re.search(r'plotly\.js v(\d+)\.(\d+)\.(\d+)', text)
+    return None if match is None else tuple(int(i) for i in match.groups())
+
+
+def get_plotly_js(figure_path: Path) -> Path:
+    """
+    获取共用的 plotly.js，没有或者版本低于 PLOTLY_JS_MIN_VERSION 时从 plotly 包中复制
+    Args:
+        figure_path: 项目的 figure 文件夹
+
+    Raises:
+        ImportError: plotly 包中的 plotly.js 不支持 typed array
+    """
+    figure_path = Path(figure_path)
+    js_path = figure_path / PLOTLY_JS
+    if js_path.exists():
+        with open(js_path, encoding='utf-8', errors='ignore') as f:
+            version = get_plotly_js_version(f.read(200))
+        if version is not None and version >= PLOTLY_JS_MIN_VERSION:
+            return js_path
+    from plotly.offline import get_plotlyjs
+
+    text = get_plotlyjs()
+    version = get_plotly_js_version(text[:200])
+    if version is None or version < PLOTLY_JS_MIN_VERSION:
+        raise ImportError('plotly 包中的 plotly.js 版本为 {}，图的数据需要 {} 以上，请升级 plotly 到 5.19 以上'.format(
+            '未知' if version is None else '.'.join(map(str, version)),
+            '.'.join(map(str, PLOTLY_JS_MIN_VERSION))))
+    figure_path.mkdir(parents=True, exist_ok=True)
+    js_path.write_text(text, encoding='utf-8')
+    return js_path
+
+
+def get_view_page(figure_path: Path) -> Path:
+    """
+    获取界面中显示图的网页，第一次使用时在 figure 文件夹中写入网页和 plotly.min.js
+    Args:
+        figure_path: 项目的 figure 文件夹
+
+    Returns:
+        网页的路径
+    """
+    page_path = Path(get_plotly_js(figure_path)).with_name('view.html')
+    write_text(page_path, VIEW_PAGE)
+    return page_path
+
+
+def write_html(figure: Dict, path: str, figure_path: Path) -> bool:
+    """
+    把图导出为 HTML 文件，文件中只有图的数据，plotly.js 使用 figure 文件夹中共用的文件
+    Args:
+        figure: plotly 格式的字典
+        path: HTML 文件的路径
+        figure_path: 项目的 figure 文件夹
+
+    Returns:
+        是否写入了文件，内容没有变化时不写入
+    """
+    path = Path(path)
+    js = Path(os.path.relpath(get_plotly_js(figure_path), path.parent)).as_posix()
+    script = f'{PLOT_SCRIPT}\nupdate({to_json(figure)});'
+    return write_text(path, PAGE.format(js=js, script=script))
+
+
+def write_text(path: Path, text: str) -> bool:
+    """
+    写入文本文件，内容与原来的文件相同时不写入
+    Returns:
+        是否写入了文件
+    """
+    path = Path(path)
+    content = text.encode('utf-8')
+    if path.exists() and path.stat().st_size == len(content) and path.read_bytes() == content:
+        return False
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    return True
@@ -0,0 +1,498 @@
+# 温度-密度网格计算
+import atexit
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from .atom import Atomic
+from .similarity import SpectrumComparer
+
+# 进程池在多次网格计算之间复用
+_POOL: ProcessPoolExecutor | None = None
+# 进程池的进程数
+_POOL_SIZE = 0
+# 子进程中已经连接的共享内存 {共享内存名称: (共享内存, {数组名称: 数组})}
+_ATTACHED: Dict[str, tuple] = {}
+
+
+def get_pool() -> ProcessPoolExecutor:
+    """
+    获取进程池，第一次调用时创建
+    """
+    global _POOL, _POOL_SIZE
+    if _POOL is None:
+        _POOL_SIZE = max(os.cpu_count() - 1, 1)
+        _POOL = ProcessPoolExecutor(_POOL_SIZE)
+    return _POOL
+
+
+def get_pool_size() -> int:
+    """
+    进程池的进程数，进程池还没有创建时先创建
+    """
+    get_pool()
+    return _POOL_SIZE
+
+
+def shutdown_pool():
+    """
+    关闭进程池，取消尚未开始的任务
+    """
+    global _POOL
+    if _POOL is not None:
+        _POOL.shutdown(cancel_futures=True)
+        _POOL = None
+
+
+atexit.register(shutdown_pool)
+
+
+class SharedArrays:
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        """
+        把一组数组复制到同一块共享内存中，子进程通过 description 连接后即可直接读取，不需要序列化
+        Args:
+            arrays: {数组名称: 数组}
+        """
+        # 每个数组的 (偏移量, 形状, 数据类型)
+        self.layout: Dict[str, tuple] = {}
+        offset = 0
+        for name, value in arrays.items():
+            value = np.asarray(value)
+            self.layout[name] = (offset, value.shape, value.dtype.str)
+            offset += (value.nbytes + 7) // 8 * 8
+        self.shm = shared_memory.SharedMemory(create=True, size=max(offset, 8))
+        for name, value in arrays.items():
+            offset, shape, dtype = self.layout[name]
+            np.ndarray(shape, dtype, buffer=self.shm.buf, offset=offset)[...] = value
+
+    def get(self, name: str) -> np.ndarray:
+        """
+        在主进程中获取数组，可以修改，修改后子进程中可见；关闭前要释放得到的数组
+        """
+        offset, shape, dtype = self.layout[name]
+        return np.ndarray(shape, dtype, buffer=self.shm.buf, offset=offset)
+
+    @property
+    def description(self):
+        """
+        子进程连接共享内存所需要的信息，只有几百字节
+        """
+        return self.shm.name, self.layout
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def attach(description) -> Dict[str, np.ndarray]:
+    """
+    在子进程中连接共享内存，同一块共享内存只连接一次
+    Args:
+        description: SharedArrays.description
+
+    Returns:
+        {数组名称: 数组}，数组直接引用共享内存，不可修改
+    """
+    name, layout = description
+    if name not in _ATTACHED:
+        # 上一次网格计算的共享内存已经不再使用
+        for old in list(_ATTACHED.keys()):
+            shm, arrays = _ATTACHED.pop(old)
+            arrays.clear()
+            shm.close()
+        shm = shared_memory.SharedMemory(name=name)
+        arrays = {}
+        for key, (offset, shape, dtype) in layout.items():
+            arrays[key] = np.ndarray(shape, dtype, buffer=shm.buf, offset=offset)
+            arrays[key].flags.writeable = False
+        _ATTACHED[name] = (shm, arrays)
+    return _ATTACHED[name][1]
+
+
+def cal_cells(description, start: int, stop: int, atom_num: int, metrics: List[str], options: Dict[str, dict]):
+    """
+    在子进程中计算第 start 到 stop-1 个温度下所有密度的相似度
+    同一温度下所有密度的模拟光谱作为一批，一次计算
+    Args:
+        description: SharedArrays.description
+        start: 起始温度的序号
+        stop: 结束温度的序号（不包含）
+        atom_num: 原子序数
+        metrics: 相似度的名称，见 similarity.METRICS
+        options: 各相似度的参数，见 SpectraAdd.get_metric_options
+
+    Returns:
+        start, {名称: 形状为 (密度个数, stop - start) 的相似度}
+    """
+    arrays = attach(description)
+    atom = Atomic(atom_num, 0)
+    comparer = SpectrumComparer(arrays['exp_wavelength'], arrays['exp_intensity'], arrays['wavelength'])
+    result = {name: np.zeros((arrays['density'].shape[0], stop - start)) for name in metrics}
+    for i in range(start, stop):
+        temperature = arrays['temperature'][i]
+        abundance = np.array([atom.get_ion_abundance2(temperature, density) for density in arrays['density']])
+        intensity = abundance[:, arrays['ion']] @ arrays['spectra'][:, i, :]
+        for name, value in comparer.evaluate(intensity, metrics, options).items():
+            result[name][:, i - start] = value
+    return start, result
+
+
+def widen_cells(description, index: int, settings: Dict, start: int, stop: int):
+    """
+    在子进程中展宽第 index 个离子在第 start 到 stop-1 个温度下的 cross_P，见 Widen.widen_lines
+    Args:
+        description: SharedArrays.description
+        index: 离子在 widen_list 中的序号
+        settings: Widen.get_settings
+        start: 起始温度的序号
+        stop: 结束温度的序号（不包含）
+
+    Returns:
+        index, start, 形状为 (stop - start, 网格点数) 的 cross_P
+    """
+    from .data import Widen
+
+    arrays = attach(description)
+    line = {key: arrays[f'line_{index}/{key}'] for key in LINE_KEYS}
+    return index, start, Widen.from_settings(settings).widen_lines(line, arrays['temperature'][start:stop])
+
+
+# Widen.get_line_arrays 中放入共享内存的数组
+LINE_KEYS = ('wave', 'fwhm', 'wavelength', 'intensity', 'energy', 'J', 'min_J')
+
+
+class GridExecutor:
+    def __init__(self, spectra_add, t_values: np.ndarray, n_values: np.ndarray, chunk: int | None = None):
+        """
+        网格计算的执行器
+        prepare 把实验谱和各离子的谱线放入共享内存，子进程按温度分块展宽（见 widen_cells），
+        同一块的所有离子展宽完成后再计算这一块的相似度（见 cal_cells），
+        子进程只接收离子和温度的序号范围，因此每个任务传递的数据只有几百字节
+        'batch' 方式的温度无关部分不超过 Widen.basis_size 时，直接在主进程中用矩阵乘法得到所有温度的 cross_P
+        Args:
+            spectra_add: SpectraAdd 对象
+            t_values: 温度列表
+            n_values: 电子密度列表
+            chunk: 每个任务计算的温度个数，为None时按照进程数自动确定
+        """
+        self.t_values = np.asarray(t_values, dtype=float)
+        self.n_values = np.asarray(n_values, dtype=float)
+        self.atom_num = spectra_add.atom.num
+        self.metrics = list(spectra_add.metrics)
+        self.options = spectra_add.get_metric_options()
+        if chunk is None:
+            chunk = max(1, int(np.ceil(self.t_values.shape[0] / (4 * get_pool_size()))))
+        self.chunk = chunk
+        self.widen_list = spectra_add.widen_list
+        self.exp_data = spectra_add.exp_data
+        self.shared: SharedArrays | None = None
+        # 需要在子进程中展宽的离子 {序号: Widen.get_settings}
+        self.settings: Dict[int, Dict] = {}
+
+        # 尚未提交的块的起始温度序号
+        self.__chunks: List[int] = []
+        # 各块尚未完成的展宽任务数
+        self.__waiting: Dict[int, int] = {}
+        # 已经提交的任务 {Future: 'widen' 或 'cells'}
+        self.__tasks: Dict[Future, str] = {}
+
+    def prepare(self, cancel_event: threading.Event | None = None) -> bool:
+        """
+        准备共享内存，每个离子之前检查是否取消
+        Args:
+            cancel_event: 取消计算的事件
+
+        Returns:
+            是否完成，取消时返回 False
+        """
+        wavelength = None
+        spectra = np.zeros((len(self.widen_list), self.t_values.shape[0], 0))
+        arrays = {}
+        ion = []
+        for index, widen in enumerate(self.widen_list):
+            if cancel_event is not None and cancel_event.is_set():
+                return False
+            basis = widen.get_temperature_basis() if widen.method == 'batch' else None
+            if basis is not None:
+                temp = basis['wavelength']
+                factor = np.exp(-np.outer(basis['energy'], 0.124 / self.t_values))
+                value = (basis['basis'] @ factor).T
+            else:
+                line = widen.get_line_arrays()
+                if line is None:
+                    raise ValueError(f'{widen.name} 在实验数据的范围内没有跃迁')
+                temp = 1239.85 / line['wave']
+                value = None
+                arrays.update({f'line_{index}/{key}': line[key] for key in LINE_KEYS})
+                self.settings[index] = widen.get_settings()
+            if wavelength is None:
+                wavelength = temp
+                spectra = np.zeros((len(self.widen_list), self.t_values.shape[0], wavelength.shape[0]))
+            if value is not None:
+                spectra[index] = value
+            ion.append(int(widen.name.split('_')[-1]))
+        exp_data = self.exp_data.data
+        self.shared = SharedArrays({
+            'temperature': self.t_values,
+            'density': self.n_values,
+            'wavelength': wavelength,
+            'spectra': spectra,
+            'ion': np.array(ion),
+            'exp_wavelength': exp_data['wavelength'].values.astype(float),
+            'exp_intensity': exp_data['intensity'].values.astype(float),
+            **arrays,
+        })
+        return True
+
+    def submit(self) -> List[Future]:
+        """
+        开始提交任务，为了让结果按块陆续返回，同时提交的任务不超过进程数的两倍，
+        其余的任务在 collect 中随着已有的任务完成陆续提交
+        Returns:
+            已经提交的任务对应的 Future，完成后交给 collect 处理
+        """
+        self.__chunks = list(range(0, self.t_values.shape[0], self.chunk))
+        self.__waiting = {}
+        self.__tasks = {}
+        return self.__fill()
+
+    def collect(self, future: Future):
+        """
+        处理完成的任务：展宽任务的结果写入共享内存，一块的所有离子都展宽完成后提交这一块的相似度任务
+        Args:
+            future: submit 或 collect 返回的 Future
+
+        Returns:
+            futures: 新提交的任务
+            result: 相似度任务的结果 (start, {名称: 相似度})，见 cal_cells；展宽任务为None
+        """
+        kind = self.__tasks.pop(future)
+        if kind == 'cells':
+            return self.__fill(), future.result()
+        index, start, value = future.result()
+        spectra = self.shared.get('spectra')
+        spectra[index, start:start + value.shape[0]] = value
+        del spectra
+        self.__waiting[start] -= 1
+        futures = []
+        if self.__waiting[start] == 0:
+            del self.__waiting[start]
+            futures.append(self.__submit_cells(start))
+        return futures + self.__fill(), None
+
+    def __fill(self) -> List[Future]:
+        futures = []
+        pool = get_pool()
+        while self.__chunks and len(self.__tasks) < 2 * get_pool_size():
+            start = self.__chunks.pop(0)
+            if not self.settings:
+                futures.append(self.__submit_cells(start))
+                continue
+            stop = min(start + self.chunk, self.t_values.shape[0])
+            self.__waiting[start] = len(self.settings)
+            for index, settings in self.settings.items():
+                future = pool.submit(widen_cells, self.shared.description, index, settings, start, stop)
+                self.__tasks[future] = 'widen'
+                futures.append(future)
+        return futures
+
+    def __submit_cells(self, start: int) -> Future:
+        stop = min(start + self.chunk, self.t_values.shape[0])
+        future = get_pool().submit(cal_cells, self.shared.description, start, stop, self.atom_num,
+                                   self.metrics, self.options)
+        self.__tasks[future] = 'cells'
+        return future
+
+    def close(self):
+        if self.shared is not None:
+            self.shared.close()
+            self.shared = None
+
+
+class GridScheduler:
+    def __init__(self, spectra_add, t_values: np.ndarray, n_values: np.ndarray, chunk: int | None = None,
+                 cancel_event: threading.Event | None = None):
+        """
+        网格计算的调度器
+        按温度分块提交给进程池，每完成一块就通过回调函数返回结果，可以随时取消
+        Args:
+            spectra_add: SpectraAdd 对象
+            t_values: 温度列表
+            n_values: 电子密度列表
+            chunk: 每块计算的温度个数，见 GridExecutor
+            cancel_event: 取消计算的事件，为None时新建，可以与其他调度器共用（见 AdaptiveScheduler）
+        """
+        self.spectra_add = spectra_add
+        self.t_values = np.asarray(t_values, dtype=float)
+        self.n_values = np.asarray(n_values, dtype=float)
+        self.chunk = chunk
+        # 计算结果 {名称: 相似度}，尚未完成的位置为nan
+        self.results = {name: np.full((self.n_values.shape[0], self.t_values.shape[0]), np.nan)
+                        for name in spectra_add.metrics}
+        # 第一个相似度的计算结果
+        self.result = self.results[spectra_add.metrics[0]]
+        self.cancelled = False
+        self.error: Exception | None = None
+
+        self.__cancel_event = cancel_event or threading.Event()
+        self.__thread: threading.Thread | None = None
+
+    def run(self, on_result: Callable[[int, np.ndarray], None] | None = None) -> bool:
+        """
+        在当前线程中计算，直到全部完成或者被取消
+        Args:
+            on_result: 每完成一块调用一次，参数为起始温度的序号和第一个相似度形状为 (密度个数, 温度个数) 的结果
+
+        Returns:
+            是否全部完成
+        """
+        executor = GridExecutor(self.spectra_add, self.t_values, self.n_values, self.chunk)
+        pending = set()
+        try:
+            if executor.prepare(self.__cancel_event):
+                pending = set(executor.submit())
+            while pending and not self.__cancel_event.is_set():
+                done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    futures, result = executor.collect(future)
+                    pending.update(futures)
+                    if result is None:
+                        continue
+                    start, blocks = result
+                    for name, block in blocks.items():
+                        self.results[name][:, start:start + block.shape[1]] = block
+                    if on_result is not None:
+                        on_result(start, blocks[executor.metrics[0]])
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.close()
+        self.cancelled = self.__cancel_event.is_set()
+        return not self.cancelled
+
+    def start(self,
+              on_result: Callable[[int, np.ndarray], None] | None = None,
+              on_finished: Callable[['GridScheduler'], None] | None = None):
+        """
+        在后台线程中计算，回调函数也在后台线程中调用
+        Args:
+            on_result: 见 run
+            on_finished: 结束（完成、取消或出错）时调用，参数为调度器本身
+        """
+        def target():
+            try:
+                self.run(on_result)
+            except Exception as e:
+                self.error = e
+            if on_finished is not None:
+                on_finished(self)
+
+        self.__thread = threading.Thread(target=target, daemon=True)
+        self.__thread.start()
+
+    def cancel(self):
+        """
+        取消计算，尚未开始的块不再计算，已经开始的块的结果被丢弃
+        """
+        self.__cancel_event.set()
+
+    def is_running(self) -> bool:
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def wait(self):
+        if self.__thread is not None:
+            self.__thread.join()
+
+
+class SearchCancelled(Exception):
+    """
+    自适应搜索被取消
+    """
+
+
+class ProgressCallback:
+    def __init__(self, fun: Callable[[float], None]):
+        """
+        把回调函数包装成有 setValue 方法的进度条
+        """
+        self.setValue = fun
+
+
+class AdaptiveScheduler:
+    def __init__(self, spectra_add, t_range, n_range, **options):
+        """
+        自适应搜索的调度器，见 SpectraAdd.get_adaptive_search
+        每一轮的点作为一个小网格交给 GridScheduler 在进程池中计算，可以在后台线程中运行并随时取消
+        Args:
+            spectra_add: SpectraAdd 对象
+            t_range: 温度范围 (最小值, 最大值)
+            n_range: 电子密度范围 (最小值, 最大值)
+            **options: get_adaptive_search 的其他参数
+        """
+        self.spectra_add = spectra_add
+        self.t_range = t_range
+        self.n_range = n_range
+        self.options = options
+        # 最佳的 (温度, 电子密度, 相似度)，完成后才有值
+        self.best: tuple | None = None
+        self.cancelled = False
+        self.error: Exception | None = None
+
+        self.__cancel_event = threading.Event()
+        self.__thread: threading.Thread | None = None
+
+    def run(self, on_progress: Callable[[float], None] | None = None) -> bool:
+        """
+        在当前线程中搜索，直到完成或者被取消
+        Args:
+            on_progress: 每完成一轮调用一次，参数为进度（0~100）
+
+        Returns:
+            是否完成
+        """
+        try:
+            self.best = self.spectra_add.get_adaptive_search(
+                self.t_range, self.n_range, pbar=None if on_progress is None else ProgressCallback(on_progress),
+                plot=False, cancel_event=self.__cancel_event, **self.options)
+        except SearchCancelled:
+            pass
+        self.cancelled = self.__cancel_event.is_set()
+        return not self.cancelled
+
+    def start(self,
+              on_progress: Callable[[float], None] | None = None,
+              on_finished: Callable[['AdaptiveScheduler'], None] | None = None):
+        """
+        在后台线程中搜索，回调函数也在后台线程中调用
+        Args:
+            on_progress: 见 run
+            on_finished: 结束（完成、取消或出错）时调用，参数为调度器本身
+        """
+        def target():
+            try:
+                self.run(on_progress)
+            except Exception as e:
+                self.error = e
+            if on_finished is not None:
+                on_finished(self)
+
+        self.__thread = threading.Thread(target=target, daemon=True)
+        self.__thread.start()
+
+    def cancel(self):
+        """
+        取消搜索，正在计算的网格随之取消
+        """
+        self.__cancel_event.set()
+
+    def is_running(self) -> bool:
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def wait(self):
+        if self.__thread is not None:
+            self.__thread.join()
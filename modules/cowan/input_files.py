@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import List
+from typing import Dict, List
 
 from .atom import ANGULAR_QUANTUM_NUM_NAME, ATOM
 
@@ -21,7 +21,7 @@ class In36:
         with open(path, 'r') as f:
             lines = f.readlines()
         # 控制卡读入
-        control_card_text = lines[0]
+        control_card_text = lines[0].rstrip('\n')
         control_card_list = []
         if len(control_card_text) != 80:
             control_card_text += ' ' * (80 - len(control_card_text))
@@ -127,6 +127,26 @@ class In36:
             parity_list.append(self.__judge_parity(v[-1]))
         self.parity = parity_list
 
+    def get_state(self) -> Dict:
+        """
+        保存到项目文件中的状态，见 store.ProjectStore
+        """
+        return {'control_card': list(self.control_card),
+                'configuration_card': [list(v) for v in self.configuration_card],
+                'atomic_num': self.atomic_num,
+                'atomic_ion': self.atomic_ion,
+                'parity': list(self.parity)}
+
+    @classmethod
+    def from_state(cls, state: Dict) -> 'In36':
+        in36 = cls()
+        in36.control_card = list(state['control_card'])
+        in36.configuration_card = [list(v) for v in state['configuration_card']]
+        in36.atomic_num = state['atomic_num']
+        in36.atomic_ion = state['atomic_ion']
+        in36.parity = list(state['parity'])
+        return in36
+
 
 class In2:
     def __init__(self):
@@ -152,6 +172,15 @@ class In2:
         in2 += '        -1\n'
         return in2
 
+    def get_state(self) -> Dict:
+        return {'input_card': list(self.input_card)}
+
+    @classmethod
+    def from_state(cls, state: Dict) -> 'In2':
+        in2 = cls()
+        in2.input_card = list(state['input_card'])
+        return in2
+
     def save_as_in2(self, path: Path):
         with open(path, 'w', encoding='utf-8') as f:
             f.write(self.get_in2_text())
@@ -0,0 +1,280 @@
+# 不依赖界面的拟合流程
+import argparse
+import json
+from pathlib import Path
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from .atom import Atomic
+from .batch import BatchRunner, load_jobs
+from .data import ExpData, CalData, Widen, SpectraAdd
+from .input_files import In36
+from .run import Recorder
+from .store import load_objects
+
+
+def load_config(path: Path) -> Dict:
+    """
+    读取拟合的配置文件（json），格式为：
+    {
+        "exp_data": "exp_data.csv",         # 实验谱，相对路径相对于项目路径
+        "x_range": [8.0, 14.0],             # 可选，实验谱的范围，单位是nm
+        "jobs": "jobs.json",                # 可选，先批量运行 Cowan，格式见 batch.load_jobs
+        "names": ["Al_3", "Al_4"],          # 可选，参与叠加的计算结果，默认为 jobs 中的全部任务
+        "atom": 13,                         # 可选，原子序数，默认由第一个计算结果的 in36 得到
+        "widen": {"n": 500},                # 可选，Widen 的参数
+        "metrics": ["dtw"],                 # 可选，相似度，第一个用于寻找最佳点
+        "dtw": {"method": "band"},          # 可选，DTW 的 method、window、prune，见 SpectraAdd.spectrum_similarity3
+        "temperature": [10, 50, 20],        # 温度的 [最小值, 最大值, 个数]
+        "density": [1e19, 1e22, 20],        # 电子密度的 [最小值, 最大值, 个数]，按对数均匀分布
+        "adaptive": false,                  # 可选，是否使用自适应搜索代替整个网格
+        "output": "fit_result",             # 可选，结果的保存路径，相对路径相对于项目路径
+        "plot": false                       # 可选，是否绘图
+    }
+    Args:
+        path: 配置文件的路径
+
+    Returns:
+        配置，jobs 为文件路径时转换为相对于配置文件所在文件夹的路径，其余相对路径在使用时相对于项目路径
+    """
+    path = Path(path)
+    config = json.loads(path.read_text(encoding='utf-8'))
+    if isinstance(config.get('jobs'), str):
+        jobs = Path(config['jobs'])
+        config['jobs'] = jobs if jobs.is_absolute() else path.parent / jobs
+    return config
+
+
+class FitPipeline:
+    def __init__(self, project_path: Path, config: Dict | None = None):
+        """
+        与界面相同的拟合流程：读取实验谱 -> （批量运行 Cowan）-> 读取计算结果并展宽 -> 叠加并计算温度-密度网格
+        不导入 Qt，只有在 plot 为 True 时才导入 plotly
+        配置中没有给出的实验谱、计算结果和原子，从项目保存的状态中读取（见 store.load_objects）
+        Args:
+            project_path: 项目路径
+            config: 配置，格式见 load_config
+        """
+        self.project_path = Path(project_path)
+        self.config = dict(config or {})
+        self.plot = self.config.get('plot', False)
+
+        self.recorder: Recorder | None = None
+        self.exp_data: ExpData | None = None
+        self.atom: Atomic | None = None
+        self.spectra_add: SpectraAdd | None = None
+        self.batch_summary: List[Dict] = []
+        # fit 的结果
+        self.result: Dict | None = None
+
+        self.__project = None
+
+    def __get_project(self) -> Dict:
+        """
+        项目保存的状态，没有时为空字典
+        """
+        if self.__project is None:
+            try:
+                self.__project = load_objects(self.project_path / '.cowan/obj_info', self.project_path)
+            except Exception:
+                self.__project = {}
+        return self.__project
+
+    def load_exp_data(self) -> ExpData:
+        if 'exp_data' in self.config:
+            path = Path(self.config['exp_data'])
+            path = path if path.is_absolute() else self.project_path / path
+            self.exp_data = ExpData(self.project_path, path, plot=self.plot)
+        else:
+            self.exp_data = self.__get_project().get('exp_data')
+            if self.exp_data is None:
+                raise ValueError('没有指定实验谱，项目中也没有保存实验谱')
+        if 'x_range' in self.config:
+            self.exp_data.set_range(self.config['x_range'], plot=self.plot)
+        return self.exp_data
+
+    def run_jobs(self, on_output: Callable[[str, str, str], None] | None = None,
+                 on_job_finished: Callable[[Dict], None] | None = None,
+                 max_workers: int | None = None) -> List[Dict]:
+        """
+        批量运行配置中的任务，没有任务时直接返回
+        Returns:
+            每个任务的结果，见 BatchRunner.run
+        """
+        if not self.config.get('jobs'):
+            return []
+        jobs = self.config['jobs']
+        jobs = load_jobs(jobs) if isinstance(jobs, (str, Path)) else {'in36': None, 'in2': None, 'workers': None,
+                                                                      'jobs': jobs}
+        runner = BatchRunner(self.project_path, jobs['jobs'], jobs['in36'], jobs['in2'],
+                             recorder=self.__get_recorder(), max_workers=max_workers or jobs['workers'])
+        self.batch_summary = runner.run(on_output, on_job_finished)
+        if 'names' not in self.config:
+            self.config['names'] = [run.name for run in runner.runs]
+        failed = [result['name'] for result in self.batch_summary if result['state'] != 'finished']
+        if failed:
+            raise RuntimeError('以下任务没有完成：{}'.format(', '.join(failed)))
+        return self.batch_summary
+
+    def __get_recorder(self) -> Recorder:
+        if self.recorder is None:
+            self.recorder = self.__get_project().get('recorder') or Recorder(self.project_path)
+        return self.recorder
+
+    def get_names(self) -> List[str]:
+        """
+        参与叠加的计算结果，默认为项目中选择的计算结果
+        """
+        names = self.config.get('names') or self.__get_recorder().selection
+        if not names:
+            raise ValueError('没有指定参与叠加的计算结果')
+        return list(names)
+
+    def get_atom(self, names: List[str]) -> Atomic:
+        if 'atom' in self.config:
+            return Atomic(self.config['atom'], 0)
+        project_atom = self.__get_project().get('atom')
+        if project_atom is not None:
+            return project_atom
+        # 由第一个计算结果的 in36 得到原子序数
+        in36 = In36()
+        in36.read_from_file(self.project_path / f'cal_result/{names[0]}/in36')
+        return Atomic(in36.atomic_num, 0)
+
+    def build_spectra_add(self) -> SpectraAdd:
+        if self.exp_data is None:
+            self.load_exp_data()
+        names = self.get_names()
+        self.atom = self.get_atom(names)
+        widen_list = [Widen(self.project_path, self.exp_data,
+                            CalData(self.project_path, self.exp_data, name, plot=self.plot),
+                            **self.config.get('widen', {}))
+                      for name in names]
+        self.spectra_add = SpectraAdd(self.project_path, self.atom, self.exp_data, widen_list)
+        self.spectra_add.metrics = list(self.config.get('metrics', self.spectra_add.metrics))
+        dtw = self.config.get('dtw', {})
+        for key in ['method', 'window', 'prune']:
+            if key in dtw:
+                setattr(self.spectra_add, f'dtw_{key}', dtw[key])
+        return self.spectra_add
+
+    def fit(self, pbar=None) -> Dict:
+        """
+        计算温度-密度网格（或自适应搜索），并在最佳点叠加光谱
+        Args:
+            pbar: 进度条，需要有 setValue 方法
+
+        Returns:
+            {'temperature': 最佳温度, 'density': 最佳电子密度, 'similarities': {相似度名称: 值}}
+        """
+        if self.spectra_add is None:
+            self.build_spectra_add()
+        t_min, t_max, t_num = self.config['temperature']
+        n_min, n_max, n_num = self.config['density']
+        spectra_add = self.spectra_add
+        if self.config.get('adaptive', False):
+            temperature, density, _ = spectra_add.get_adaptive_search((t_min, t_max), (n_min, n_max),
+                                                                      pbar=pbar, plot=self.plot)
+        else:
+            t_values = np.linspace(t_min, t_max, int(t_num))
+            n_values = np.power(10, np.linspace(np.log10(n_min), np.log10(n_max), int(n_num)))
+            spectra_add.get_cal_grid(n_values, t_values, pbar=pbar, plot=self.plot)
+            grid = spectra_add.grid_data['grid_data']
+            i, j = np.unravel_index(np.nanargmax(grid) if spectra_add.is_higher_better() else np.nanargmin(grid),
+                                    grid.shape)
+            temperature, density = float(t_values[j]), float(n_values[i])
+            spectra_add.get_add_data(temperature, density)
+        if self.plot:
+            spectra_add.plot_html()
+        self.result = {
+            'temperature': float(temperature),
+            'density': float(density),
+            'similarities': {name: float(value) for name, value in spectra_add.similarities.items()},
+        }
+        return self.result
+
+    def save(self, output: Path | None = None) -> Path:
+        """
+        保存结果：
+            result.json: 最佳点及其相似度
+            spectrum.csv: 最佳点的叠加光谱
+            grid.npz: 温度、密度以及各相似度的网格（自适应搜索时为粗网格和计算过的所有点）
+        Args:
+            output: 保存的文件夹，为None时使用配置中的 output
+
+        Returns:
+            保存的文件夹
+        """
+        output = Path(output or self.config.get('output', 'fit_result'))
+        output = output if output.is_absolute() else self.project_path / output
+        output.mkdir(parents=True, exist_ok=True)
+        spectra_add = self.spectra_add
+        (output / 'result.json').write_text(json.dumps(
+            dict(self.result, names=self.get_names(), metrics=spectra_add.metrics, batch=self.batch_summary),
+            ensure_ascii=False, indent=2), encoding='utf-8')
+        spectra_add.result.to_csv(output / 'spectrum.csv', index=False)
+        arrays = {'temperature': spectra_add.grid_data['temperature'],
+                  'density': spectra_add.grid_data['density'],
+                  'grid': spectra_add.grid_data['grid_data']}
+        arrays.update({f'grid_{name}': value for name, value in spectra_add.grid_data['metrics'].items()})
+        if spectra_add.search_data is not None:
+            arrays.update({f'search_{key}': spectra_add.search_data[key].values
+                           for key in spectra_add.search_data.columns})
+        np.savez(output / 'grid.npz', **arrays)
+        return output
+
+    def run(self, on_output: Callable[[str, str, str], None] | None = None,
+            on_job_finished: Callable[[Dict], None] | None = None, max_workers: int | None = None) -> Dict:
+        """
+        依次执行整个流程并保存结果
+        """
+        self.load_exp_data()
+        self.run_jobs(on_output, on_job_finished, max_workers)
+        self.build_spectra_add()
+        result = self.fit()
+        self.save()
+        return result
+
+
+def main(argv: List[str] | None = None):
+    parser = argparse.ArgumentParser(description='不打开界面进行拟合')
+    parser.add_argument('project', help='项目路径')
+    parser.add_argument('config', nargs='?', default=None, help='配置文件（json），格式见 load_config')
+    parser.add_argument('-t', '--temperature', type=float, nargs=3, metavar=('MIN', 'MAX', 'NUM'), help='温度范围')
+    parser.add_argument('-n', '--density', type=float, nargs=3, metavar=('MIN', 'MAX', 'NUM'), help='电子密度范围')
+    parser.add_argument('-m', '--metrics', nargs='+', default=None, help='相似度')
+    parser.add_argument('-a', '--adaptive', action='store_true', help='使用自适应搜索')
+    parser.add_argument('-o', '--output', default=None, help='结果的保存路径')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='同时运行的 Cowan 任务数')
+    parser.add_argument('-p', '--plot', action='store_true', help='绘图')
+    parser.add_argument('-v', '--verbose', action='store_true', help='显示 Cowan 程序的输出')
+    args = parser.parse_args(argv)
+
+    config = load_config(Path(args.config)) if args.config else {}
+    for key in ['temperature', 'density', 'metrics', 'output']:
+        if getattr(args, key) is not None:
+            config[key] = getattr(args, key)
+    if args.adaptive:
+        config['adaptive'] = True
+    if args.plot:
+        config['plot'] = True
+    if 'temperature' not in config or 'density' not in config:
+        parser.error('需要在配置文件或参数中给出温度和电子密度的范围')
+
+    def on_output(name, stage, line):
+        print(f'[{name} {stage}] {line}', flush=True)
+
+    def on_job_finished(result):
+        print('{} {} {:.1f} s'.format(result['name'], result['state'], result['time']), flush=True)
+
+    pipeline = FitPipeline(Path(args.project), config)
+    result = pipeline.run(on_output if args.verbose else None, on_job_finished, args.workers)
+    print('最佳温度：{:.3f}，最佳密度：{:.3e}'.format(result['temperature'], result['density']))
+    for name, value in result['similarities'].items():
+        print(f'{name}: {value:.6g}')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,8 +1,12 @@
+import hashlib
 import json
-import os
 import shutil
 import subprocess
+import tempfile
+import threading
+import time
 from pathlib import Path
+from typing import Callable, Dict, List
 
 from .input_files import In36, In2
 
@@ -27,14 +31,147 @@ class Recorder:
     def del_selection(self, index):
         self.selection.pop(index)
 
+    def get_state(self) -> Dict:
+        """
+        保存到项目文件中的状态，见 store.ProjectStore
+        """
+        return {'run_history': list(self.run_history), 'selection': list(self.selection)}
+
+    @classmethod
+    def from_state(cls, state: Dict, path) -> 'Recorder':
+        recorder = cls(path)
+        recorder.run_history = list(state['run_history'])
+        recorder.selection = list(state['selection'])
+        return recorder
+
+
+# 文件的哈希值 {路径: (大小, 修改时间, 哈希值)}，文件没有变化时不重新计算
+_FILE_HASH: Dict[str, tuple] = {}
+
+
+def file_hash(path: Path) -> str:
+    """
+    计算文件内容的 sha256，文件的大小和修改时间不变时直接使用上次的结果
+    """
+    stat = path.stat()
+    cached = _FILE_HASH.get(path.as_posix())
+    if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+        return cached[2]
+    value = hashlib.sha256(path.read_bytes()).hexdigest()
+    _FILE_HASH[path.as_posix()] = (stat.st_size, stat.st_mtime_ns, value)
+    return value
+
+
+class RunCache:
+    def __init__(self, project_path: Path, max_size=2 * 1024 ** 3, max_age=30 * 24 * 3600):
+        """
+        Cowan 计算结果的缓存，保存在 .cowan/run_cache/<键> 中
+        键由 in36、in2 的内容，耦合方式和 bin 中的程序共同决定，输入完全相同时直接复制上次的结果
+        Args:
+            project_path: 项目路径
+            max_size: 缓存的最大总大小（字节），超过时删除最久没有使用的结果
+            max_age: 超过这么多秒没有使用的结果会被删除
+        """
+        self.project_path = project_path
+        self.root = self.project_path / '.cowan/run_cache'
+        self.max_size = max_size
+        self.max_age = max_age
+
+    def get_key(self, in36: In36, in2: In2, coupling_mode: int) -> str:
+        sha = hashlib.sha256()
+        sha.update(in36.get_in36_text().encode('utf-8'))
+        sha.update(b'\0')
+        sha.update(in2.get_in2_text().encode('utf-8'))
+        sha.update(f'\0{coupling_mode}\0'.encode('utf-8'))
+        for path in sorted((self.project_path / 'bin').iterdir()):
+            if path.is_file():
+                sha.update(f'{path.name}:{file_hash(path)}\0'.encode('utf-8'))
+        return sha.hexdigest()
+
+    def get(self, key: str, run_path: Path) -> bool:
+        """
+        把缓存的结果复制到 run_path 中
+        Returns:
+            是否命中
+        """
+        entry = self.root / key
+        meta_path = entry / 'meta.json'
+        if not meta_path.exists():
+            return False
+        try:
+            meta = json.loads(meta_path.read_text(encoding='utf-8'))
+            shutil.copytree(entry / 'files', run_path, dirs_exist_ok=True)
+            meta['last_used'] = time.time()
+            meta_path.write_text(json.dumps(meta), encoding='utf-8')
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def put(self, key: str, run_path: Path):
+        """
+        保存 run_path 中的计算结果（程序本身除外），保存后按照大小和时间清理缓存
+        """
+        entry = self.root / key
+        if entry.exists():
+            return
+        self.root.mkdir(parents=True, exist_ok=True)
+        # 先写到临时文件夹中再重命名，避免其他计算读到不完整的结果
+        temp = Path(tempfile.mkdtemp(dir=self.root, prefix='.tmp_'))
+        try:
+            shutil.copytree(run_path, temp / 'files', ignore=shutil.ignore_patterns('*.exe', 'obj_info*'))
+            size = sum(path.stat().st_size for path in (temp / 'files').rglob('*') if path.is_file())
+            meta = {'name': run_path.name, 'size': size, 'created': time.time(), 'last_used': time.time()}
+            (temp / 'meta.json').write_text(json.dumps(meta), encoding='utf-8')
+            temp.rename(entry)
+        except OSError:
+            shutil.rmtree(temp, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        """
+        删除超过 max_age 没有使用的结果，然后从最久没有使用的开始删除，直到总大小不超过 max_size
+        """
+        if not self.root.exists():
+            return
+        entries = []
+        for entry in self.root.iterdir():
+            try:
+                meta = json.loads((entry / 'meta.json').read_text(encoding='utf-8'))
+            except (OSError, ValueError):
+                # 残留的临时文件夹
+                if entry.name.startswith('.tmp_') and time.time() - entry.stat().st_mtime > 24 * 3600:
+                    shutil.rmtree(entry, ignore_errors=True)
+                continue
+            entries.append((meta['last_used'], meta['size'], entry))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        for last_used, size, entry in entries:
+            if now - last_used <= self.max_age and total <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
 
 class Run:
-    def __init__(self, project_path: Path, name: str, in36: In36, in2: In2, recorder: Recorder, coupling_mode=1, ):
+    # 依次运行的程序
+    STAGES = ['RCN', 'RCN2', 'RCG']
+    # 各阶段的输入和输出记录，保存在运行目录中
+    STAGE_FILE = '.stages.json'
+
+    def __init__(self, project_path: Path, name: str, in36: In36, in2: In2, recorder: Recorder, coupling_mode=1,
+                 auto_run=True, use_cache=True):
         """
 
         Args:
             name: 此次运行的名称
             coupling_mode: 1是L-S耦合 2是j-j耦合
+            auto_run: 是否在创建时立即运行，为False时需要调用 run 或者交给 RunManager
+            use_cache: 输入与以前的某次计算完全相同时是否直接使用其结果，见 RunCache
         """
         self.name = name
         self.in36 = in36
@@ -46,34 +183,308 @@ class Run:
 
         self.coupling_mode = coupling_mode  # 1是L-S耦合 2是j-j耦合
 
+        # 运行状态：ready, running, finished, failed, cancelled
+        self.state = 'ready'
+        # 各个程序的返回值
+        self.return_codes: Dict[str, int] = {}
+        self.use_cache = use_cache
+        # 结果是否来自缓存
+        self.from_cache = False
+        # 输入没有变化而跳过的程序
+        self.skipped_stages: List[str] = []
+
+        self.__process: subprocess.Popen | None = None
+        self.__cancelled = False
+        self.__lock = threading.Lock()
+
+        if auto_run:
+            self.run()
+
+    def __getstate__(self):
+        # 正在运行的进程和锁不能保存
+        state = self.__dict__.copy()
+        state.pop('_Run__process', None)
+        state.pop('_Run__lock', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault('state', 'finished')
+        self.__dict__.setdefault('return_codes', {})
+        self.__dict__.setdefault('use_cache', True)
+        self.__dict__.setdefault('from_cache', False)
+        self.__dict__.setdefault('skipped_stages', [])
+        self.__process = None
+        self.__cancelled = False
+        self.__lock = threading.Lock()
+
+    def get_state(self) -> Dict:
+        """
+        保存到项目文件中的状态，见 store.ProjectStore
+        """
+        return {'name': self.name,
+                'in36': self.in36.get_state(),
+                'in2': self.in2.get_state(),
+                'coupling_mode': self.coupling_mode,
+                'use_cache': self.use_cache,
+                'state': 'finished' if self.state == 'running' else self.state,
+                'return_codes': dict(self.return_codes),
+                'from_cache': self.from_cache,
+                'skipped_stages': list(self.skipped_stages)}
+
+    @classmethod
+    def from_state(cls, state: Dict, project_path: Path, recorder: Recorder) -> 'Run':
+        run = cls(project_path=project_path,
+                  name=state['name'],
+                  in36=In36.from_state(state['in36']),
+                  in2=In2.from_state(state['in2']),
+                  recorder=recorder,
+                  coupling_mode=state['coupling_mode'],
+                  auto_run=False,
+                  use_cache=state['use_cache'])
+        run.state = state['state']
+        run.return_codes = dict(state['return_codes'])
+        run.from_cache = state['from_cache']
+        run.skipped_stages = list(state['skipped_stages'])
+        return run
+
+    def run(self, on_output: Callable[[str, str], None] | None = None,
+            on_stage: Callable[[str], None] | None = None) -> bool:
+        """
+        依次运行 RCN、RCN2、RCG，在当前线程中等待
+        程序的工作目录通过 cwd 指定，不改变当前进程的工作目录，因此多个计算可以在不同线程中同时进行
+        运行目录中上一次计算的某个阶段的输入没有变化、输出也没有被改动时，跳过该阶段，见 get_stage_signatures
+        Args:
+            on_output: 程序每输出一行调用一次，参数为程序名称和这一行的内容（标准输出和标准错误合并）
+            on_stage: 每个程序开始运行时调用，参数为程序名称
+
+        Returns:
+            是否全部完成，被取消或者某个程序的返回值不为0时返回False（state 分别为 cancelled 和 failed）
+        """
+        self.__cancelled = False
+        self.state = 'running'
+        self.return_codes = {}
+        self.from_cache = False
+        self.skipped_stages = []
         self.__get_ready()
-        self.__run()
+
+        cache = RunCache(self.project_path) if self.use_cache else None
+        key = cache.get_key(self.in36, self.in2, self.coupling_mode) if cache else None
+        if cache is not None and cache.get(key, self.run_path):
+            if on_output is not None:
+                on_output('cache', f'输入与以前的计算相同，使用缓存的结果 {key[:12]}')
+            self.from_cache = True
+            self.recorder.add_history(self.name)
+            self.state = 'finished'
+            return True
+
+        signatures = self.get_stage_signatures()
+        records = self.__load_stage_records()
+        # 某一阶段重新运行后，之后的阶段都要重新运行
+        rerun = False
+        for stage in self.STAGES:
+            if self.__cancelled:
+                break
+            if not rerun and self.__is_stage_valid(stage, signatures[stage], records.get(stage)):
+                self.skipped_stages.append(stage)
+                if on_output is not None:
+                    on_output(stage, '输入没有变化，使用上一次的结果')
+                continue
+            rerun = True
+            # 先删除这一阶段及之后的记录，被取消或者出错时不会留下错误的记录
+            for key in self.STAGES[self.STAGES.index(stage):]:
+                records.pop(key, None)
+            self.__save_stage_records(records)
+            if stage == 'RCG':
+                self.__edit_ing11()
+            if on_stage is not None:
+                on_stage(stage)
+            before = self.__snapshot()
+            self.__run_stage(stage, on_output)
+            # 出错后之后的程序没有正确的输入，不再运行
+            if self.__cancelled or self.return_codes.get(stage) != 0:
+                break
+            after = self.__snapshot()
+            outputs = [name for name, value in after.items() if before.get(name) != value]
+            records[stage] = {
+                'signature': signatures[stage],
+                'outputs': {name: file_hash(self.run_path / name) for name in outputs},
+            }
+            self.__save_stage_records(records)
+        if self.__cancelled:
+            self.state = 'cancelled'
+            return False
+        if self.get_failed_stages():
+            self.state = 'failed'
+            return False
+        if cache is not None:
+            cache.put(key, self.run_path)
         self.recorder.add_history(self.name)
+        self.state = 'finished'
+        return True
+
+    def get_failed_stages(self) -> Dict[str, int]:
+        """
+        返回值不为0的程序 {程序名称: 返回值}
+        """
+        return {stage: code for stage, code in self.return_codes.items() if code != 0}
+
+    def cancel(self):
+        """
+        取消计算，正在运行的程序会被终止，可以在其他线程中调用
+        """
+        with self.__lock:
+            self.__cancelled = True
+            if self.__process is not None and self.__process.poll() is None:
+                self.__process.terminate()
+
+    def get_stage_signatures(self) -> Dict[str, str]:
+        """
+        各阶段输入的签名，每一阶段的签名包含上一阶段的签名：
+        RCN: in36 + bin 中的数据文件 + RCN.exe
+        RCN2: RCN + in2 + RCN2.exe
+        RCG: RCN2 + 耦合方式 + RCG.exe
+        """
+        bin_path = self.project_path / 'bin'
+        data_files = ''.join(f'{path.name}:{file_hash(path)}\0' for path in sorted(bin_path.iterdir())
+                             if path.is_file() and path.suffix != '.exe')
+        inputs = {
+            'RCN': self.in36.get_in36_text() + '\0' + data_files,
+            'RCN2': self.in2.get_in2_text(),
+            'RCG': str(self.coupling_mode),
+        }
+        signatures = {}
+        previous = ''
+        for stage in self.STAGES:
+            text = f'{previous}\0{inputs[stage]}\0{file_hash(bin_path / f"{stage}.exe")}'
+            previous = hashlib.sha256(text.encode('utf-8')).hexdigest()
+            signatures[stage] = previous
+        return signatures
+
+    def __is_stage_valid(self, stage: str, signature: str, record: Dict | None) -> bool:
+        """
+        判断上一次的某一阶段是否可以直接使用：签名相同，并且输出的文件都在、没有被改动
+        """
+        if record is None or record['signature'] != signature:
+            return False
+        for name, value in record['outputs'].items():
+            path = self.run_path / name
+            if not path.exists():
+                return False
+            # out2ing 的开头会在运行 RCG 之前按照耦合方式修改，只检查是否存在
+            if name != 'out2ing' and file_hash(path) != value:
+                return False
+        return True
+
+    def __load_stage_records(self) -> Dict:
+        try:
+            return json.loads((self.run_path / self.STAGE_FILE).read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return {}
+
+    def __save_stage_records(self, records: Dict):
+        (self.run_path / self.STAGE_FILE).write_text(json.dumps(records, indent=2), encoding='utf-8')
+
+    def __snapshot(self) -> Dict[str, tuple]:
+        """
+        运行目录中各文件的 (大小, 修改时间)，用于找出某一阶段输出的文件
+        """
+        return {path.name: (path.stat().st_size, path.stat().st_mtime_ns) for path in self.run_path.iterdir()
+                if path.is_file() and path.name != self.STAGE_FILE}
 
     def __get_ready(self):
-        if self.run_path.exists():
-            shutil.rmtree(self.run_path)
-        shutil.copytree(self.project_path / 'bin', self.run_path)
+        # 保留上一次的结果，以便跳过输入没有变化的阶段
+        self.run_path.mkdir(parents=True, exist_ok=True)
+        # 程序直接从 bin 中运行，只复制程序会改写的数据文件（tape72 等），内容相同时不再复制
+        for path in (self.project_path / 'bin').iterdir():
+            if not path.is_file() or path.suffix == '.exe':
+                continue
+            target = self.run_path / path.name
+            if not target.exists() or file_hash(target) != file_hash(path):
+                shutil.copyfile(path, target)
         self.in36.save_as_in36(self.run_path / 'in36')
         self.in2.save_as_in2(self.run_path / 'in2')
 
-    def __run(self):
-        # 获取最初的运行路径
-        original_path = Path.cwd()
-
-        # 运行文件
-        os.chdir(self.run_path)
-        rcn = subprocess.run('./RCN.exe')
-        rcn2 = subprocess.run('./RCN2.exe')
-        self.__edit_ing11()
-        rcg = subprocess.run('./RCG.exe')
-        os.chdir(original_path)
+    def __run_stage(self, stage: str, on_output: Callable[[str, str], None] | None):
+        with self.__lock:
+            if self.__cancelled:
+                return
+            self.__process = subprocess.Popen([(self.project_path / f'bin/{stage}.exe').resolve().as_posix()],
+                                              cwd=self.run_path,
+                                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                              text=True, errors='replace')
+        for line in self.__process.stdout:
+            if on_output is not None:
+                on_output(stage, line.rstrip('\n'))
+        self.return_codes[stage] = self.__process.wait()
+        self.__process = None
 
     def __edit_ing11(self):
-        with open('./out2ing', 'r', encoding='utf-8') as f:
+        with open(self.run_path / 'out2ing', 'r', encoding='utf-8') as f:
             text = f.read()
         text = f'    {self.coupling_mode}{text[5:]}'
-        with open('./ing11', 'w', encoding='utf-8') as f:
+        with open(self.run_path / 'ing11', 'w', encoding='utf-8') as f:
             f.write(text)
-        with open('./out2ing', 'w', encoding='utf-8') as f:
+        with open(self.run_path / 'out2ing', 'w', encoding='utf-8') as f:
             f.write(text)
+
+
+class RunManager:
+    def __init__(self):
+        """
+        在后台线程中运行 Run，不同名称的计算可以同时进行
+        """
+        # 正在运行的计算 {名称: (Run, 线程)}
+        self.running: Dict[str, tuple] = {}
+
+    def submit(self, run: Run,
+               on_output: Callable[[str, str], None] | None = None,
+               on_stage: Callable[[str], None] | None = None,
+               on_finished: Callable[[Run, Exception | None], None] | None = None):
+        """
+        开始计算，立即返回，回调函数都在后台线程中调用
+        Args:
+            run: 创建时 auto_run=False 的 Run 对象
+            on_output: 见 Run.run
+            on_stage: 见 Run.run
+            on_finished: 结束时调用，参数为 Run 对象和出现的异常（没有异常时为None）
+        """
+        if self.is_running(run.name):
+            raise ValueError(f'{run.name} 正在计算')
+
+        def target():
+            error = None
+            try:
+                run.run(on_output, on_stage)
+            except Exception as e:
+                error = e
+            self.running.pop(run.name, None)
+            if on_finished is not None:
+                on_finished(run, error)
+
+        thread = threading.Thread(target=target, daemon=True)
+        self.running[run.name] = (run, thread)
+        thread.start()
+
+    def is_running(self, name: str | None = None) -> bool:
+        """
+        某个计算是否正在运行，name 为None时判断是否有任何计算正在运行
+        """
+        if name is None:
+            return len(self.running) > 0
+        return name in self.running
+
+    def cancel(self, name: str | None = None):
+        """
+        取消某个计算，name 为None时取消所有计算
+        """
+        for key, (run, thread) in list(self.running.items()):
+            if name is None or key == name:
+                run.cancel()
+
+    def wait(self):
+        """
+        等待所有计算结束
+        """
+        for run, thread in list(self.running.values()):
+            thread.join()
@@ -0,0 +1,252 @@
+# 光谱相似度
+from typing import Callable, Dict, List
+
+import numpy as np
+
+# 已注册的相似度 {名称: Metric}
+METRICS: Dict[str, 'Metric'] = {}
+
+
+class Metric:
+    def __init__(self, name: str, fun: Callable, higher_is_better: bool, label: str):
+        """
+        相似度
+        Args:
+            name: 名称
+            fun: fun(comparer, y2, intensity, **options)，y2 为插值到实验波长并归一化后的模拟光谱，
+                 intensity 为原始的模拟光谱，形状都是 (光谱个数, 点数)，返回形状为 (光谱个数,) 的数组
+            higher_is_better: 值越大是否越相似
+            label: 显示的名称
+        """
+        self.name = name
+        self.fun = fun
+        self.higher_is_better = higher_is_better
+        self.label = label
+
+
+def register_metric(name: str, higher_is_better: bool, label: str):
+    """
+    注册相似度的装饰器，注册后即可在 SpectraAdd.metrics 中通过名称选择
+    """
+    def decorator(fun):
+        METRICS[name] = Metric(name, fun, higher_is_better, label)
+        return fun
+
+    return decorator
+
+
+class SpectrumComparer:
+    def __init__(self, exp_wavelength: np.ndarray, exp_intensity: np.ndarray, wavelength: np.ndarray):
+        """
+        把一批模拟光谱和同一条实验光谱比较
+        实验光谱的截取、归一化以及插值所需的下标和权重只计算一次，
+        之后每一批模拟光谱只需要一次矩阵运算就可以插值到实验波长上
+        插值与 SpectraAdd.get_y1y2 相同（线性插值，超出范围时外推）
+        Args:
+            exp_wavelength: 实验光谱的波长
+            exp_intensity: 实验光谱的强度
+            wavelength: 模拟光谱的波长，同一批模拟光谱的波长相同
+        """
+        self.exp_wavelength = np.asarray(exp_wavelength, dtype=float)
+        self.exp_intensity = np.asarray(exp_intensity, dtype=float)
+        self.wavelength = np.asarray(wavelength, dtype=float)
+
+        min_x = max(self.exp_wavelength.min(), self.wavelength.min())
+        max_x = min(self.exp_wavelength.max(), self.wavelength.max())
+        # 两条光谱重叠的部分
+        self.model_mask = (min_x <= self.wavelength) & (self.wavelength <= max_x)
+        exp_mask = (min_x <= self.exp_wavelength) & (self.exp_wavelength <= max_x)
+        self.x = self.exp_wavelength[exp_mask]
+        self.y1 = self.exp_intensity[exp_mask] / self.exp_intensity[exp_mask].max()
+
+        # 模拟光谱的波长可能是降序的
+        xb = self.wavelength[self.model_mask]
+        order = np.argsort(xb, kind='stable')
+        xb = xb[order]
+        index = np.clip(np.searchsorted(xb, self.x), 1, xb.shape[0] - 1)
+        self.__lo = order[index - 1]
+        self.__hi = order[index]
+        self.__weight = (self.x - xb[index - 1]) / (xb[index] - xb[index - 1])
+
+    def interpolate(self, intensity: np.ndarray) -> np.ndarray:
+        """
+        把模拟光谱插值到实验波长上，并按最大值归一化
+        Args:
+            intensity: 形状为 (光谱个数, 模拟光谱点数)
+
+        Returns:
+            形状为 (光谱个数, 实验光谱点数)
+        """
+        yb = np.atleast_2d(intensity)[:, self.model_mask]
+        y2 = yb[:, self.__lo] * (1 - self.__weight) + yb[:, self.__hi] * self.__weight
+        return y2 / y2.max(axis=1, keepdims=True)
+
+    def evaluate(self, intensity: np.ndarray, names: List[str], options: Dict[str, dict] | None = None):
+        """
+        计算一批模拟光谱的多个相似度，插值只进行一次
+        Args:
+            intensity: 形状为 (光谱个数, 模拟光谱点数)
+            names: 相似度的名称
+            options: {名称: 参数}
+
+        Returns:
+            {名称: 形状为 (光谱个数,) 的数组}
+        """
+        options = options or {}
+        intensity = np.atleast_2d(intensity)
+        y2 = self.interpolate(intensity)
+        return {name: np.asarray(METRICS[name].fun(self, y2, intensity, **options.get(name, {})), dtype=float)
+                for name in names}
+
+
+def lb_keogh(y1: np.ndarray, y2: np.ndarray, window: int) -> float:
+    """
+    带宽为 window 的 DTW 距离的下界（LB_Keogh），计算量与序列长度成正比
+    两条序列的长度必须相同
+    Args:
+        y1: 序列1
+        y2: 序列2
+        window: Sakoe-Chiba 带宽（点数）
+
+    Returns:
+        DTW 距离的下界
+    """
+    from scipy.ndimage import maximum_filter1d, minimum_filter1d
+
+    upper = maximum_filter1d(y2, 2 * window + 1, mode='nearest')
+    lower = minimum_filter1d(y2, 2 * window + 1, mode='nearest')
+    return float(np.sum(np.maximum(y1 - upper, 0) + np.maximum(lower - y1, 0)))
+
+
+def dtw_distance(y1: np.ndarray, y2: np.ndarray, window: int | None = None, threshold: float = np.inf) -> float:
+    """
+    精确的 DTW 距离，点与点之间的距离为差的绝对值
+    逐行计算累积距离矩阵，行内的递推 D[j] = c[j] + min(b[j], D[j-1]) 可以展开为
+    D = C + minimum.accumulate(b - C[j-1])，其中 C 为 c 的累加和，b[j] = min(D'[j], D'[j-1]) 由上一行得到，
+    因此每一行只需要几次向量运算
+    Args:
+        y1: 序列1
+        y2: 序列2
+        window: Sakoe-Chiba 带宽（点数），第 i 行只计算对角线附近 window 个点以内的列，为None时不限制
+        threshold: 距离的上限，下界或某一行的最小值超过该值时停止计算
+
+    Returns:
+        DTW 距离；提前停止时返回已经得到的下界（不小于 threshold）
+    """
+    y1 = np.asarray(y1, dtype=float)
+    y2 = np.asarray(y2, dtype=float)
+    n, m = y1.shape[0], y2.shape[0]
+    if window is None:
+        window = max(n, m)
+    # 长度不同时带宽至少要能连接两个端点
+    window = max(int(window), abs(n - m))
+
+    if n == m and threshold < np.inf:
+        bound = lb_keogh(y1, y2, window)
+        if bound >= threshold:
+            return bound
+
+    # 每一行在 y2 中对应的范围 [lo, hi)
+    center = np.arange(n) * (m - 1) / max(n - 1, 1)
+    lo = np.clip(np.ceil(center - window).astype(int), 0, m - 1)
+    hi = np.clip(np.floor(center + window).astype(int) + 1, 1, m)
+    # 上一行的累积距离，左侧多一个元素表示第 -1 列
+    prev = np.full(m + 1, np.inf)
+    prev[0] = 0
+    row = np.full(m + 1, np.inf)
+    for i in range(n):
+        a, b = lo[i], hi[i]
+        cost = np.abs(y1[i] - y2[a:b])
+        temp = np.minimum(prev[a + 1:b + 1], prev[a:b])
+        cum = np.cumsum(cost)
+        row[:] = np.inf
+        row[a + 1:b + 1] = cum + np.minimum.accumulate(temp - (cum - cost))
+        if row[a + 1:b + 1].min() >= threshold:
+            return float(row[a + 1:b + 1].min())
+        prev, row = row, prev
+    return float(prev[m])
+
+
+def nearest_point_distance(x1: np.ndarray, y1: np.ndarray, x2: np.ndarray, y2: np.ndarray) -> float:
+    """
+    对光谱1的每个点，找到光谱2中 (x, y) 平面上最近的点，求距离的平均值
+    在光谱2上建立 KD 树，一次查询所有点
+    Args:
+        x1: 光谱1的横坐标
+        y1: 光谱1的纵坐标
+        x2: 光谱2的横坐标
+        y2: 光谱2的纵坐标
+    """
+    from scipy.spatial import cKDTree
+
+    tree = cKDTree(np.column_stack([x2, y2]))
+    distance, _ = tree.query(np.column_stack([x1, y1]))
+    return float(distance.mean())
+
+
+@register_metric('nearest', False, '最近点距离')
+def nearest_distance(comparer: SpectrumComparer, y2: np.ndarray, intensity: np.ndarray):
+    """
+    遍历实验光谱的每个点，找到模拟光谱中最近的点，计算距离，并求平均，见 SpectraAdd.spectrum_similarity1
+    """
+    y1 = comparer.exp_intensity / comparer.exp_intensity.max()
+    return [nearest_point_distance(comparer.exp_wavelength, y1, comparer.wavelength, y / y.max()) for y in intensity]
+
+
+@register_metric('r2', True, 'R2')
+def r2(comparer: SpectrumComparer, y2: np.ndarray, intensity: np.ndarray):
+    """
+    见 SpectraAdd.spectrum_similarity2
+    """
+    mean = y2.mean(axis=1, keepdims=True)
+    ss_reg = np.power(comparer.y1 - mean, 2).sum(axis=1)
+    ss_tot = np.power(y2 - mean, 2).sum(axis=1)
+    res = ss_reg / ss_tot
+    return np.where(res > 1, 1 / res, res)
+
+
+@register_metric('dtw', False, 'DTW距离')
+def dtw(comparer: SpectrumComparer, y2: np.ndarray, intensity: np.ndarray,
+        method='fastdtw', window=0.1, prune: float | None = None):
+    """
+    见 SpectraAdd.spectrum_similarity3
+    Args:
+        prune: 距离超过这一批中目前最小值的多少倍就不再精确计算，为None时全部精确计算，仅用于 'band'
+    """
+    if method == 'fastdtw':
+        from fastdtw import fastdtw
+        return [fastdtw(comparer.y1, y)[0] for y in y2]
+    if window is not None:
+        window = max(int(np.ceil(window * comparer.y1.shape[0])), 1)
+    res = []
+    best = np.inf
+    for y in y2:
+        res.append(dtw_distance(comparer.y1, y, window, np.inf if prune is None else best * prune))
+        best = min(best, res[-1])
+    return res
+
+
+@register_metric('corr', True, '相关系数')
+def correlation(comparer: SpectrumComparer, y2: np.ndarray, intensity: np.ndarray):
+    """
+    皮尔逊相关系数加1，见 SpectraAdd.spectrum_similarity4
+    """
+    a = comparer.y1 - comparer.y1.mean()
+    b = y2 - y2.mean(axis=1, keepdims=True)
+    return b @ a / np.sqrt((a @ a) * np.einsum('ij,ij->i', b, b)) + 1
+
+
+@register_metric('peak', True, '峰值匹配')
+def peak_match(comparer: SpectrumComparer, y2: np.ndarray, intensity: np.ndarray):
+    """
+    峰值位置相同的比例，见 SpectraAdd.spectrum_similarity5，没有峰时为0
+    """
+    from scipy.signal import find_peaks
+
+    peaks1, _ = find_peaks(comparer.y1, height=0.5)
+    res = []
+    for y in y2:
+        peaks2, _ = find_peaks(y, height=0.5)
+        num = min(len(peaks1), len(peaks2))
+        res.append(len(np.intersect1d(peaks1, peaks2)) / num if num else 0)
+    return res
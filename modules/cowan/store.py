@@ -0,0 +1,140 @@
+# 项目文件
+import json
+import os
+import shelve
+from pathlib import Path
+from typing import Dict
+
+import numpy as np
+
+from .atom import Atomic
+from .data import ExpData, CalData, Widen
+from .input_files import In36, In2
+from .run import Recorder, Run
+
+# 项目文件的格式版本
+VERSION = 1
+
+
+class ProjectStore:
+    def __init__(self, path: Path):
+        """
+        保存各对象状态的项目文件，由两个文件组成：
+            <path>.json: 参数以及数据文件的路径
+            <path>.npz: 状态中的数组，不压缩，读取时不需要解析文本
+        对象只保存 get_state 的结果，DataFrame 等可以从数据文件重新读取的内容不保存
+        Args:
+            path: 项目文件的路径，不包含后缀
+        """
+        self.path = Path(path)
+        self.json_path = self.path.with_name(self.path.name + '.json')
+        self.npz_path = self.path.with_name(self.path.name + '.npz')
+
+    def exists(self) -> bool:
+        return self.json_path.exists()
+
+    def save(self, states: Dict[str, Dict | None]):
+        """
+        保存状态，先写临时文件再替换，避免中途出错时损坏原来的文件
+        Args:
+            states: {对象名称: 对象的状态}，状态中可以包含 numpy 数组
+        """
+        arrays = {}
+
+        def pack(value, key):
+            if isinstance(value, np.ndarray):
+                arrays[key] = value
+                return {'__array__': key}
+            if isinstance(value, dict):
+                return {k: pack(v, f'{key}/{k}') for k, v in value.items()}
+            if isinstance(value, (list, tuple)):
+                return [pack(v, f'{key}/{i}') for i, v in enumerate(value)]
+            if isinstance(value, np.generic):
+                return value.item()
+            return value
+
+        content = {'version': VERSION, 'states': pack(states, '')}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.npz_path.with_name(self.npz_path.name + '.tmp')
+        with open(temp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(temp_path, self.npz_path)
+        temp_path = self.json_path.with_name(self.json_path.name + '.tmp')
+        temp_path.write_text(json.dumps(content, ensure_ascii=False, indent=2), encoding='utf-8')
+        os.replace(temp_path, self.json_path)
+
+    def load(self) -> Dict[str, Dict | None]:
+        """
+        读取状态
+        Returns:
+            {对象名称: 对象的状态}
+        """
+        content = json.loads(self.json_path.read_text(encoding='utf-8'))
+        if content['version'] > VERSION:
+            raise ValueError(f'项目文件的版本 {content["version"]} 高于当前支持的版本 {VERSION}')
+        with np.load(self.npz_path) as arrays:
+            def unpack(value):
+                if isinstance(value, dict):
+                    if set(value.keys()) == {'__array__'}:
+                        return arrays[value['__array__']]
+                    return {k: unpack(v) for k, v in value.items()}
+                if isinstance(value, list):
+                    return [unpack(v) for v in value]
+                return value
+
+            return unpack(content['states'])
+
+
+def save_objects(path: Path, **objects):
+    """
+    保存对象，对象为None时保存为None
+    Args:
+        path: 项目文件的路径，见 ProjectStore
+        **objects: atom, exp_data, in36, in2, run, cal_data, widen, recorder 中的任意几个
+    """
+    ProjectStore(path).save({key: None if value is None else value.get_state() for key, value in objects.items()})
+
+
+def load_objects(path: Path, project_path: Path, recorder: Recorder | None = None) -> Dict:
+    """
+    读取 save_objects 保存的对象，计算数据在第一次使用时才读取
+    没有项目文件而有以前版本保存的 shelve 数据库时，从数据库中读取，两者都没有时抛出 FileNotFoundError
+    Args:
+        path: 项目文件的路径，见 ProjectStore
+        project_path: 项目路径
+        recorder: 项目文件中没有 recorder 时 Run 使用的记录器
+
+    Returns:
+        {对象名称: 对象}
+    """
+    store = ProjectStore(path)
+    if not store.exists():
+        return load_shelve(path)
+    states = store.load()
+    objects = {}
+
+    def restore(key, fun, *args):
+        if key in states:
+            objects[key] = None if states[key] is None else fun(states[key], *args)
+
+    restore('recorder', Recorder.from_state, project_path)
+    restore('atom', Atomic.from_state)
+    restore('in36', In36.from_state)
+    restore('in2', In2.from_state)
+    restore('exp_data', ExpData.from_state, project_path)
+    restore('run', Run.from_state, project_path, objects.get('recorder') or recorder or Recorder(project_path))
+    restore('cal_data', CalData.from_state, project_path, objects.get('exp_data'))
+    restore('widen', Widen.from_state, project_path, objects.get('exp_data'), objects.get('cal_data'))
+    return objects
+
+
+def load_shelve(path: Path) -> Dict:
+    """
+    读取以前版本用 shelve 保存的对象，数据库不存在时抛出 FileNotFoundError
+    """
+    # 不同的 dbm 后端使用不同的文件名
+    path = Path(path)
+    if not any(path.with_name(path.name + suffix).exists() for suffix in ['', '.db', '.dat', '.dir']):
+        raise FileNotFoundError(f'没有找到项目文件：{path}')
+    with shelve.open(Path(path).as_posix(), flag='r') as obj_info:
+        return dict(obj_info)
@@ -0,0 +1,93 @@
+# 各启动阶段的导入时间，用于发现启动变慢的改动
+# 用法：python -m modules.import_time [-s 阶段 ...] [-o 结果.json] [-b 以前的结果.json]
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+# 启动阶段 {名称: 在新的解释器中执行的语句}，每个阶段单独统计
+STAGES = {
+    'login': 'import main',
+    'main_window': 'import main; main.import_main_modules()',
+    'data': 'import modules.cowan.data',
+    'pipeline': 'import modules.cowan.pipeline',
+}
+
+
+def measure(statement: str, cwd: Path | None = None) -> Dict[str, float]:
+    """
+    在新的解释器中用 -X importtime 执行语句，按顶层包汇总导入时间
+    Args:
+        statement: 要执行的语句
+        cwd: 工作路径，为None时为项目的根目录
+
+    Returns:
+        {顶层包名: 导入时间（毫秒）}，按时间从大到小排列
+    """
+    cwd = cwd or Path(__file__).resolve().parent.parent
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                             cwd=cwd, capture_output=True, text=True, encoding='utf-8')
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1])
+    times = {}
+    for line in process.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_time, _, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        times[package] = times.get(package, 0.0) + int(self_time) / 1000
+    return dict(sorted(times.items(), key=lambda item: -item[1]))
+
+
+def get_report(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]] | None = None,
+               top: int = 10) -> str:
+    """
+    导入时间的汇总表
+    Args:
+        results: {阶段: measure 的结果}
+        baseline: 以前的结果，给出时显示变化量
+        top: 每个阶段显示的包数
+    """
+    baseline = baseline or {}
+    lines = []
+    for stage, times in results.items():
+        old = baseline.get(stage, {})
+        total = sum(times.values())
+        head = f'{stage}: {total:.1f} ms'
+        if old:
+            head += f' ({total - sum(old.values()):+.1f} ms)'
+        lines.append(head)
+        for package, value in list(times.items())[:top]:
+            line = f'    {package:<24}{value:>10.1f}'
+            if old:
+                line += f'{value - old.get(package, 0.0):>+10.1f}'
+            lines.append(line)
+    return '\n'.join(lines)
+
+
+def main(argv: List[str] | None = None):
+    parser = argparse.ArgumentParser(description='统计各启动阶段的导入时间')
+    parser.add_argument('-s', '--stages', nargs='+', choices=list(STAGES), default=list(STAGES), help='启动阶段')
+    parser.add_argument('-o', '--output', default=None, help='把结果保存为json文件')
+    parser.add_argument('-b', '--baseline', default=None, help='以前保存的结果，用于比较')
+    parser.add_argument('-n', '--top', type=int, default=10, help='每个阶段显示的包数')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for stage in args.stages:
+        try:
+            results[stage] = measure(STAGES[stage])
+        except RuntimeError as e:
+            print(f'{stage}: 导入失败 {e}')
+    baseline = json.loads(Path(args.baseline).read_text(encoding='utf-8')) if args.baseline else None
+    print(get_report(results, baseline, args.top))
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2), encoding='utf-8')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,5 @@
+# 测试时从仓库根目录导入 modules
+import sys
+from pathlib import Path
+
+sys.path.insert(0, Path(__file__).resolve().parents[1].as_posix())
@@ -0,0 +1,28 @@
+# 共用的 plotly.js 的版本检查，见 figure.get_plotly_js
+import pytest
+
+from modules.cowan.figure import PLOTLY_JS, PLOTLY_JS_MIN_VERSION, get_plotly_js, get_plotly_js_version
+
+OLD_JS = '/**\n* plotly.js v2.12.1\n*/\n'
+
+
+def test_old_plotly_js_replaced(tmp_path):
+    """
+    figure 文件夹中不支持 typed array 的 plotly.js 重新从 plotly 包中复制
+    """
+    pytest.importorskip('plotly')
+    (tmp_path / PLOTLY_JS).write_text(OLD_JS, encoding='utf-8')
+    js_path = get_plotly_js(tmp_path)
+    with open(js_path, encoding='utf-8') as f:
+        assert get_plotly_js_version(f.read(200)) >= PLOTLY_JS_MIN_VERSION
+
+
+def test_old_plotly_package(tmp_path, monkeypatch):
+    """
+    plotly 包中的 plotly.js 不支持 typed array 时报错，不写入文件
+    """
+    offline = pytest.importorskip('plotly.offline')
+    monkeypatch.setattr(offline, 'get_plotlyjs', lambda: OLD_JS)
+    with pytest.raises(ImportError):
+        get_plotly_js(tmp_path)
+    assert not (tmp_path / PLOTLY_JS).exists()
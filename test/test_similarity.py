@@ -0,0 +1,102 @@
+# 相似度计算与原来实现的对比，使用固定随机种子生成的光谱
+import numpy as np
+import pandas as pd
+import pytest
+
+from modules.cowan.data import SpectraAdd
+from modules.cowan.similarity import dtw_distance, lb_keogh, nearest_point_distance
+
+
+def get_spectrum(rng, n):
+    """
+    几个随机位置的高斯峰加上噪声，归一化到最大值为1
+    """
+    x = np.linspace(0, 1, n)
+    y = sum(rng.uniform(0.2, 1) * np.exp(-(x - rng.uniform(0, 1)) ** 2 / 2e-4) for _ in range(5))
+    y = y + rng.uniform(0, 0.05, n)
+    return y / y.max()
+
+
+def dtw_reference(y1, y2, window=None):
+    """
+    逐元素计算的 DTW，带宽的定义与 dtw_distance 相同
+    """
+    n, m = len(y1), len(y2)
+    window = max(n, m) if window is None else max(window, abs(n - m))
+    cost = np.full((n + 1, m + 1), np.inf)
+    cost[0, 0] = 0
+    for i in range(n):
+        center = i * (m - 1) / max(n - 1, 1)
+        for j in range(m):
+            if abs(j - center) <= window:
+                cost[i + 1, j + 1] = abs(y1[i] - y2[j]) + min(cost[i, j], cost[i, j + 1], cost[i + 1, j])
+    return cost[n, m]
+
+
+@pytest.mark.parametrize('n, m', [(60, 60), (60, 45)])
+def test_dtw_matches_fastdtw(n, m):
+    """
+    半径覆盖整条序列时 fastdtw 为精确的 DTW；默认半径时 fastdtw 是近似值，不小于精确值
+    """
+    fastdtw = pytest.importorskip('fastdtw').fastdtw
+    rng = np.random.default_rng(2)
+    y1, y2 = get_spectrum(rng, n), get_spectrum(rng, m)
+    distance = dtw_distance(y1, y2)
+    assert distance == pytest.approx(fastdtw(y1, y2, radius=max(n, m))[0], rel=1e-12)
+    assert distance <= fastdtw(y1, y2)[0] + 1e-12
+
+
+@pytest.mark.parametrize('window', [0, 3, 10])
+def test_dtw_band(window):
+    rng = np.random.default_rng(3)
+    y1, y2 = get_spectrum(rng, 50), get_spectrum(rng, 50)
+    distance = dtw_distance(y1, y2, window)
+    assert distance == pytest.approx(dtw_reference(y1, y2, window), rel=1e-12)
+    # 带宽越小距离越大，LB_Keogh 是下界
+    assert dtw_distance(y1, y2) <= distance + 1e-12
+    assert lb_keogh(y1, y2, window) <= distance + 1e-12
+
+
+def test_dtw_threshold():
+    """
+    超过 threshold 时提前停止，返回值不小于 threshold；没有超过时与不设置 threshold 相同
+    """
+    rng = np.random.default_rng(4)
+    y1, y2 = get_spectrum(rng, 80), get_spectrum(rng, 80)
+    distance = dtw_distance(y1, y2, 8)
+    assert dtw_distance(y1, y2, 8, threshold=distance / 2) >= distance / 2
+    assert dtw_distance(y1, y2, 8, threshold=distance * 2) == distance
+
+
+def test_dtw_default_is_fastdtw():
+    """
+    默认的 DTW 相似度与原来的 fastdtw 相同，带宽约束的精确 DTW 需要手动选择
+    """
+    fastdtw = pytest.importorskip('fastdtw').fastdtw
+    rng = np.random.default_rng(6)
+    y1, y2 = get_spectrum(rng, 120), get_spectrum(rng, 120)
+    fax = pd.DataFrame({'wavelength': np.arange(120), 'intensity': y1})
+    fbx = pd.DataFrame({'wavelength': np.arange(120), 'intensity': y2})
+    assert SpectraAdd.spectrum_similarity3(fax, fbx) == pytest.approx(fastdtw(y1, y2)[0], rel=1e-12)
+    assert SpectraAdd.spectrum_similarity3(fax, fbx, 'band') == pytest.approx(dtw_distance(y1, y2, 12), rel=1e-12)
+
+
+def nearest_reference(x1, y1, x2, y2):
+    """
+    原来的 spectrum_similarity1：逐点求到光谱2所有点的最小距离，再求平均
+    """
+    res = 0
+    for i in range(x1.shape[0]):
+        res += min(np.sqrt((x1[i] - x2) ** 2 + (y1[i] - y2) ** 2))
+    return res / x1.shape[0]
+
+
+def test_nearest_point_distance():
+    rng = np.random.default_rng(5)
+    x1, x2 = np.linspace(10, 20, 300), np.sort(rng.uniform(9, 21, 500))
+    y1, y2 = get_spectrum(rng, 300), get_spectrum(rng, 500)
+    distance = nearest_point_distance(x1, y1, x2, y2)
+    assert distance == pytest.approx(nearest_reference(x1, y1, x2, y2), rel=1e-12)
+    fax = pd.DataFrame({'wavelength': x1, 'intensity': y1 * 3})
+    fbx = pd.DataFrame({'wavelength': x2, 'intensity': y2 * 7})
+    assert SpectraAdd.spectrum_similarity1(fax, fbx) == pytest.approx(distance, rel=1e-12)
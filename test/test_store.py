@@ -0,0 +1,27 @@
+# 项目文件的保存和读取，见 store.ProjectStore
+import numpy as np
+import pandas as pd
+
+from modules.cowan.data import ExpData
+from modules.cowan.store import load_objects, save_objects
+
+
+def write_exp(path, intensity):
+    pd.DataFrame({'wavelength': np.linspace(10, 20, 50), 'intensity': intensity}).to_csv(path, index=False)
+
+
+def test_exp_data_keeps_saved_spectrum(tmp_path):
+    """
+    重新加载实验数据会覆盖实验谱文件，历史记录中的实验数据仍为保存时的数据
+    """
+    exp_path = tmp_path / 'exp_data.csv'
+    write_exp(exp_path, np.linspace(1, 2, 50))
+    exp_data = ExpData(tmp_path, exp_path, plot=False)
+    exp_data.set_range([12, 18], plot=False)
+    save_objects(tmp_path / 'obj_info', exp_data=exp_data)
+
+    write_exp(exp_path, np.linspace(5, 9, 50))
+    restored = load_objects(tmp_path / 'obj_info', tmp_path)['exp_data']
+    assert restored.x_range == [12, 18]
+    for key in ['wavelength', 'intensity', 'intensity_normalization']:
+        assert np.array_equal(restored.data[key].values, exp_data.data[key].values)
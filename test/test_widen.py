@@ -0,0 +1,122 @@
+# 各展宽方式与逐点计算（'point'）的对比，使用固定随机种子生成的谱线，不依赖 Cowan 的计算结果
+import numpy as np
+import pytest
+
+from modules.cowan.data import CalData, ExpData, Widen
+
+# 与 'point' 的最大偏差（相对于各列的最大值）
+TOLERANCE = {'batch': 1e-10, 'window': 2e-2, 'fft': 5e-3}
+COLUMNS = ['gauss', 'cross_NP', 'cross_P']
+
+
+@pytest.fixture(scope='module')
+def project(tmp_path_factory):
+    """
+    合成的项目：实验谱为 10~20 nm 的 400 个点，计算结果为 300 条随机谱线（包括实验范围外的）
+    spectra.dat 中能量的单位为 1000 cm-1，跃迁能量的单位为 eV
+    """
+    project_path = tmp_path_factory.mktemp('project')
+    rng = np.random.default_rng(1)
+    wavelength = np.linspace(10, 20, 400)
+    with open(project_path / 'exp.csv', 'w') as f:
+        f.write('wavelength,intensity\n')
+        for x in wavelength:
+            f.write(f'{x},{1 + np.sin(x)}\n')
+    cal_path = project_path / 'cal_result/Al_5'
+    cal_path.mkdir(parents=True)
+    with open(cal_path / 'spectra.dat', 'w') as f:
+        for _ in range(300):
+            energy_l = rng.uniform(0, 50)
+            energy_ev = 1239.84 / rng.uniform(9, 21)
+            f.write('{:12.3f} {:12.3f} {:10.4f} {:10.5f} {:3d} {:3d} {:5.1f} {:5.1f}\n'.format(
+                energy_l, energy_l + energy_ev * 8.06554, energy_ev, rng.uniform(0.001, 1),
+                rng.integers(1, 4), rng.integers(1, 3), rng.integers(0, 5) + 0.5, 1.5))
+    exp_data = ExpData(project_path, project_path / 'exp.csv', plot=False)
+    cal_data = CalData(project_path, exp_data, 'Al_5', plot=False)
+    return project_path, exp_data, cal_data
+
+
+def get_deviation(result, reference):
+    return {key: np.abs(result[key].values - reference[key].values).max() / np.abs(reference[key].values).max()
+            for key in COLUMNS}
+
+
+# fft 方式需要均匀的网格，只测试设置了 n 的情况
+@pytest.mark.parametrize('method, n', [('batch', None), ('batch', 2000), ('window', None), ('window', 2000),
+                                       ('fft', 2000)])
+def test_widen_matches_point(project, method, n):
+    project_path, exp_data, cal_data = project
+    widen = Widen(project_path, exp_data, cal_data, n=n, method=method)
+    point = Widen(project_path, exp_data, cal_data, n=n, method='point')
+    # 两个温度，'batch' 第二次使用缓存的温度无关部分
+    for temperature in [25.0, 60.0]:
+        reference = point.widen(temperature, save_in_memory=False)
+        result = widen.widen(temperature)
+        assert np.allclose(result['wavelength'].values, reference['wavelength'].values)
+        for key, value in get_deviation(result, reference).items():
+            assert value < TOLERANCE[method], (key, value)
+
+
+def test_widen_data_matches_point(project):
+    """
+    传入 data 时（如 widen_by_group）不使用缓存，结果同样与 'point' 相同
+    """
+    project_path, exp_data, cal_data = project
+    data = cal_data.data[cal_data.data['index_l'] == 1]
+    reference = Widen(project_path, exp_data, cal_data, method='point').widen(25.0, data, save_in_memory=False)
+    result = Widen(project_path, exp_data, cal_data, method='batch').widen(25.0, data, save_in_memory=False)
+    for key, value in get_deviation(result, reference).items():
+        assert value < TOLERANCE['batch'], (key, value)
+
+
+def test_legacy_widen_state(project):
+    """
+    以前的版本用 pickle 保存的 Widen（直接保存 init_data，没有展宽方式等参数）可以转换为新的项目文件
+    """
+    project_path, exp_data, cal_data = project
+    widen = Widen(project_path, exp_data, cal_data, method='point')
+    widen.widen(25.0)
+    state = {key: value for key, value in widen.__dict__.items()
+             if key not in ['method', 'chunk_size', 'cutoff', 'window_deviation', '_Widen__basis', '_Widen__init_data']}
+    state['init_data'] = cal_data.data.copy()
+    legacy = Widen.__new__(Widen)
+    legacy.__setstate__(state)
+
+    restored = Widen.from_state(legacy.get_state(), project_path, exp_data, cal_data)
+    assert restored.method == 'batch'
+    assert restored.window_deviation is None
+    assert np.allclose(restored.widen_data['cross_P'].values, widen.widen_data['cross_P'].values)
+    result = restored.widen(25.0, save_in_memory=False)
+    for key, value in get_deviation(result, widen.widen_data).items():
+        assert value < TOLERANCE['batch'], (key, value)
+
+
+@pytest.mark.parametrize('method, n', [('point', None), ('window', None), ('fft', 2000)])
+def test_widen_lines_matches_widen(project, method, n):
+    """
+    网格计算在子进程中按温度分块展宽（Widen.widen_lines），结果与逐个温度调用 widen 相同
+    """
+    project_path, exp_data, cal_data = project
+    widen = Widen(project_path, exp_data, cal_data, n=n, method=method)
+    temperatures = [25.0, 60.0]
+    result = Widen.from_settings(widen.get_settings()).widen_lines(widen.get_line_arrays(), temperatures)
+    for i, temperature in enumerate(temperatures):
+        reference = widen.widen(temperature, save_in_memory=False)['cross_P'].values
+        assert np.abs(result[i] - reference).max() / np.abs(reference).max() < 1e-10
+
+
+def test_cached_spectra_not_copied(project):
+    """
+    第二次读取 spectra.dat 时使用内存映射的 spectra.npy，各列不复制，展宽结果与第一次读取相同
+    """
+    project_path, exp_data, cal_data = project
+    first = cal_data.data
+    cached = CalData(project_path, exp_data, 'Al_5', plot=False)
+    for name in first.columns:
+        assert isinstance(cached.data[name].values, np.memmap)
+        assert np.array_equal(cached.data[name].values, first[name].values)
+    widen = Widen(project_path, exp_data, cached)
+    reference = Widen(project_path, exp_data, cal_data).widen(25.0, save_in_memory=False)
+    assert np.shares_memory(widen.init_data['intensity'].values, cached.data['intensity'].values)
+    for key, value in get_deviation(widen.widen(25.0), reference).items():
+        assert value < TOLERANCE['batch'], (key, value)